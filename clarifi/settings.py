@@ -24,6 +24,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "editor.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -92,8 +93,114 @@ STATICFILES_FINDERS = [
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# Largest image accepted, checked from the header before decoding (editor/utils/ingest.py)
+MAX_IMAGE_MEGAPIXELS = float(os.environ.get('MAX_IMAGE_MEGAPIXELS', '100'))
+
+# Disk budget for everything under MEDIA_ROOT (uploads, working-image spills,
+# histories, job results, the result cache and large-frame files, wherever
+# those are configured); uploads are refused above it
+# (editor/utils/media_store.py). Run `manage.py cleanup_media` periodically.
+MEDIA_STORAGE_BYTES = int(os.environ.get('MEDIA_STORAGE_MB', '5120')) * 1024 * 1024
+
+# Decoded studio images kept in memory per session (editor/utils/session_store.py)
+WORKING_IMAGE_CACHE_BYTES = int(os.environ.get('WORKING_IMAGE_CACHE_MB', '512')) * 1024 * 1024
+WORKING_IMAGE_IDLE_SECONDS = int(os.environ.get('WORKING_IMAGE_IDLE_SECONDS', '900'))
+# Spill every edit to disk so other workers see it; disable for single-worker setups.
+WORKING_IMAGE_WRITE_THROUGH = os.environ.get('WORKING_IMAGE_WRITE_THROUGH', 'True') == 'True'
+
+# Undo/redo history of studio images (editor/utils/history.py). Edits are
+# logged by their parameters; the frame is checkpointed every
+# HISTORY_CHECKPOINT_EVERY entries and after edits slower than
+# HISTORY_CHECKPOINT_SECONDS, so undo replays at most that many steps.
+HISTORY_MAX_ENTRIES = int(os.environ.get('HISTORY_MAX_ENTRIES', '50'))
+HISTORY_CHECKPOINT_EVERY = int(os.environ.get('HISTORY_CHECKPOINT_EVERY', '10'))
+HISTORY_CHECKPOINT_SECONDS = float(os.environ.get('HISTORY_CHECKPOINT_SECONDS', '0.5'))
+
+# Longest edge of the proxy used for preview=1 slider requests
+PREVIEW_MAX_EDGE = int(os.environ.get('PREVIEW_MAX_EDGE', '1024'))
+
+# Stored images and job results are streamed by editor/utils/serving.py.
+# Behind a proxy, let it send the file: "nginx" (X-Accel-Redirect to
+# SENDFILE_URL_PREFIX + path under MEDIA_ROOT, an internal location aliased
+# to MEDIA_ROOT) or "sendfile" (X-Sendfile with the absolute path).
+SENDFILE_BACKEND = os.environ.get('SENDFILE_BACKEND', '')
+SENDFILE_URL_PREFIX = os.environ.get('SENDFILE_URL_PREFIX', '/protected-media/')
+
+# Latency budget used to pick the denoise/restore tier when the request
+# doesn't give one (editor/utils/denoising.py)
+DENOISE_BUDGET_SECONDS = float(os.environ.get('DENOISE_BUDGET_SECONDS', '10'))
+
+# Output encoding (editor/utils/encoding.py); `manage.py bench_encode` shows
+# the time/size trade-off of each setting. PNG level is zlib 0-9, WebP
+# method 0 (fast) to 6 (small).
+ENCODE_JPEG_QUALITY = int(os.environ.get('ENCODE_JPEG_QUALITY', '75'))
+ENCODE_PNG_LEVEL = int(os.environ.get('ENCODE_PNG_LEVEL', '1'))
+ENCODE_WEBP_QUALITY = int(os.environ.get('ENCODE_WEBP_QUALITY', '80'))
+ENCODE_WEBP_METHOD = int(os.environ.get('ENCODE_WEBP_METHOD', '2'))
+ENCODE_AVIF_QUALITY = int(os.environ.get('ENCODE_AVIF_QUALITY', '60'))
+
+# Batch processing (editor/utils/batch.py). "thread" suits the GIL-releasing
+# cv2/PIL operations; "process" isolates heavier pure-Python work.
+BATCH_EXECUTOR = os.environ.get('BATCH_EXECUTOR', 'thread')
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(os.cpu_count() or 1)))
+# Images read and decoded at once, across all batch requests of a process
+BATCH_MAX_IN_FLIGHT = int(os.environ.get('BATCH_MAX_IN_FLIGHT', str(2 * BATCH_WORKERS)))
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', '100'))
+
+# TrueType fonts tried in order for text tools; Pillow's bundled font is the
+# fallback (editor/utils/resources.py).
+TEXT_FONT_PATHS = [path for path in os.environ.get(
+    'TEXT_FONT_PATHS', 'arial.ttf,DejaVuSans.ttf,/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf').split(',') if path]
+
+# Cache of tool responses for uploaded inputs (editor/utils/result_cache.py)
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'True') == 'True'
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(MEDIA_ROOT, 'result_cache'))
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_MB', '256')) * 1024 * 1024
+
+# Threads that split large-image filters into strips (editor/utils/tiling.py)
+TILE_WORKERS = int(os.environ.get('TILE_WORKERS', str(os.cpu_count() or 1)))
+# Frames of at least this many megapixels (collages, panoramas, tiled
+# filter output) live in memory-mapped files under LARGE_FRAME_DIR, which
+# must be on disk rather than tmpfs (editor/utils/mapped.py); 0 disables.
+LARGE_FRAME_MEGAPIXELS = float(os.environ.get('LARGE_FRAME_MEGAPIXELS', '50'))
+LARGE_FRAME_DIR = os.environ.get('LARGE_FRAME_DIR', os.path.join(MEDIA_ROOT, 'workfiles'))
+
+# Background jobs for slow tools (editor/utils/jobs.py). Keep JOB_WORKERS low so
+# heavy jobs leave CPU for the request threads; excess requests get a 503.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '1'))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', '8'))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', '3600'))
+# Run job pipelines in this many worker processes instead of on the job
+# threads, passing frames through shared memory (editor/utils/frames.py).
+# 0 keeps them in-process. Containers need a /dev/shm larger than the
+# biggest frames (docker's default is 64 MB; see shm_size).
+FRAME_PROCESSES = int(os.environ.get('FRAME_PROCESSES', '0'))
+
+# Async serving under ASGI (editor/utils/offload.py): tool views run on
+# OFFLOAD_WORKERS threads, one more than the CPUs so a busy heavy endpoint
+# still leaves a thread for quick edits. OFFLOAD_LIMITS ("endpoint=n,...",
+# by URL name) caps concurrent requests per endpoint; past
+# OFFLOAD_MAX_WAITING queued requests for one endpoint, callers get a 503.
+OFFLOAD_WORKERS = int(os.environ.get('OFFLOAD_WORKERS', str((os.cpu_count() or 1) + 1)))
+OFFLOAD_LIMITS = {name: int(limit) for name, limit in (
+    item.split('=') for item in os.environ.get('OFFLOAD_LIMITS', 'premium=1,collage=1,batch=1').split(',') if item)}
+OFFLOAD_MAX_WAITING = int(os.environ.get('OFFLOAD_MAX_WAITING', '256'))
+
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Measure the peak memory of one tracked operation in this many for
+# /metrics (editor/utils/metrics.py); 1 measures every operation, 0 none.
+METRICS_MEMORY_SAMPLE_EVERY = int(os.environ.get('METRICS_MEMORY_SAMPLE_EVERY', '10'))
+
+# Log INFO and above to the console; LOG_LEVEL overrides the level.
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {"simple": {"format": "%(levelname)s:%(name)s:%(message)s"}},
+    "handlers": {"console": {"class": "logging.StreamHandler", "formatter": "simple"}},
+    "root": {"handlers": ["console"], "level": os.environ.get("LOG_LEVEL", "INFO")},
+}
+
 # Security settings for production
 SECURE_SSL_REDIRECT = False if DEBUG else True
 SESSION_COOKIE_SECURE = False if DEBUG else True
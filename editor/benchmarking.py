@@ -0,0 +1,119 @@
+"""Shared helpers for the benchmark management commands."""
+import ctypes
+import io
+
+from .utils.lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+
+# Arguments used when benchmarking each ImageProcessor operation.
+OPERATION_ARGS = {
+    "adjust_brightness": (1.2,),
+    "adjust_contrast": (1.2,),
+    "adjust_saturation": (1.2,),
+    "adjust_hue": (0.1,),
+    "grayscale": (),
+    "sepia": (),
+    "blur": (3,),
+    "sharpen": (),
+    "edge_detection": (),
+    "crop": (0, 0, 512, 512),
+    "resize": (1024, 768),
+    "rotate": (90,),
+    "flip": ("horizontal",),
+    "add_text": ("ClariFi", 20, 20, 40, "#ffffff"),
+    "watermark": ("ClariFi", 0.5),
+    "vignette": (0.5,),
+    "noise": (0.3,),
+    "hdr": (),
+    "cartoon": (),
+    "super_resolution": (2,),
+    "auto_enhance": (),
+    "colorize": (),
+    "oil_painting": (),
+    "watercolor": (),
+    "sketch": (),
+    "emboss": (),
+    "inpaint": (100, 100, 20),
+    "face_detection": ("blur",),
+    "remove_background": (),
+    "restore": (),
+    "denoise": (10,),
+    "perspective_correction": ([(0, 0), (400, 10), (420, 300), (10, 290)],),
+    "color_pop": ((20, 90),),
+    "add_border": (10, "#ffffff"),
+    "meme_generator": ("TOP", "BOTTOM"),
+    "remove_red_eye": (),
+    "extract_palette": (5,),
+}
+
+
+def synthetic_image(megapixels, kind="photo", seed=0):
+    """Generate a deterministic test frame of roughly ``megapixels`` MP.
+
+    ``photo`` is a smooth colour field with fine texture, ``gradient`` a
+    plain ramp, ``gray`` a single-channel photo, ``rgba`` a photo with
+    a radial alpha channel and ``subject`` a photo with a textured,
+    irregular foreground blob in the middle (for segmentation).
+    """
+    width = max(int((megapixels * 1e6 * 4 / 3) ** 0.5), 8)
+    height = max(int(width * 3 / 4), 8)
+    rng = np.random.default_rng(seed)
+    if kind == "gradient":
+        ramp = np.linspace(0, 255, width, dtype=np.float32)
+        frame = np.empty((height, width, 3), np.uint8)
+        frame[:] = ramp[np.newaxis, :, np.newaxis]
+        return frame
+    coarse = rng.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+    frame = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    texture = rng.integers(-12, 13, (height, width, 1), dtype=np.int16)
+    frame = np.clip(frame + texture, 0, 255).astype(np.uint8)
+    if kind == "gray":
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    if kind == "subject":
+        yy, xx = np.ogrid[:height, :width]
+        angle = np.arctan2(yy - height / 2, xx - width / 2)
+        wobble = 1 + 0.15 * np.sin(5 * angle + seed) + 0.05 * np.sin(13 * angle)
+        dist = np.hypot((xx - width / 2) / (width * 0.3), (yy - height / 2) / (height * 0.3))
+        inside = dist < wobble
+        subject = np.array([200, 60, 40], np.int16) + texture * 3
+        frame[inside] = np.clip(subject, 0, 255).astype(np.uint8)[inside]
+        return frame
+    if kind == "rgba":
+        yy, xx = np.ogrid[:height, :width]
+        dist = np.hypot((xx - width / 2) / width, (yy - height / 2) / height)
+        alpha = np.clip(255 - dist * 400, 0, 255).astype(np.uint8)
+        return np.dstack((frame, alpha))
+    return frame
+
+
+def synthetic_upload(megapixels, kind="photo", format="JPEG", seed=0):
+    """Encode a synthetic frame the way a browser upload would arrive."""
+    frame = synthetic_image(megapixels, kind, seed)
+    if kind == "rgba" and format == "JPEG":
+        format = "PNG"
+    output = io.BytesIO()
+    Image.fromarray(frame).save(output, format=format, quality=90)
+    return output.getvalue()
+
+
+# mallopt() parameters from glibc's malloc.h.
+_M_TRIM_THRESHOLD = -1
+_M_MMAP_THRESHOLD = -3
+
+
+def pin_mmap_threshold(nbytes=128 * 1024):
+    """Make glibc hand buffers over ``nbytes`` back to the kernel as soon as they are freed.
+
+    glibc normally raises its mmap threshold after large frees and then
+    reuses heap memory, so a repeated allocation no longer moves the RSS
+    high-water mark. Returns False where the C library isn't glibc.
+    """
+    try:
+        libc = ctypes.CDLL("libc.so.6")
+        return bool(libc.mallopt(_M_MMAP_THRESHOLD, nbytes) and libc.mallopt(_M_TRIM_THRESHOLD, nbytes))
+    except (OSError, AttributeError):
+        return False
@@ -0,0 +1,69 @@
+import json
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from editor.benchmarking import synthetic_image
+from editor.utils import denoising, tiling
+
+
+class Command(BaseCommand):
+    help = ("Measure run time and quality (PSNR against the clean frame) of each denoise tier, "
+            "and show which tier auto picks for a range of frame sizes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--megapixels", type=float, default=1.0)
+        parser.add_argument("--sigma", type=float, default=12.0,
+                            help="Standard deviation of the Gaussian noise added to the frame")
+        parser.add_argument("--strength", type=int, default=10)
+        parser.add_argument("--budget", type=float, default=None,
+                            help="Latency budget for the auto column (default: DENOISE_BUDGET_SECONDS)")
+        parser.add_argument("--repeat", type=int, default=1,
+                            help="Runs per measurement; the fastest is kept")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON instead of a table")
+
+    def handle(self, *args, **options):
+        clean = cv2.cvtColor(synthetic_image(options["megapixels"]), cv2.COLOR_RGB2BGR)
+        noise = np.random.default_rng(0).normal(0, options["sigma"], clean.shape)
+        noisy = np.clip(clean + noise, 0, 255).astype(np.uint8)
+        height, width = clean.shape[:2]
+        megapixels = width * height / 1e6
+
+        results = []
+        for tier in denoising.TIERS:
+            best = float("inf")
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                output = denoising.apply(noisy, options["strength"], tier)
+                best = min(best, time.perf_counter() - start)
+            results.append({
+                "tier": tier,
+                "seconds": best,
+                "s_per_mp": best / megapixels * min(tiling.workers(), len(tiling.spans(height, width))),
+                "predicted_seconds": denoising.predict_seconds(tier, width, height),
+                "psnr": cv2.PSNR(clean, output),
+            })
+
+        budget = settings.DENOISE_BUDGET_SECONDS if options["budget"] is None else options["budget"]
+        auto = {}
+        for size in (1, 2, 4, 8, 12, 24, 48):
+            w = int((size * 1e6 * 4 / 3) ** 0.5)
+            auto[size] = denoising.choose_tier(w, w * 3 // 4, budget)
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"megapixels": megapixels, "workers": tiling.workers(),
+                                          "noisy_psnr": cv2.PSNR(clean, noisy), "budget": budget,
+                                          "results": results, "auto": auto}, indent=2))
+            return
+        self.stdout.write(f"{width}x{height} ({megapixels:.1f} MP), sigma {options['sigma']}, "
+                          f"{tiling.workers()} workers; noisy PSNR {cv2.PSNR(clean, noisy):.2f} dB")
+        self.stdout.write(f"{'tier':<10}{'ms':>10}{'s/MP/core':>11}{'predicted':>11}{'PSNR':>8}")
+        for row in results:
+            self.stdout.write(f"{row['tier']:<10}{row['seconds'] * 1000:>10.1f}{row['s_per_mp']:>11.2f}"
+                              f"{row['predicted_seconds'] * 1000:>9.0f}ms{row['psnr']:>8.2f}")
+        self.stdout.write(f"auto with a {budget:g} s budget: "
+                          + ", ".join(f"{size} MP -> {tier}" for size, tier in auto.items()))
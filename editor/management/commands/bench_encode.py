@@ -0,0 +1,80 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from editor.benchmarking import synthetic_image
+from editor.utils.encoding import available_formats, encode
+
+# (format, quality, effort) combinations measured by default; None means
+# the configured ENCODE_* setting.
+DEFAULT_CASES = [
+    ("jpeg", 75, None),
+    ("jpeg", 90, None),
+    ("png", None, 1),
+    ("png", None, 3),
+    ("png", None, 6),
+    ("webp", 80, 0),
+    ("webp", 80, 2),
+    ("webp", 80, 4),
+    ("webp", 80, 6),
+    ("avif", 60, None),
+]
+
+
+class Command(BaseCommand):
+    help = "Measure encode time and output size per format and quality/effort setting."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--megapixels", type=float, default=12.0)
+        parser.add_argument("--kind", default="photo", choices=["photo", "gradient", "rgba"],
+                            help="Synthetic frame to encode")
+        parser.add_argument("--formats", nargs="*", default=None,
+                            help="Only measure these formats (default: all available)")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="Runs per measurement; the fastest is kept")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON instead of a table")
+
+    def handle(self, *args, **options):
+        available = available_formats()
+        formats = options["formats"] or available
+        unknown = set(formats) - set(available)
+        if unknown:
+            raise CommandError(f"Unsupported formats: {', '.join(sorted(unknown))}")
+
+        frame = synthetic_image(options["megapixels"], options["kind"])
+        megapixels = frame.shape[0] * frame.shape[1] / 1e6
+        results = []
+        for format, quality, effort in DEFAULT_CASES:
+            if format not in formats:
+                continue
+            best = float("inf")
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                data = encode(frame, format, quality=quality, effort=effort)
+                best = min(best, time.perf_counter() - start)
+            results.append({
+                "format": format,
+                "quality": quality,
+                "effort": effort,
+                "seconds": best,
+                "mp_per_s": megapixels / best,
+                "bytes": len(data),
+                "bits_per_pixel": len(data) * 8 / (megapixels * 1e6),
+            })
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"megapixels": megapixels, "kind": options["kind"],
+                                          "results": results}, indent=2))
+            return
+        self.stdout.write(f"{frame.shape[1]}x{frame.shape[0]} {options['kind']} ({megapixels:.1f} MP); "
+                          f"defaults: JPEG q{settings.ENCODE_JPEG_QUALITY}, PNG level {settings.ENCODE_PNG_LEVEL}, "
+                          f"WebP q{settings.ENCODE_WEBP_QUALITY} method {settings.ENCODE_WEBP_METHOD}")
+        self.stdout.write(f"{'format':<8}{'quality':>8}{'effort':>8}{'ms':>10}{'MP/s':>8}{'KB':>10}{'bpp':>7}")
+        for row in results:
+            quality = "-" if row["quality"] is None else row["quality"]
+            effort = "-" if row["effort"] is None else row["effort"]
+            self.stdout.write(f"{row['format']:<8}{quality:>8}{effort:>8}{row['seconds'] * 1000:>10.1f}"
+                              f"{row['mp_per_s']:>8.1f}{row['bytes'] / 1024:>10.0f}{row['bits_per_pixel']:>7.2f}")
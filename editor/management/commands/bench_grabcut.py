@@ -0,0 +1,73 @@
+import json
+import time
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from editor.benchmarking import synthetic_image
+from editor.utils.image_processing import ImageProcessor
+
+
+class Command(BaseCommand):
+    help = ("Compare remove_background at several analysis resolutions against the "
+            "full-resolution GrabCut result: latency, mask IoU and IoU near the edge.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--megapixels", type=float, default=4.0)
+        parser.add_argument("--input", help="Image file to segment instead of a synthetic subject")
+        parser.add_argument("--edges", type=int, nargs="*", default=[320, 480, 640, 960],
+                            help="Analysis edges to compare with full resolution")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON instead of a table")
+
+    def handle(self, *args, **options):
+        if options["input"]:
+            with open(options["input"], "rb") as f:
+                frame = ImageProcessor(f).pixels
+        else:
+            frame = synthetic_image(options["megapixels"], "subject")
+        megapixels = frame.shape[0] * frame.shape[1] / 1e6
+
+        reference, reference_seconds = self.run(frame, 0)
+        reference_fg = reference >= 128
+        band = self.edge_band(reference_fg)
+        results = [{"analysis_edge": 0, "seconds": reference_seconds, "speedup": 1.0,
+                    "iou": 1.0, "edge_iou": 1.0}]
+        for edge in options["edges"]:
+            alpha, seconds = self.run(frame, edge)
+            fg = alpha >= 128
+            results.append({
+                "analysis_edge": edge,
+                "seconds": seconds,
+                "speedup": reference_seconds / seconds,
+                "iou": self.iou(fg, reference_fg),
+                # Whole-frame IoU is dominated by the interior; this only
+                # counts pixels within a few pixels of the reference edge.
+                "edge_iou": self.iou(fg & band, reference_fg & band),
+            })
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"megapixels": megapixels, "results": results}, indent=2))
+            return
+        self.stdout.write(f"{frame.shape[1]}x{frame.shape[0]} ({megapixels:.1f} MP)")
+        self.stdout.write(f"{'edge':>6}{'seconds':>10}{'speedup':>9}{'IoU':>8}{'edge IoU':>10}")
+        for row in results:
+            edge = row["analysis_edge"] or "full"
+            self.stdout.write(f"{edge:>6}{row['seconds']:>10.2f}{row['speedup']:>8.1f}x"
+                              f"{row['iou']:>8.4f}{row['edge_iou']:>10.4f}")
+
+    def run(self, frame, edge):
+        processor = ImageProcessor.from_array(frame)
+        start = time.perf_counter()
+        processor.remove_background(analysis_edge=edge)
+        return processor.pixels[..., 3], time.perf_counter() - start
+
+    def iou(self, a, b):
+        union = np.count_nonzero(a | b)
+        return np.count_nonzero(a & b) / union if union else 1.0
+
+    def edge_band(self, foreground, width=8):
+        mask = foreground.astype(np.uint8)
+        kernel = np.ones((2 * width + 1, 2 * width + 1), np.uint8)
+        return cv2.dilate(mask, kernel) != cv2.erode(mask, kernel)
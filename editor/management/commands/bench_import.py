@@ -0,0 +1,88 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from editor.utils.lazy import HEAVY_MODULES
+
+# What a gunicorn worker imports before it can answer its first request.
+STARTUP = "import django; django.setup(); import clarifi.urls"
+PRELOAD = "; from editor.utils.lazy import preload; preload()"
+
+
+def import_times(code):
+    """Run ``code`` in a fresh interpreter under ``-X importtime``.
+
+    Returns ``[(module, self_us, cumulative_us, depth), ...]`` in import order.
+    """
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": settings.SETTINGS_MODULE}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True,
+                            text=True, env=env, cwd=settings.BASE_DIR)
+    if result.returncode:
+        raise CommandError(f"Import failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def summarize(rows, top):
+    """Total import time, the packages that take most of it (by self time), and heavy modules loaded."""
+    packages = {}
+    for name, self_us, _, _ in rows:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    ranked = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return {
+        "total_ms": sum(cumulative for _, _, cumulative, depth in rows if depth == 0) / 1000,
+        "modules": len(rows),
+        "packages": [{"package": package, "ms": us / 1000} for package, us in ranked],
+        "heavy": [name for name in HEAVY_MODULES if any(row[0] == name for row in rows)],
+    }
+
+
+class Command(BaseCommand):
+    help = ("Measure worker start-up import time with -X importtime in fresh interpreters, and fail "
+            "if it is over a cold-start target or the URL conf imports NumPy, OpenCV or Pillow.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5,
+                            help="Fresh interpreters per measurement; the median run is reported")
+        parser.add_argument("--top", type=int, default=10, help="Packages to list")
+        parser.add_argument("--target-ms", type=float, default=500.0,
+                            help="Cold-start import budget for the URL conf (0 disables the check)")
+        parser.add_argument("--preload", action="store_true",
+                            help="Also measure start-up followed by lazy.preload(), as with gunicorn --preload")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON instead of a table")
+
+    def handle(self, *args, **options):
+        results = {"startup": self.measure(STARTUP, options)}
+        if options["preload"]:
+            results["preload"] = self.measure(STARTUP + PRELOAD, options)
+        target = options["target_ms"]
+        startup = results["startup"]
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"target_ms": target, "results": results}, indent=2))
+        else:
+            for label, summary in results.items():
+                self.stdout.write(f"{label}: {summary['total_ms']:.1f} ms for {summary['modules']} modules "
+                                  f"(median of {options['repeat']})")
+                for row in summary["packages"]:
+                    self.stdout.write(f"  {row['package']:<24}{row['ms']:>9.1f} ms")
+        if startup["heavy"]:
+            raise CommandError(f"Start-up imported {', '.join(startup['heavy'])}; import them through lazy_import")
+        if target and startup["total_ms"] > target:
+            raise CommandError(f"Start-up imports took {startup['total_ms']:.1f} ms, over the {target:g} ms target")
+
+    def measure(self, code, options):
+        runs = [summarize(import_times(code), options["top"]) for _ in range(max(1, options["repeat"]))]
+        return sorted(runs, key=lambda run: run["total_ms"])[len(runs) // 2]
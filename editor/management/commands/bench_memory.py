@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from editor.benchmarking import OPERATION_ARGS, synthetic_upload
+from editor.utils.memory import current_rss_kb, peak_rss_kb, reset_peak_rss
+
+
+class Command(BaseCommand):
+    help = "Measure peak RSS of every ImageProcessor operation, one process per operation."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--megapixels", type=float, default=24.0)
+        parser.add_argument("--ops", nargs="*", default=None,
+                            help="Operations to measure (default: all)")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON instead of a table")
+        parser.add_argument("--child", help=argparse.SUPPRESS)
+        parser.add_argument("--input", help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options["child"]:
+            return self.run_child(options["child"], options["input"])
+
+        ops = options["ops"] or list(OPERATION_ARGS)
+        unknown = set(ops) - set(OPERATION_ARGS)
+        if unknown:
+            raise CommandError(f"Unknown operations: {', '.join(sorted(unknown))}")
+
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+            f.write(synthetic_upload(options["megapixels"]))
+            path = f.name
+        try:
+            results = [self.measure(op, path) for op in ops]
+        finally:
+            os.unlink(path)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'operation':<24}{'frame MB':>10}{'op peak MB':>12}{'total MB':>10}")
+        for row in results:
+            if "error" in row:
+                self.stdout.write(f"{row['op']:<24}  error: {row['error']}")
+                continue
+            self.stdout.write(
+                f"{row['op']:<24}{row['frame_mb']:>10.1f}{row['op_peak_mb']:>12.1f}{row['peak_mb']:>10.1f}")
+
+    def measure(self, op, path):
+        """Run one operation in a fresh interpreter so peaks don't mix."""
+        proc = subprocess.run(
+            [sys.executable, os.path.join(settings.BASE_DIR, "manage.py"), "bench_memory", "--child", op, "--input", path],
+            capture_output=True, text=True)
+        if proc.returncode != 0:
+            return {"op": op, "error": proc.stderr.strip().splitlines()[-1:]}
+        return json.loads(proc.stdout)
+
+    def run_child(self, op, path):
+        from editor.utils.image_processing import ImageProcessor
+
+        with open(path, "rb") as f:
+            processor = ImageProcessor(f)
+        frame_kb = processor.pixels.nbytes / 1024
+        resettable = reset_peak_rss()
+        before = current_rss_kb()
+        result = {"op": op}
+        try:
+            getattr(processor, op)(*OPERATION_ARGS[op])
+        except Exception as e:
+            result["error"] = str(e)
+        peak = peak_rss_kb()
+        result.update({
+            "frame_mb": frame_kb / 1024,
+            "op_peak_mb": (peak - before) / 1024,
+            "peak_mb": peak / 1024,
+            "peak_reset": resettable,
+        })
+        self.stdout.write(json.dumps(result))
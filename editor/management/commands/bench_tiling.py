@@ -0,0 +1,85 @@
+import io
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from editor.benchmarking import OPERATION_ARGS, synthetic_upload
+from editor.utils import tiling
+
+# Operations that run through editor.utils.tiling.
+TILED_OPS = ["blur", "sharpen", "emboss", "edge_detection", "sepia", "vignette", "noise", "color_pop"]
+
+
+class Command(BaseCommand):
+    help = "Measure throughput of the strip-tiled filters for a range of worker counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--megapixels", type=float, default=24.0)
+        parser.add_argument("--ops", nargs="*", default=None,
+                            help="Operations to measure (default: all tiled operations)")
+        parser.add_argument("--workers", type=int, nargs="*", default=None,
+                            help="Worker counts to try (default: 1, 2, 4, ... up to the CPU count)")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="Runs per measurement; the fastest is kept")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON instead of a table")
+
+    def handle(self, *args, **options):
+        from editor.utils.image_processing import ImageProcessor
+
+        ops = options["ops"] or TILED_OPS
+        unknown = set(ops) - set(TILED_OPS)
+        if unknown:
+            raise CommandError(f"Not tiled: {', '.join(sorted(unknown))}")
+        counts = options["workers"] or self.default_counts()
+
+        data = synthetic_upload(options["megapixels"])
+        height, width = ImageProcessor(io.BytesIO(data)).pixels.shape[:2]
+        megapixels = width * height / 1e6
+
+        results = []
+        try:
+            for op in ops:
+                single = None
+                for count in counts:
+                    tiling.configure(count)
+                    best = min(self.time_op(data, op) for _ in range(options["repeat"]))
+                    single = single or best
+                    results.append({
+                        "op": op,
+                        "workers": count,
+                        "seconds": best,
+                        "mp_per_s": megapixels / best,
+                        "speedup": single / best,
+                    })
+        finally:
+            tiling.configure(None)
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"megapixels": megapixels, "cpus": os.cpu_count(),
+                                          "results": results}, indent=2))
+            return
+        self.stdout.write(f"{width}x{height} ({megapixels:.1f} MP), {os.cpu_count()} CPUs")
+        self.stdout.write(f"{'operation':<18}{'workers':>8}{'ms':>10}{'MP/s':>10}{'speedup':>9}")
+        for row in results:
+            self.stdout.write(f"{row['op']:<18}{row['workers']:>8}{row['seconds'] * 1000:>10.1f}"
+                              f"{row['mp_per_s']:>10.1f}{row['speedup']:>8.2f}x")
+
+    def default_counts(self):
+        cpus = os.cpu_count() or 1
+        counts = [1]
+        while counts[-1] * 2 < cpus:
+            counts.append(counts[-1] * 2)
+        if cpus > 1:
+            counts.append(cpus)
+        return counts
+
+    def time_op(self, data, op):
+        from editor.utils.image_processing import ImageProcessor
+
+        processor = ImageProcessor(io.BytesIO(data))
+        start = time.perf_counter()
+        getattr(processor, op)(*OPERATION_ARGS[op])
+        return time.perf_counter() - start
@@ -0,0 +1,334 @@
+import inspect
+import io
+import json
+import logging
+import math
+import os
+import platform
+import time
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+
+from editor.benchmarking import OPERATION_ARGS, pin_mmap_threshold, synthetic_image, synthetic_upload
+from editor.utils import tiling
+from editor.utils.memory import current_rss_kb, peak_rss_kb, reset_peak_rss
+
+# (kind, megapixels) measured by default; see benchmarking.synthetic_image.
+DEFAULT_CASES = [("photo", 1), ("photo", 12), ("photo", 48), ("gray", 1), ("rgba", 1)]
+
+# Arguments for operations that take files or need more than OPERATION_ARGS,
+# built from the frame and its encoded upload for every run.
+INPUT_ARGS = {
+    "point_ops": lambda frame, upload: ([("adjust_brightness", {"factor": 1.2}), ("adjust_contrast", {"factor": 1.1}),
+                                         ("adjust_saturation", {"factor": 1.2})],),
+    "preview": lambda frame, upload: (),
+    "save_preview": lambda frame, upload: (),
+    "save_image": lambda frame, upload: ("jpeg",),
+    "convert_format": lambda frame, upload: ("png",),
+    "compress_image": lambda frame, upload: (max(len(upload) // 2048, 10),),
+    "get_compressed_size": lambda frame, upload: (),
+    "extract_text": lambda frame, upload: (),
+    "add_layer": lambda frame, upload: (io.BytesIO(upload),),
+    "merge_layers": lambda frame, upload: (0.5,),
+    "collage": lambda frame, upload: ([io.BytesIO(upload) for _ in range(4)], "2x2"),
+    "stitch_images": lambda frame, upload: (panorama_pair(frame),),
+    "batch_process": lambda frame, upload: ([io.BytesIO(upload) for _ in range(4)], "sharpen", []),
+}
+
+# Set-up done before the timed call, outside the measurement.
+PREPARE = {
+    "merge_layers": lambda processor, upload: processor.add_layer(io.BytesIO(upload)),
+}
+
+# (name, path, form data) sent through the full Django request path.
+REQUESTS = [
+    ("adjust/brightness", "/adjust/brightness", {"factor": "1.2"}),
+    ("filter/blur", "/filter/blur", {"radius": "3"}),
+    ("filter/sepia", "/filter/sepia", {}),
+    ("transform/apply-resize", "/transform/apply-resize", {"width": "800", "height": "600"}),
+    ("premium/denoise", "/premium/denoise", {"tier": "fast"}),
+    ("palette/extract-palette", "/palette/extract-palette", {"num_colors": "5"}),
+    ("format/convert-format", "/format/convert-format", {"format": "webp"}),
+    ("pipeline", "/pipeline", {"operations": json.dumps([
+        {"op": "adjust_brightness", "params": {"factor": 1.1}},
+        {"op": "adjust_contrast", "params": {"factor": 1.2}},
+        {"op": "sharpen"},
+    ])}),
+]
+
+
+def panorama_pair(frame):
+    """Two overlapping JPEG crops of ``frame`` with enough corners for the stitcher to match."""
+    frame = cv2.cvtColor(frame[..., :3], cv2.COLOR_RGB2BGR)
+    height, width = frame.shape[:2]
+    rng = np.random.default_rng(0)
+    for _ in range(300 * max(1, width * height // 1_000_000)):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(5, 40))
+        cv2.rectangle(frame, (x, y), (x + size, y + size), [int(c) for c in rng.integers(0, 256, 3)], -1)
+    return [io.BytesIO(cv2.imencode(".jpg", crop)[1].tobytes())
+            for crop in (frame[:, :width * 3 // 5], frame[:, width * 2 // 5:])]
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of ``samples``."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def parse_case(value):
+    kind, _, megapixels = value.partition("@")
+    try:
+        return kind, float(megapixels)
+    except ValueError:
+        raise CommandError(f"Cases look like photo@12, not {value!r}")
+
+
+class Command(BaseCommand):
+    help = ("Time every ImageProcessor operation and the main request paths on synthetic images; "
+            "report throughput, p50/p95 latency and peak memory, and compare against a baseline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--case", action="append", default=None, metavar="KIND@MP",
+                            help="Synthetic input to measure, e.g. photo@12 (repeatable; "
+                                 "default: photo@1, photo@12, photo@48, gray@1, rgba@1)")
+        parser.add_argument("--ops", nargs="*", default=None,
+                            help="Operations to time (default: every public ImageProcessor method)")
+        parser.add_argument("--requests", nargs="*", default=None,
+                            help="Request paths to time (default: all; pass none to skip)")
+        parser.add_argument("--repeat", type=int, default=5,
+                            help="Runs per measurement")
+        parser.add_argument("--max-seconds", type=float, default=30.0,
+                            help="Stop repeating a measurement after this long, and skip it on a larger "
+                                 "input when the smaller one predicts it would take longer")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Strip workers for tiled filters (default: TILE_WORKERS)")
+        parser.add_argument("--output", help="Write results as JSON to this file")
+        parser.add_argument("--baseline", help="Compare p50 latency against a previous --output file")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="Relative p50 slowdown reported as a regression")
+        parser.add_argument("--min-delta-ms", type=float, default=5.0,
+                            help="Ignore p50 differences smaller than this")
+        parser.add_argument("--json", action="store_true",
+                            help="Print results as JSON instead of a table")
+
+    def handle(self, *args, **options):
+        from editor.utils.image_processing import ImageProcessor
+
+        cases = [parse_case(case) for case in options["case"]] if options["case"] else DEFAULT_CASES
+        public = [name for name, member in vars(ImageProcessor).items()
+                  if inspect.isfunction(member) and not name.startswith("_")]
+        ops = options["ops"] if options["ops"] is not None else public
+        unknown = set(ops) - set(public)
+        if unknown:
+            raise CommandError(f"Unknown operations: {', '.join(sorted(unknown))}")
+        requests = [r for r in REQUESTS if options["requests"] is None or r[0] in options["requests"]]
+        baseline = self.load(options["baseline"]) if options["baseline"] else None
+
+        # Return large buffers to the kernel on free, so each run's peak shows.
+        self.pinned = pin_mmap_threshold()
+        self.repeat = max(1, options["repeat"])
+        self.max_seconds = options["max_seconds"]
+        self.timings = {}
+        results = []
+        tiling.configure(options["workers"])
+        logging.disable(logging.CRITICAL)
+        try:
+            for kind, megapixels in sorted(cases, key=lambda case: case[1]):
+                upload = synthetic_upload(megapixels, kind, format="PNG" if kind == "rgba" else "JPEG")
+                frame = synthetic_image(megapixels, kind)
+                if frame.ndim == 2:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+                self.stderr.write(f"{kind}@{megapixels:g}: {frame.shape[1]}x{frame.shape[0]}")
+                for op in ops:
+                    results.append(self.time_operation(ImageProcessor, op, kind, frame, upload))
+                for name, path, data in requests:
+                    results.append(self.time_request(name, path, data, kind, frame, upload))
+        finally:
+            logging.disable(logging.NOTSET)
+            tiling.configure(None)
+
+        report = {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "environment": self.environment(),
+            "options": {"repeat": self.repeat, "max_seconds": self.max_seconds},
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+        comparison = None
+        if baseline is not None:
+            comparison = self.compare(results, baseline, options["threshold"], options["min_delta_ms"] / 1000)
+            report["comparison"] = comparison
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_table(report)
+        if comparison and comparison["regressions"]:
+            raise CommandError(f"{len(comparison['regressions'])} measurement(s) slower than the baseline")
+
+    def load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            raise CommandError(f"Cannot read baseline {path}: {e}")
+
+    def environment(self):
+        return {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "tile_workers": tiling.workers(),
+            "cv2_threads": cv2.getNumThreads(),
+            "mmap_threshold_pinned": self.pinned,
+        }
+
+    def should_skip(self, key, megapixels):
+        """True if a smaller run of ``key`` predicts more than ``max_seconds`` at this size."""
+        smaller = self.timings.get(key)
+        return smaller is not None and smaller[0] * megapixels / smaller[1] > self.max_seconds
+
+    def measure(self, key, megapixels, run):
+        """Call ``run()`` (which returns its own elapsed seconds and output size) up to ``repeat`` times."""
+        samples, peak, output_bytes = [], 0, None
+        started = time.perf_counter()
+        for _ in range(self.repeat):
+            reset_peak_rss()
+            before = current_rss_kb()
+            seconds, output_bytes = run()
+            peak = max(peak, peak_rss_kb() - before)
+            samples.append(seconds)
+            if time.perf_counter() - started > self.max_seconds:
+                break
+        p50 = percentile(samples, 0.5)
+        self.timings[key] = (p50, megapixels)
+        return {
+            "runs": len(samples),
+            "p50": p50,
+            "p95": percentile(samples, 0.95),
+            "mean": sum(samples) / len(samples),
+            "mp_per_s": megapixels / p50 if p50 else None,
+            "peak_mb": peak / 1024,
+            "output_bytes": output_bytes,
+        }
+
+    def time_operation(self, ImageProcessor, op, kind, frame, upload):
+        megapixels = frame.shape[0] * frame.shape[1] / 1e6
+        result = {"target": "operation", "name": op, "kind": kind, "megapixels": round(megapixels, 2)}
+        if op in INPUT_ARGS:
+            make_args = INPUT_ARGS[op]
+        elif op in OPERATION_ARGS:
+            make_args = lambda frame, upload: OPERATION_ARGS[op]
+        else:
+            result["error"] = "no benchmark arguments defined"
+            return result
+        if self.should_skip(("operation", op, kind), megapixels):
+            result["skipped"] = f"predicted over {self.max_seconds:g} s"
+            return result
+
+        def run():
+            processor = ImageProcessor.from_array(frame.copy())
+            if op in PREPARE:
+                PREPARE[op](processor, upload)
+            args = make_args(frame, upload)
+            start = time.perf_counter()
+            output = getattr(processor, op)(*args)
+            seconds = time.perf_counter() - start
+            if isinstance(output, tuple):
+                output = output[0]
+            size = len(output) if isinstance(output, (bytes, str)) else processor.pixels.nbytes
+            return seconds, size
+
+        try:
+            result.update(self.measure(("operation", op, kind), megapixels, run))
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+        return result
+
+    def time_request(self, name, path, data, kind, frame, upload):
+        megapixels = frame.shape[0] * frame.shape[1] / 1e6
+        result = {"target": "request", "name": name, "kind": kind, "megapixels": round(megapixels, 2)}
+        if self.should_skip(("request", name, kind), megapixels):
+            result["skipped"] = f"predicted over {self.max_seconds:g} s"
+            return result
+        client = Client()
+
+        def run():
+            start = time.perf_counter()
+            response = client.post(path, {"image": io.BytesIO(upload), **data}, secure=True)
+            body = b"".join(response) if response.streaming else response.content
+            seconds = time.perf_counter() - start
+            if response.status_code != 200:
+                raise ValueError(f"HTTP {response.status_code}: {body[:200].decode(errors='replace')}")
+            return seconds, len(body)
+
+        with override_settings(RESULT_CACHE_ENABLED=False, ALLOWED_HOSTS=["testserver"]):
+            try:
+                result.update(self.measure(("request", name, kind), megapixels, run))
+            except Exception as e:
+                result["error"] = str(e) or type(e).__name__
+        return result
+
+    def compare(self, results, baseline, threshold, min_delta):
+        def key(row):
+            return row["target"], row["name"], row["kind"], row["megapixels"]
+
+        before = {key(row): row for row in baseline.get("results", []) if "p50" in row}
+        comparison = {"regressions": [], "improvements": [], "new": []}
+        for row in results:
+            old = before.get(key(row))
+            if "p50" not in row:
+                continue
+            if old is None:
+                comparison["new"].append(row["name"])
+                continue
+            change = {"target": row["target"], "name": row["name"], "kind": row["kind"],
+                      "megapixels": row["megapixels"], "baseline_p50": old["p50"], "p50": row["p50"],
+                      "ratio": row["p50"] / old["p50"] if old["p50"] else None}
+            if abs(row["p50"] - old["p50"]) < min_delta or change["ratio"] is None:
+                continue
+            if change["ratio"] > 1 + threshold:
+                comparison["regressions"].append(change)
+            elif change["ratio"] < 1 / (1 + threshold):
+                comparison["improvements"].append(change)
+        environment = baseline.get("environment", {})
+        comparison["environment_changes"] = {
+            name: [environment.get(name), value] for name, value in self.environment().items()
+            if environment.get(name) != value}
+        return comparison
+
+    def print_table(self, report):
+        environment = report["environment"]
+        self.stdout.write(f"Python {environment['python']}, NumPy {environment['numpy']}, OpenCV {environment['opencv']}, "
+                          f"{environment['cpus']} CPUs, {environment['tile_workers']} tile workers")
+        self.stdout.write(f"{'target':<10}{'name':<26}{'input':>11}{'runs':>5}{'p50 ms':>10}{'p95 ms':>10}"
+                          f"{'MP/s':>8}{'peak MB':>9}")
+        for row in report["results"]:
+            label = f"{row['target']:<10}{row['name']:<26}{row['kind'] + '@' + format(row['megapixels'], 'g'):>11}"
+            if "p50" not in row:
+                self.stdout.write(f"{label}  {row.get('skipped') or 'error: ' + row['error']}")
+                continue
+            self.stdout.write(f"{label}{row['runs']:>5}{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}"
+                              f"{row['mp_per_s'] or 0:>8.1f}{row['peak_mb']:>9.1f}")
+        comparison = report.get("comparison")
+        if not comparison:
+            return
+        for title, rows in (("Regressions", comparison["regressions"]), ("Improvements", comparison["improvements"])):
+            self.stdout.write(f"{title}: {len(rows)}")
+            for row in rows:
+                self.stdout.write(f"  {row['target']} {row['name']} {row['kind']}@{row['megapixels']:g}: "
+                                  f"{row['baseline_p50'] * 1000:.1f} -> {row['p50'] * 1000:.1f} ms "
+                                  f"({row['ratio']:.2f}x)")
+        if comparison["environment_changes"]:
+            self.stdout.write("Environment differs from the baseline: " + ", ".join(
+                f"{name} {old} -> {new}" for name, (old, new) in comparison["environment_changes"].items()))
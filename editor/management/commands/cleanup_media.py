@@ -0,0 +1,38 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from editor.utils import frames
+from editor.utils.media_store import media_store
+
+
+class Command(BaseCommand):
+    help = ("Release stored images of expired sessions, delete unreferenced uploads and remove "
+            "shared-memory frames left by crashed processes. "
+            "Run periodically, e.g. from cron: */15 * * * * python manage.py cleanup_media")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--legacy-age", type=int, default=settings.SESSION_COOKIE_AGE,
+                            help="Also delete pre-dedup uploads in MEDIA_ROOT older than this many "
+                                 "seconds (default: SESSION_COOKIE_AGE); -1 keeps them")
+        parser.add_argument("--json", action="store_true",
+                            help="Print counters as JSON")
+
+    def handle(self, *args, **options):
+        before = media_store.usage(refresh=True)
+        legacy_age = options["legacy_age"] if options["legacy_age"] >= 0 else None
+        stats = media_store.cleanup(legacy_age=legacy_age)
+        stats.update(bytes_before=before, bytes_after=media_store.usage(), max_bytes=media_store.max_bytes,
+                     segments=frames.sweep())
+        if options["json"]:
+            self.stdout.write(json.dumps(stats, indent=2))
+            return
+        self.stdout.write(
+            f"Checked {stats['sessions']} sessions: released {stats['released']} references, "
+            f"deleted {stats['objects']} unreferenced and {stats['legacy']} legacy uploads "
+            f"and {stats['spills']} orphaned working images, "
+            f"removed {stats['segments']} stale shared-memory frames, "
+            f"freed {stats['bytes_freed'] / 1e6:.1f} MB "
+            f"({stats['bytes_before'] / 1e6:.1f} -> {stats['bytes_after'] / 1e6:.1f} MB "
+            f"of {stats['max_bytes'] / 1e6:.0f} MB)")
@@ -0,0 +1,49 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .utils import metrics
+
+
+class MetricsMiddleware:
+    """Time each request for ``/metrics`` and report its stages in ``Server-Timing``.
+
+    Works in both sync and async chains, so it doesn't force async views
+    back onto a thread under ASGI.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        token = metrics.start_request()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            timings = metrics.end_request(token)
+        return self._finish(request, response, timings, start)
+
+    async def _acall(self, request):
+        token = metrics.start_request()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timings = metrics.end_request(token)
+        return self._finish(request, response, timings, start)
+
+    def _finish(self, request, response, timings, start):
+        total = time.perf_counter() - start
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else "unmatched"
+        metrics.request_seconds.observe(total, view, request.method, str(response.status_code))
+        response["Server-Timing"] = metrics.server_timing(timings, total)
+        return response
@@ -1,3 +1,920 @@
-from django.test import TestCase
+import asyncio
+import gc
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from PIL import Image, ImageEnhance, ImageFont
+
+from .utils import (
+    batch, denoising, encoding, frames, image_processing, ingest, metrics, offload, pointops, quantize, resources, tiling,
+)
+from .utils.history import EditHistory
+from .utils.image_processing import ImageProcessor
+from .utils.ingest import ImageTooLarge
+from .utils.jobs import DONE, QUEUED, JobQueue, jobs
+from .utils.media_store import MediaStore
+from .utils.pipeline import run_pipeline
+from .utils.result_cache import result_cache
+from .utils.serving import serve_file
+from .utils.session_store import working_images
+
+
+def _frame(height=48, width=64, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def _png(pixels):
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+class TempDirMixin:
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+
+class CanonicalBufferTests(SimpleTestCase):
+    def test_views_follow_the_buffer(self):
+        pixels = _frame()
+        processor = ImageProcessor.from_array(pixels.copy())
+        np.testing.assert_array_equal(np.asarray(processor.image), pixels)
+        np.testing.assert_array_equal(processor.cv_image, pixels[..., ::-1])
+
+        revision = processor.revision
+        processor.grayscale()
+        self.assertGreater(processor.revision, revision)
+        np.testing.assert_array_equal(np.asarray(processor.image), processor.pixels)
+        np.testing.assert_array_equal(processor.cv_image, processor.pixels[..., ::-1])
+
+    def test_decoded_upload_is_rgb(self):
+        pixels = _frame()
+        processor = ImageProcessor(io.BytesIO(_png(pixels)))
+        self.assertEqual(processor.pixels.dtype, np.uint8)
+        np.testing.assert_array_equal(processor.pixels, pixels)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+class PipelineViewTests(SimpleTestCase):
+    steps = [
+        {"op": "crop", "params": {"left": 2, "top": 3, "right": 50, "bottom": 40}},
+        {"op": "adjust_brightness", "params": {"factor": 1.2}},
+        {"op": "adjust_contrast", "params": {"factor": 0.9}},
+        {"op": "blur", "params": {"radius": 1.5}},
+    ]
+
+    def _post(self, steps, **data):
+        image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+        return self.client.post("/pipeline", {"operations": json.dumps(steps), "image": image, **data})
+
+    def test_matches_calling_each_operation(self):
+        response = self._post(self.steps, format="png")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+
+        expected = ImageProcessor.from_array(_frame())
+        for step in self.steps:
+            getattr(expected, step["op"])(**step["params"])
+        np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(response.content))), expected.pixels)
+
+    def test_every_step_is_validated_before_running(self):
+        response = self._post(self.steps + [{"op": "blur", "params": {"sigma": 2}}])
+        self.assertEqual(response.status_code, 400)
+        response = self._post(self.steps + [{"op": "explode"}])
+        self.assertEqual(response.status_code, 400)
+
+    def test_requires_an_image(self):
+        response = self.client.post("/pipeline", {"operations": json.dumps(self.steps)})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False, PREVIEW_MAX_EDGE=32)
+class PreviewTests(SimpleTestCase):
+    def _post(self, path, **data):
+        image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+        return self.client.post(path, {"image": image, **data})
+
+    def test_preview_is_downscaled(self):
+        for path, data in [("/adjust/brightness", {"factor": "1.3"}), ("/filter/blur", {"radius": "2"})]:
+            response = self._post(path, preview="1", **data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "image/jpeg")
+            self.assertEqual(Image.open(io.BytesIO(response.content)).size, (32, 24))
+
+    def test_full_request_keeps_size(self):
+        response = self._post("/adjust/brightness", factor="1.3", format="png")
+        self.assertEqual(Image.open(io.BytesIO(response.content)).size, (64, 48))
+
+    def test_proxy_is_cached_and_leaves_frame_untouched(self):
+        pixels = _frame()
+        processor = ImageProcessor.from_array(pixels.copy())
+        proxy, scale = processor.preview(32)
+        self.assertEqual(proxy.pixels.shape, (24, 32, 3))
+        self.assertEqual(scale, 0.5)
+        self.assertIs(processor.preview(32)[0].pixels, proxy.pixels)
+        proxy.adjust_brightness(1.5)
+        np.testing.assert_array_equal(processor.pixels, pixels)
+        processor.sepia()
+        self.assertIsNot(processor.preview(32)[0].pixels, proxy.pixels)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False)
+class BatchTests(SimpleTestCase):
+    def test_streams_a_zip_with_one_member_per_image(self):
+        images = [SimpleUploadedFile(f"img{i}.png", _png(_frame(seed=i))) for i in range(3)]
+        images.append(SimpleUploadedFile("broken.png", b"not an image"))
+        response = self.client.post("/batch", {
+            "image": images, "format": "png",
+            "operations": json.dumps([{"op": "grayscale"}]),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/zip")
+
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()),
+                         ["000_img0.png", "001_img1.png", "002_img2.png", "003_broken.error.txt"])
+        for i in range(3):
+            result = np.asarray(Image.open(io.BytesIO(archive.read(f"00{i}_img{i}.png"))))
+            self.assertEqual(result.shape, (48, 64, 3))
+            np.testing.assert_array_equal(result[..., 0], result[..., 1])
+
+    def test_in_flight_limit_is_shared_by_concurrent_batches(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def process_one(data, steps, format):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return format, data
+
+        def run():
+            images = [io.BytesIO(b"x") for _ in range(6)]
+            list(batch.iter_batch(images, []))
+
+        executor = ThreadPoolExecutor(max_workers=8)
+        self.addCleanup(executor.shutdown)
+        with mock.patch.object(batch, "_executor", executor), \
+                mock.patch.object(batch, "_slots", threading.BoundedSemaphore(2)), \
+                mock.patch.object(batch, "process_one", process_one):
+            threads = [threading.Thread(target=run) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertLessEqual(running[1], 2)
+
+
+class JobQueueTests(TempDirMixin, SimpleTestCase):
+    def _wait(self, queue, job_id, status, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            record = queue.get(job_id)
+            if record["status"] == status:
+                return record
+            time.sleep(0.01)
+        self.fail(f"job {job_id} never reached {status}: {queue.get(job_id)}")
+
+    def test_status_goes_from_queued_to_done(self):
+        queue = JobQueue(self.tmp, workers=1, queue_size=2, ttl_seconds=3600)
+        release = threading.Event()
+        blocker = queue.submit(lambda job: (release.wait(10), (b"", "text/plain"))[1], "block")
+        record = queue.submit(lambda job: (b"result", "image/png", {"extra": 1}), "work")
+
+        self.assertEqual(record["status"], QUEUED)
+        self.assertEqual(queue.get(record["id"])["status"], QUEUED)
+        release.set()
+        done = self._wait(queue, record["id"], DONE)
+        self.assertEqual(done["progress"], 1.0)
+        self.assertEqual(done["content_type"], "image/png")
+        self.assertEqual(done["extra"], 1)
+        with open(queue.result_path(record["id"]), "rb") as f:
+            self.assertEqual(f.read(), b"result")
+        self._wait(queue, blocker["id"], DONE)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+class AsyncJobViewTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(jobs, "root", self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_job_result_matches_synchronous_tool(self):
+        pixels = _frame()
+        image = SimpleUploadedFile("in.png", _png(pixels), content_type="image/png")
+        response = self.client.post("/filter/hdr", {"async": "1", "format": "png", "image": image})
+        self.assertEqual(response.status_code, 202)
+        urls = response.json()
+
+        deadline = time.monotonic() + 30
+        while (status := self.client.get(urls["status_url"]).json())["status"] != DONE:
+            self.assertNotEqual(status["status"], "failed", status["error"])
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        result = self.client.get(urls["result_url"])
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result["Content-Type"], "image/png")
+
+        expected = ImageProcessor.from_array(pixels.copy())
+        expected.hdr()
+        body = b"".join(result.streaming_content)
+        np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(body))), expected.pixels)
+
+    def test_unreadable_stitch_upload_is_rejected(self):
+        images = [SimpleUploadedFile("a.png", _png(_frame())), SimpleUploadedFile("b.png", b"not an image")]
+        response = self.client.post("/collage/stitch", {"async": "1", "image": images})
+        self.assertEqual(response.status_code, 400)
+
+
+class CompressTests(SimpleTestCase):
+    def setUp(self):
+        # A smooth gradient with texture, so sizes vary over the quality range.
+        y, x = np.mgrid[0:384, 0:512]
+        base = np.dstack([x / 2, y / 1.5, (x + y) / 3.5]).astype(np.uint8)
+        self.pixels = cv2.add(base, _frame(384, 512) // 8)
+
+    def _sizes(self, format):
+        processor = ImageProcessor.from_array(self.pixels)
+        return {q: processor._encode_full(format, q, 0, False, False, keep=False)[0] for q in (10, 30, 50, 80)}
+
+    def _counting(self):
+        return mock.patch.object(ImageProcessor, "_encode_full", autospec=True,
+                                 side_effect=ImageProcessor._encode_full)
+
+    def _compress(self, processor, target_bytes, format):
+        with self._counting() as counted:
+            data = processor.compress_image(target_bytes / 1024, format, quality=80)
+        return data, counted.call_count
+
+    def test_fits_target_within_probe_budget(self):
+        for format in ("JPEG", "WEBP"):
+            sizes = self._sizes(format)
+            for target in (sizes[30] * 0.9, (sizes[30] + sizes[50]) / 2, sizes[80] * 0.97, sizes[80] * 2):
+                data, encodes = self._compress(ImageProcessor.from_array(self.pixels), target, format)
+                self.assertLessEqual(len(data), target, (format, target))
+                self.assertLessEqual(encodes, image_processing._MAX_SIZE_PROBES, (format, target))
+
+    def test_unreachable_target_returns_smallest_encode(self):
+        sizes = self._sizes("JPEG")
+        data, encodes = self._compress(ImageProcessor.from_array(self.pixels), sizes[10] / 2, "JPEG")
+        self.assertEqual(len(data), sizes[10])
+        self.assertLessEqual(encodes, image_processing._MAX_SIZE_PROBES)
+
+    def test_size_query_is_reused(self):
+        sizes = self._sizes("JPEG")
+        processor = ImageProcessor.from_array(self.pixels)
+        processor.get_compressed_size("JPEG", quality=80)
+        with self._counting() as counted:
+            processor.compress_image((sizes[30] + sizes[50]) / 2 / 1024, "JPEG", quality=80)
+        self.assertNotIn(80, [call.args[2] for call in counted.call_args_list])
+
+
+class ResourceTests(SimpleTestCase):
+    def test_cascades_load_once(self):
+        with mock.patch.object(resources, "_cascades", {}), \
+                mock.patch.object(resources, "_Cascade", wraps=resources._Cascade) as loaded:
+            for _ in range(2):
+                ImageProcessor.from_array(_frame()).face_detection("blur")
+                resources.detect(resources.EYE_CASCADE, _frame()[..., 0])
+        self.assertEqual(sorted(call.args[0] for call in loaded.call_args_list),
+                         sorted([resources.EYE_CASCADE, resources.FACE_CASCADE]))
+
+    def test_text_tools_use_cached_fonts(self):
+        with mock.patch.object(image_processing, "get_font", wraps=resources.get_font) as get_font:
+            processor = ImageProcessor.from_array(_frame())
+            processor.add_text("hi", 2, 2, 20, "#ffffff")
+            processor.meme_generator("top", "bottom", 24)
+        self.assertEqual([call.args[0] for call in get_font.call_args_list], [20, 24])
+        self.assertIs(resources.get_font(20), resources.get_font(20))
+
+    @override_settings(TEXT_FONT_PATHS=["/nonexistent/font.ttf"])
+    def test_missing_fonts_fall_back_to_a_scalable_font(self):
+        resources.get_font.cache_clear()
+        self.addCleanup(resources.get_font.cache_clear)
+        font = resources.get_font(40)
+        self.assertIsInstance(font, ImageFont.FreeTypeFont)
+        self.assertEqual(font.size, 40)
+
+
+class IngestTests(SimpleTestCase):
+    def _jpeg(self, width, height):
+        output = io.BytesIO()
+        Image.fromarray(_frame(height, width)).save(output, format="JPEG")
+        return output.getvalue()
+
+    @override_settings(MAX_IMAGE_MEGAPIXELS=0.001)
+    def test_oversized_image_is_rejected_from_its_header(self):
+        data = _png(_frame())
+        with mock.patch.object(ingest, "_decode") as decode:
+            with self.assertRaises(ImageTooLarge):
+                ingest.probe(io.BytesIO(data))
+        decode.assert_not_called()
+        with self.assertRaises(ImageTooLarge):
+            ImageProcessor(io.BytesIO(data))
+
+    @override_settings(MAX_IMAGE_MEGAPIXELS=0.001, SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+    def test_oversized_upload_gets_413(self):
+        image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+        response = self.client.post("/filter/sepia", {"image": image})
+        self.assertEqual(response.status_code, 413)
+
+    def test_jpeg_draft_decode(self):
+        data = self._jpeg(800, 600)
+        processor = ImageProcessor(io.BytesIO(data), draft_size=200)
+        self.assertEqual(processor.pixels.shape, (150, 200, 3))
+        self.assertEqual(processor.decode_scale, 0.25)
+        self.assertEqual(ImageProcessor(io.BytesIO(data), draft_size=(300, 300)).pixels.shape, (300, 400, 3))
+        self.assertEqual(ImageProcessor(io.BytesIO(data)).pixels.shape, (600, 800, 3))
+
+    def test_spooled_upload_is_decoded_from_disk(self):
+        pixels = _frame()
+        upload = TemporaryUploadedFile("in.png", "image/png", 0, None)
+        self.addCleanup(upload.close)
+        upload.write(_png(pixels))
+        upload.seek(0)
+        with mock.patch.object(ingest.cv2, "imdecode", side_effect=AssertionError("read into memory")):
+            np.testing.assert_array_equal(ImageProcessor(upload).pixels, pixels)
+
+
+@override_settings(RESULT_CACHE_ENABLED=True, SECURE_SSL_REDIRECT=False)
+class ResultCacheTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in [("root", self.tmp), ("_entries", None), ("_total", None)]:
+            patcher = mock.patch.object(result_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.upload = _png(_frame())
+
+    def _post(self, **headers):
+        image = SimpleUploadedFile("in.png", self.upload, content_type="image/png")
+        return self.client.post("/adjust/brightness", {"factor": "1.2", "image": image},
+                                HTTP_ACCEPT="image/png", **headers)
+
+    def test_miss_then_hit_then_not_modified(self):
+        first = self._post()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first["X-Cache"], "MISS")
+
+        second = self._post()
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second["X-Cache"], "HIT")
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["Content-Type"], first["Content-Type"])
+        self.assertEqual(second["ETag"], first["ETag"])
+
+        third = self._post(HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(third.status_code, 304)
+        self.assertEqual(third["ETag"], first["ETag"])
+
+    def test_hit_keeps_stored_headers(self):
+        def post():
+            image = SimpleUploadedFile("in.png", self.upload, content_type="image/png")
+            return self.client.post("/premium/denoise", {"tier": "fast", "image": image}, HTTP_ACCEPT="image/png")
+
+        first = post()
+        self.assertEqual(first["X-Cache"], "MISS")
+        second = post()
+        self.assertEqual(second["X-Cache"], "HIT")
+        self.assertEqual(second["X-Denoise-Tier"], first["X-Denoise-Tier"])
+
+    def test_parameters_are_part_of_the_key(self):
+        first = self._post()
+        image = SimpleUploadedFile("in.png", self.upload, content_type="image/png")
+        other = self.client.post("/adjust/brightness", {"factor": "1.4", "image": image},
+                                 HTTP_ACCEPT="image/png")
+        self.assertEqual(other["X-Cache"], "MISS")
+        self.assertNotEqual(other["ETag"], first["ETag"])
+
+    def test_overwrite_keeps_byte_count(self):
+        result_cache.put("a" * 40, b"x" * 100, "image/png")
+        result_cache.put("a" * 40, b"y" * 50, "image/png")
+        stats = result_cache.stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["bytes"], os.path.getsize(result_cache._path("a" * 40)))
+
+
+class TilingTests(SimpleTestCase):
+    def setUp(self):
+        tiling.configure(4)
+        self.addCleanup(tiling.configure, None)
+
+    def test_strips_match_whole_frame_filter(self):
+        pixels = _frame(1200, 1000)
+        self.assertGreater(len(tiling.spans(*pixels.shape[:2])), 1)
+        blur = lambda strip: cv2.GaussianBlur(strip, (0, 0), sigmaX=2.0)
+        np.testing.assert_array_equal(tiling.apply(blur, pixels, halo=7), blur(pixels))
+
+    def test_output_may_change_channels(self):
+        pixels = _frame(1200, 1000)
+        gray = lambda strip: cv2.cvtColor(strip, cv2.COLOR_RGB2GRAY)
+        np.testing.assert_array_equal(tiling.apply(gray, pixels), gray(pixels))
+
+    def test_edge_detection_matches_whole_frame_canny(self):
+        # A vertical edge, strong only near the top: hysteresis keeps the weak
+        # part because it connects to the strong part hundreds of rows away.
+        pixels = np.full((1200, 1000, 3), 100, np.uint8)
+        pixels[:, 500:] = 135
+        pixels[:100, 500:] = 180
+        processor = ImageProcessor.from_array(pixels)
+        processor.edge_detection()
+        edges = cv2.Canny(cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY), 100, 200)
+        np.testing.assert_array_equal(processor.pixels, cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB))
+
+
+class PointOpsTests(SimpleTestCase):
+    def test_fused_steps_match_image_enhance(self):
+        pixels = _frame()
+        steps = [("adjust_brightness", {"factor": 1.3}), ("adjust_contrast", {"factor": 0.7}),
+                 ("adjust_saturation", {"factor": 1.6}), ("adjust_brightness", {"factor": 0.8})]
+        enhancers = {"adjust_brightness": ImageEnhance.Brightness, "adjust_contrast": ImageEnhance.Contrast,
+                     "adjust_saturation": ImageEnhance.Color}
+
+        image = Image.fromarray(pixels)
+        for op, kwargs in steps:
+            image = enhancers[op](image).enhance(kwargs["factor"])
+        expected = np.asarray(image).astype(int)
+
+        fused = pointops.apply(pixels, pointops.compile_steps(steps))
+        self.assertLessEqual(np.abs(fused.astype(int) - expected).max(), 1)
+
+    def test_input_is_not_modified(self):
+        pixels = _frame()
+        before = pixels.copy()
+        pointops.apply(pixels, [pointops.brightness(1.5), pointops.sepia()])
+        np.testing.assert_array_equal(pixels, before)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+class FormatNegotiationTests(SimpleTestCase):
+    def _negotiate(self, accept="", alpha=False, **data):
+        request = RequestFactory().post("/", data, HTTP_ACCEPT=accept)
+        return encoding.negotiate(request, alpha=alpha)
+
+    def test_accept_header_picks_the_format(self):
+        self.assertEqual(self._negotiate("image/webp,image/*;q=0.8"), "webp")
+        self.assertEqual(self._negotiate("image/png;q=0.5,image/webp;q=0.9"), "webp")
+        self.assertEqual(self._negotiate("image/webp;q=0,image/png"), "png")
+        self.assertEqual(self._negotiate("text/html,*/*;q=0.8"), "jpeg")
+        self.assertEqual(self._negotiate(""), "jpeg")
+
+    def test_alpha_never_gets_jpeg(self):
+        self.assertEqual(self._negotiate("image/jpeg", alpha=True), "png")
+        self.assertEqual(self._negotiate("", alpha=True, format="jpg"), "png")
+
+    def test_format_field_beats_accept(self):
+        self.assertEqual(self._negotiate("image/webp", format="JPG"), "jpeg")
+        self.assertIsNone(self._negotiate("image/webp", format="tiff"))
+
+    def test_response_uses_the_accepted_format(self):
+        image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+        response = self.client.post("/adjust/brightness", {"image": image, "factor": "1.2"}, HTTP_ACCEPT="image/webp")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("Accept", response["Vary"])
+        self.assertEqual(Image.open(io.BytesIO(response.content)).format, "WEBP")
+
+
+class ServingTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.body = bytes(range(256)) * 4
+        self.path = os.path.join(self.tmp, "image.png")
+        with open(self.path, "wb") as f:
+            f.write(self.body)
+        self.factory = RequestFactory()
+
+    def _get(self, **headers):
+        return serve_file(self.factory.get("/studio/get-image", **headers), self.path, "image/png")
+
+    def _content(self, response):
+        return b"".join(response.streaming_content) if response.streaming else response.content
+
+    def test_full_response(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(self._content(response), self.body)
+
+    def test_range(self):
+        response = self._get(HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.body)}")
+        self.assertEqual(response["Content-Length"], "10")
+        self.assertEqual(self._content(response), self.body[10:20])
+
+    def test_open_and_suffix_ranges(self):
+        response = self._get(HTTP_RANGE="bytes=1000-")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self._content(response), self.body[1000:])
+        response = self._get(HTTP_RANGE="bytes=-5")
+        self.assertEqual(response["Content-Range"], f"bytes {len(self.body) - 5}-{len(self.body) - 1}/{len(self.body)}")
+        self.assertEqual(self._content(response), self.body[-5:])
+
+    def test_unsatisfiable_range(self):
+        response = self._get(HTTP_RANGE=f"bytes={len(self.body)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.body)}")
+
+    def test_stale_if_range_serves_whole_file(self):
+        response = self._get(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._content(response), self.body)
+
+    def test_not_modified(self):
+        etag = self._get()["ETag"]
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        last_modified = self._get()["Last-Modified"]
+        self.assertEqual(self._get(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_rewrite_changes_etag(self):
+        etag = self._get()["ETag"]
+        with open(self.path, "ab") as f:
+            f.write(b"more")
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class MediaStoreTests(TempDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = MediaStore(self.tmp, max_bytes=1 << 30)
+        for name in ("spill_dir", "history_dir"):
+            patcher = mock.patch.object(working_images, name, os.path.join(self.tmp, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Large-frame files configured outside the media root still count.
+        self.frames = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.frames, ignore_errors=True)
+        overrides = override_settings(RESULT_CACHE_DIR=os.path.join(self.tmp, "cache"), LARGE_FRAME_DIR=self.frames)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        self.session.create()
+
+    def _upload(self, data):
+        source = self.store.store(SimpleUploadedFile("in.png", data), self.session.session_key, "PNG")
+        self.session["studio_image"] = source
+        self.session.save()
+        return source
+
+    def _object(self, source):
+        return self.store._object_path(os.path.basename(source))
+
+    def test_identical_uploads_share_an_object(self):
+        data = _png(_frame())
+        source = self._upload(data)
+        other = self.store.store(SimpleUploadedFile("in.png", data), "x" * 32, "PNG")
+        self.assertEqual(os.path.basename(source), os.path.basename(other))
+        self.assertEqual(os.stat(self._object(source)).st_nlink, 3)
+        self.assertEqual(os.listdir(self.store.tmp), [])
+
+    def test_expired_session_releases_its_references(self):
+        source = self._upload(_png(_frame()))
+        obj = self._object(source)
+
+        stats = self.store.cleanup()
+        self.assertEqual(stats["released"], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, source)))
+        self.assertEqual(os.stat(obj).st_nlink, 2)
+
+        self.session.delete()
+        stats = self.store.cleanup()
+        self.assertEqual(stats["released"], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, source)))
+        self.assertFalse(os.path.exists(obj))
+        self.assertEqual(self.store.usage(refresh=True), 0)
+
+    def test_replaced_image_is_released(self):
+        first = self._upload(_png(_frame(seed=1)))
+        second = self._upload(_png(_frame(seed=2)))
+        self.store.cleanup()
+        self.assertFalse(os.path.exists(self._object(first)))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, second)))
+
+    def test_usage_counts_every_working_directory_once(self):
+        source = self._upload(_png(_frame()))
+        size = os.path.getsize(self._object(source))
+        self.assertEqual(self.store.usage(refresh=True), size)
+
+        outside = [os.path.join(self.tmp, "jobs", "result.png"), os.path.join(self.tmp, "cache", "ab", "entry"),
+                   os.path.join(self.frames, "frame-1")]
+        for path in outside:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"x" * 100)
+        self.assertEqual(self.store.usage(), size)
+        self.assertEqual(self.store.usage(refresh=True), size + 300)
+
+
+class RemoveBackgroundTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.pixels = rng.integers(20, 60, (240, 320, 3), dtype=np.uint8)
+        self.pixels[70:170, 100:220] = (220, 180, 40)
+
+    def _remove(self, analysis_edge):
+        processor = ImageProcessor.from_array(self.pixels.copy())
+        with mock.patch.object(image_processing, "_grabcut", wraps=image_processing._grabcut) as grabcut:
+            processor.remove_background(analysis_edge=analysis_edge)
+        return processor.pixels, grabcut.call_args.args[0].shape[:2]
+
+    def test_proxy_mask_matches_full_resolution(self):
+        full, full_shape = self._remove(0)
+        proxy, proxy_shape = self._remove(80)
+        self.assertEqual(full_shape, (240, 320))
+        self.assertEqual(proxy_shape, (60, 80))
+        self.assertEqual(proxy.shape, (240, 320, 4))
+        full_mask, proxy_mask = full[..., 3] > 127, proxy[..., 3] > 127
+        self.assertGreater((full_mask & proxy_mask).sum() / (full_mask | proxy_mask).sum(), 0.95)
+        self.assertTrue(proxy_mask[120, 160])
+        self.assertFalse(proxy_mask[5, 5])
+
+    def test_small_analysis_edge_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ImageProcessor.from_array(self.pixels).remove_background(analysis_edge=32)
+
+    @override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+    def test_view_passes_analysis_edge(self):
+        image = SimpleUploadedFile("in.png", _png(self.pixels), content_type="image/png")
+        with mock.patch.object(image_processing, "_grabcut", wraps=image_processing._grabcut) as grabcut:
+            response = self.client.post("/premium/remove-background", {"image": image, "analysis_edge": "80"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(grabcut.call_args.args[0].shape[:2], (60, 80))
+        self.assertEqual(response["Content-Type"], "image/png")
+        result = Image.open(io.BytesIO(response.content))
+        self.assertEqual((result.mode, result.size), ("RGBA", (320, 240)))
+
+
+class DenoiseTierTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(tiling, "workers", return_value=1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_best_tier_within_budget(self):
+        # One megapixel on one worker: fast 0.15 s, balanced 1.7 s, quality 3.8 s.
+        self.assertEqual(denoising.choose_tier(1000, 1000, budget=10), "quality")
+        self.assertEqual(denoising.choose_tier(1000, 1000, budget=2), "balanced")
+        self.assertEqual(denoising.choose_tier(1000, 1000, budget=0.5), "fast")
+        self.assertEqual(denoising.choose_tier(1000, 1000, budget=0.01), "fast")
+
+    @override_settings(DENOISE_BUDGET_SECONDS=2)
+    def test_budget_defaults_to_setting(self):
+        self.assertEqual(denoising.choose_tier(1000, 1000), "balanced")
+        self.assertEqual(denoising.resolve_tier("auto", 1000, 1000), "balanced")
+
+    def test_explicit_tier_is_validated(self):
+        self.assertEqual(denoising.resolve_tier("quality", 1000, 1000, budget=0.01), "quality")
+        with self.assertRaises(ValueError):
+            denoising.resolve_tier("best", 1000, 1000)
+
+    @override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+    def test_response_reports_the_tier(self):
+        for data, tier in [({"tier": "fast"}, "fast"), ({"budget": "100"}, "quality"), ({"budget": "0.000001"}, "fast")]:
+            image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+            response = self.client.post("/premium/denoise", {"image": image, "strength": "5", **data})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["X-Denoise-Tier"], tier)
+
+
+class PaletteTests(SimpleTestCase):
+    def setUp(self):
+        self.pixels = np.zeros((60, 100, 3), dtype=np.uint8)
+        self.pixels[:, :50] = (200, 30, 30)
+        self.pixels[:, 50:80] = (30, 200, 30)
+        self.pixels[:, 80:] = (30, 30, 200)
+
+    def _extract(self, pixels, num_colors=3, mode="fast"):
+        # A fresh cache each time, so every call does the full extraction.
+        with mock.patch.object(quantize, "_cache", OrderedDict()):
+            return quantize.extract_palette(pixels, num_colors, mode)
+
+    def test_dominant_colours_and_shares(self):
+        for mode in quantize.MODES:
+            palette = self._extract(self.pixels, mode=mode)
+            self.assertEqual([entry["hex"] for entry in palette], ["#c81e1e", "#1ec81e", "#1e1ec8"])
+            self.assertEqual([entry["weight"] for entry in palette], [0.5, 0.3, 0.2])
+
+    def test_same_image_gives_the_same_palette(self):
+        pixels = _frame(96, 128)
+        for mode in quantize.MODES:
+            first = json.dumps(self._extract(pixels, 6, mode))
+            self.assertEqual(json.dumps(self._extract(pixels, 6, mode)), first)
+            self.assertEqual(json.dumps(quantize.extract_palette(pixels, 6, mode)), first)
+
+    def test_transparent_pixels_do_not_count(self):
+        rgba = np.dstack((self.pixels, np.full(self.pixels.shape[:2], 255, dtype=np.uint8)))
+        rgba[:, :50, 3] = 0
+        palette = self._extract(rgba, 2)
+        self.assertEqual([entry["hex"] for entry in palette], ["#1ec81e", "#1e1ec8"])
+        self.assertEqual([entry["weight"] for entry in palette], [0.6, 0.4])
+
+    @override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+    def test_view_returns_identical_json(self):
+        bodies = []
+        for _ in range(2):
+            with mock.patch.object(quantize, "_cache", OrderedDict()):
+                image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+                response = self.client.post("/palette/extract-palette", {"image": image, "num_colors": "4"})
+            self.assertEqual(response.status_code, 200)
+            bodies.append(response.content)
+        self.assertEqual(bodies[0], bodies[1])
+        self.assertEqual(len(json.loads(bodies[0])["palette"]), 4)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+class MetricsTests(SimpleTestCase):
+    def _sample(self, text, series):
+        for line in text.splitlines():
+            if line.startswith(series + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return 0.0
+
+    def _post(self):
+        image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+        return self.client.post("/adjust/brightness", {"image": image, "factor": "1.2"})
+
+    def test_server_timing_lists_the_stages(self):
+        response = self._post()
+        self.assertEqual(response.status_code, 200)
+        stages = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        self.assertEqual(stages, ["decode", "adjust_brightness", "encode", "total"])
+
+    def test_metrics_count_requests_and_operations(self):
+        operation = 'clarifi_operation_seconds_count{operation="adjust_brightness"}'
+        view = 'clarifi_request_seconds_count{view="adjust_image",method="POST",status="200"}'
+        before = self.client.get("/metrics").content.decode()
+        self._post()
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        after = response.content.decode()
+        self.assertIn("# TYPE clarifi_operation_seconds histogram", after)
+        self.assertEqual(self._sample(after, operation), self._sample(before, operation) + 1)
+        self.assertEqual(self._sample(after, view), self._sample(before, view) + 1)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", (1, 5), ("op",))
+        for value in (0.5, 3, 10):
+            histogram.observe(value, "a")
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{op="a",le="1"} 1',
+            'test_seconds_bucket{op="a",le="5"} 2',
+            'test_seconds_bucket{op="a",le="+Inf"} 3',
+            'test_seconds_sum{op="a"} 13.5',
+            'test_seconds_count{op="a"} 3',
+        ])
+
+
+class LimiterTests(SimpleTestCase):
+    async def test_waits_then_rejects_over_the_limit(self):
+        limiter = offload.Limiter(limit=1, max_waiting=1)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        self.assertEqual(limiter.stats(), (1, 1))
+        with self.assertRaises(offload.Busy):
+            await limiter.acquire()
+
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        self.assertEqual(limiter.stats(), (1, 0))
+        limiter.release()
+        self.assertEqual(limiter.stats(), (0, 0))
+
+    async def test_cancelled_waiter_gives_up_its_place(self):
+        limiter = offload.Limiter(limit=1, max_waiting=1)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(limiter.stats(), (1, 0))
+        limiter.release()
+        self.assertEqual(limiter.stats(), (0, 0))
+
+    @override_settings(SECURE_SSL_REDIRECT=False, RESULT_CACHE_ENABLED=False)
+    def test_busy_endpoint_answers_503(self):
+        full = offload.Limiter(limit=1, max_waiting=0)
+        full.active = 1
+        image = SimpleUploadedFile("in.png", _png(_frame()), content_type="image/png")
+        with mock.patch.dict(offload._limiters, {"premium": full}):
+            response = self.client.post("/premium/denoise", {"image": image})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertEqual(full.stats(), (1, 0))
+
+
+class SharedFrameTests(SimpleTestCase):
+    def _segments(self):
+        return {name for name in frames._segments() if name.startswith(f"{frames.PREFIX}{os.getpid()}_")}
+
+    def test_frame_survives_the_round_trip(self):
+        pixels = _frame()
+        handle, array = frames.allocate(pixels.shape, pixels.dtype)
+        array[...] = pixels
+        self.assertEqual(frames.handle_of(array), handle)
+        self.assertIsNone(frames.handle_of(array[1:]))
+
+        other = frames.attach(handle)
+        np.testing.assert_array_equal(other, pixels)
+        other[0, 0] = 0
+        self.assertEqual(array[0, 0].tolist(), [0, 0, 0])
+        self.assertIsNone(frames.handle_of(other))
+
+        # The owning array unlinks the segment; the other mapping stays valid.
+        del array
+        gc.collect()
+        self.assertNotIn(handle.name, self._segments())
+        np.testing.assert_array_equal(other[1:], pixels[1:])
+
+    @override_settings(FRAME_PROCESSES=1)
+    def test_worker_pipeline_matches_in_process(self):
+        self.addCleanup(lambda: frames._pool and frames._discard_pool(frames._pool))
+        before = self._segments()
+        steps = [("adjust_brightness", {"factor": 1.2}), ("denoise", {"strength": 5, "tier": "fast"}),
+                 ("rotate", {"angle": 90})]
+        expected = run_pipeline(ImageProcessor.from_array(_frame()), steps)
+
+        processor = ImageProcessor.from_array(_frame())
+        frames.run(processor, steps)
+        np.testing.assert_array_equal(processor.pixels, expected.pixels)
+        self.assertEqual(processor.denoise_tier, "fast")
+        self.assertIsNotNone(frames.handle_of(processor.pixels))
+
+        del processor
+        gc.collect()
+        frames._close_unmapped()
+        self.assertEqual(self._segments(), before)
+
+
+class HistoryTests(TempDirMixin, SimpleTestCase):
+    def _edit(self, processor, history, method, **kwargs):
+        processor.journal = []
+        getattr(processor, method)(**kwargs)
+        history.record(processor.journal, processor.pixels)
+        processor.journal = None
+        return processor.pixels.copy()
+
+    def test_undo_and_redo_round_trip(self):
+        original = _frame()
+        history = EditHistory(self.tmp, lambda: original.copy())
+        processor = ImageProcessor.from_array(original.copy())
+        states = [original]
+        states.append(self._edit(processor, history, "adjust_brightness", factor=1.2))
+        states.append(self._edit(processor, history, "noise", intensity=0.3))
+        states.append(self._edit(processor, history, "crop", left=4, top=4, right=40, bottom=30))
+        states.append(self._edit(processor, history, "blur", radius=1.5))
+
+        self.assertTrue(history.move(processor, -len(states) + 1))
+        np.testing.assert_array_equal(processor.pixels, states[0])
+        for state in states[1:]:
+            self.assertTrue(history.move(processor, 1))
+            np.testing.assert_array_equal(processor.pixels, state)
+        self.assertFalse(history.move(processor, 1))
+
+        self.assertTrue(history.move(processor, -2))
+        np.testing.assert_array_equal(processor.pixels, states[2])
+        # The log on disk replays the same way.
+        reloaded = EditHistory(self.tmp, lambda: original.copy())
+        self.assertTrue(reloaded.move(processor, 2))
+        np.testing.assert_array_equal(processor.pixels, states[4])
+
+    def test_new_edit_drops_redo_entries(self):
+        original = _frame()
+        history = EditHistory(self.tmp, lambda: original.copy())
+        processor = ImageProcessor.from_array(original.copy())
+        self._edit(processor, history, "sepia")
+        self._edit(processor, history, "grayscale")
+        history.move(processor, -1)
+        self._edit(processor, history, "sharpen")
+        self.assertEqual(history.status()["entries"], ["sepia", "sharpen"])
+        self.assertFalse(history.move(processor, 1))
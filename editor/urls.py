@@ -8,6 +8,8 @@ urlpatterns = [
     path("converter", views.converter, name="converter"),
     path("remove", views.remove_background, name="remove_background"),
     path("studio/get-image", views.get_studio_image, name="get_studio_image"),
+    path("history", views.history_status, name="history"),
+    path("history/<str:tool>", views.history_step, name="history_step"),
     path("adjust/<str:tool>", views.adjust_image, name="adjust_image"),
     path("filter/<str:tool>", views.filter_image, name="filter_image"),
     path("transform/<str:tool>", views.transform_image, name="transform_image"),
@@ -18,6 +20,12 @@ urlpatterns = [
     path("layers/<str:tool>", views.layers, name="layers"),
     path("palette/<str:tool>", views.palette, name="palette"),
     path("format/<str:tool>", views.format, name="format"),
+    path("pipeline", views.pipeline, name="pipeline"),
+    path("batch", views.batch, name="batch"),
+    path("cache/stats", views.cache_stats, name="cache_stats"),
+    path("metrics", views.metrics_view, name="metrics"),
+    path("jobs/<uuid:job_id>", views.job_status, name="job_status"),
+    path("jobs/<uuid:job_id>/result", views.job_result, name="job_result"),
     path("compressor", views.compressor_page, name="compressor"),
     path("compressor/<str:tool>", views.compressor, name="compressor_tool"),
     path("batch-editor", views.batch_editor, name="batch_editor"),
@@ -0,0 +1,175 @@
+"""Run a pipeline over many uploads in parallel and stream the results.
+
+Images are spread over a shared, bounded executor (threads by default, as
+cv2 and PIL release the GIL; processes with ``BATCH_EXECUTOR=process``).
+Every batch in the process takes a slot from one shared semaphore before
+reading an image, so only ``BATCH_MAX_IN_FLIGHT`` images are read and
+decoded at any time however many batches run at once. Each result is
+handed to the response as soon as it finishes rather than being collected
+into a list first.
+"""
+import io
+import os
+import threading
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .image_processing import ImageProcessor
+from .pipeline import run_pipeline
+
+_executor = None
+_executor_lock = threading.Lock()
+# Images being read, decoded or processed, across every batch.
+_slots = None
+
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+
+def get_executor():
+    """Return the worker pool shared by every batch request in this process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if settings.BATCH_EXECUTOR == "process":
+                _executor = ProcessPoolExecutor(max_workers=settings.BATCH_WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=settings.BATCH_WORKERS,
+                                               thread_name_prefix="batch")
+        return _executor
+
+
+def _get_slots():
+    global _slots
+    with _executor_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(settings.BATCH_MAX_IN_FLIGHT)
+        return _slots
+
+
+def process_one(data, steps, format):
+    """Decode, edit and encode one image. Runs inside a pool worker."""
+    processor = ImageProcessor(io.BytesIO(data))
+    run_pipeline(processor, steps)
+    if processor.pixels.shape[2] == 4 and format == "JPEG":
+        format = "PNG"
+    return format, processor.save_image(format=format)
+
+
+def iter_batch(images, steps, format="JPEG"):
+    """Yield ``(index, name, format, data_or_exception)`` as each image finishes.
+
+    ``images`` is a sequence of file-like objects (Django uploads); each is
+    read only once it holds a slot, which caps how many frames the process
+    holds in memory at once. A slot is freed when its image finishes.
+    """
+    executor = get_executor()
+    slots = _get_slots()
+    pending = {}
+    queue = iter(enumerate(images))
+    exhausted = False
+    while pending or not exhausted:
+        # Wait for a slot only when none of this batch's images are running;
+        # otherwise go back to collecting results.
+        while not exhausted and slots.acquire(blocking=not pending):
+            try:
+                index, image = next(queue)
+            except StopIteration:
+                slots.release()
+                exhausted = True
+                break
+            name = os.path.splitext(os.path.basename(getattr(image, "name", "") or f"image{index}"))[0]
+            try:
+                future = executor.submit(process_one, image.read(), steps, format)
+            except BaseException:
+                slots.release()
+                raise
+            future.add_done_callback(lambda future: slots.release())
+            pending[future] = (index, name)
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, name = pending.pop(future)
+            try:
+                result_format, data = future.result()
+                yield index, name, result_format, data
+            except Exception as e:
+                yield index, name, None, e
+
+
+def result_filename(index, name, format):
+    return f"{index:03d}_{name}.{EXTENSIONS[format]}"
+
+
+class _StreamBuffer:
+    """Write-only file object that hands its contents to a generator."""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(results):
+    """Yield a ZIP archive chunk by chunk, one member per finished image.
+
+    Images are already compressed, so members are stored. Failures are
+    written as ``<name>.error.txt`` members so one bad file doesn't abort
+    the rest of the batch.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for index, name, format, data in results:
+            if isinstance(data, Exception):
+                archive.writestr(f"{index:03d}_{name}.error.txt", str(data))
+            else:
+                archive.writestr(result_filename(index, name, format), data)
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+def multipart_boundary():
+    return f"clarifi-{uuid.uuid4().hex}"
+
+
+def stream_multipart(results, boundary):
+    """Yield a ``multipart/mixed`` body, one part per finished image.
+
+    Every part carries ``Content-Length`` and ``X-Batch-Index`` headers so
+    the browser can hand each image to the page as soon as it arrives.
+    """
+    for index, name, format, data in results:
+        if isinstance(data, Exception):
+            content_type = "text/plain"
+            filename = f"{index:03d}_{name}.error.txt"
+            data = str(data).encode()
+        else:
+            content_type = f"image/{format.lower()}"
+            filename = result_filename(index, name, format)
+        headers = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Disposition: attachment; filename=\"{filename}\"\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"X-Batch-Index: {index}\r\n\r\n"
+        )
+        yield headers.encode() + data + b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
@@ -0,0 +1,64 @@
+"""Tiered denoising with a latency-driven choice of algorithm.
+
+``quality`` is the original full NL-means (7 px template, 21 px search
+window). ``balanced`` is NL-means with an 11 px search window, about half
+the work for nearly the same result on photographic noise. ``fast`` is a
+bilateral filter. All three run strip by strip on the tiling pool, with a
+halo covering the filter's reach, so the output matches a single call.
+
+``auto`` predicts each tier's run time from the frame size, the number of
+strip workers and per-megapixel costs measured on one core, and picks the
+best tier that fits the latency budget.
+"""
+from django.conf import settings
+
+from . import tiling
+from .lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+
+TIERS = ("fast", "balanced", "quality")
+
+# Seconds per megapixel on one core, measured with `manage.py bench_denoise`.
+TIER_COST = {"fast": 0.15, "balanced": 1.7, "quality": 3.8}
+
+# (template window, search window) for the NL-means tiers.
+_NLM_WINDOWS = {"balanced": (7, 11), "quality": (7, 21)}
+_BILATERAL_DIAMETER = 7
+
+
+def predict_seconds(tier, width, height, workers=None):
+    """Expected run time of ``tier`` on a ``width`` x ``height`` frame."""
+    workers = workers or tiling.workers()
+    strips = len(tiling.spans(height, width))
+    return TIER_COST[tier] * width * height / 1e6 / min(workers, strips)
+
+
+def choose_tier(width, height, budget=None):
+    """Best tier expected to finish within ``budget`` seconds (``DENOISE_BUDGET_SECONDS`` by default)."""
+    budget = settings.DENOISE_BUDGET_SECONDS if budget is None else budget
+    for tier in reversed(TIERS):
+        if predict_seconds(tier, width, height) <= budget:
+            return tier
+    return TIERS[0]
+
+
+def resolve_tier(tier, width, height, budget=None):
+    """Validate ``tier`` ("auto" or one of ``TIERS``) and resolve "auto"."""
+    if tier in (None, "", "auto"):
+        return choose_tier(width, height, budget)
+    if tier not in TIERS:
+        raise ValueError(f"Tier must be auto or one of: {', '.join(TIERS)}")
+    return tier
+
+
+def apply(bgr, strength, tier):
+    """Denoise a BGR frame with filter strength ``strength`` using ``tier``."""
+    if tier == "fast":
+        diameter = _BILATERAL_DIAMETER
+        return tiling.apply(lambda strip: cv2.bilateralFilter(strip, diameter, strength * 3, diameter / 2),
+                            bgr, halo=diameter // 2)
+    template, search = _NLM_WINDOWS[tier]
+    return tiling.apply(
+        lambda strip: cv2.fastNlMeansDenoisingColored(strip, None, strength, strength, template, search),
+        bgr, halo=template // 2 + search // 2)
@@ -0,0 +1,133 @@
+"""Pick the output format for a response and encode frames into it.
+
+``negotiate`` chooses the format from an explicit ``format`` form field,
+then the request's ``Accept`` header, then falls back to JPEG (PNG for
+frames with alpha, which JPEG can't carry). ``encode`` writes JPEG and PNG
+with ``cv2.imencode`` (libjpeg-turbo / zlib without PIL's image copy) and
+WebP/AVIF with PIL, which exposes WebP's speed/size ``method``. Quality
+and effort defaults come from settings; ``manage.py bench_encode`` reports
+encode time and size per format and setting to choose them from data.
+"""
+import io
+
+from django.conf import settings
+
+from . import metrics
+from .lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+Image = lazy_import("PIL.Image")
+
+CONTENT_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+_ALIASES = {"jpg": "jpeg"}
+
+# zlib level for interactive previews, where latency beats size.
+PREVIEW_PNG_LEVEL = 1
+
+
+def available_formats():
+    """Formats ``encode`` can produce with the installed libraries."""
+    Image.init()
+    return [format for format in CONTENT_TYPES if format != "avif" or "AVIF" in Image.SAVE]
+
+
+def normalize(format):
+    """Return the canonical name of ``format`` ("JPG" -> "jpeg"), or ``None`` if unsupported."""
+    format = str(format).strip().lower()
+    format = _ALIASES.get(format, format)
+    return format if format in available_formats() else None
+
+
+def _accepted(header):
+    """Parse ``Accept`` into ``[(media_type, q), ...]``, best first."""
+    ranges = []
+    for position, item in enumerate(header.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.append((-q, position, media_type.lower(), q))
+    return [(media_type, q) for _, _, media_type, q in sorted(ranges)]
+
+
+def negotiate(request, alpha=False, explicit=None):
+    """Return the output format for ``request``, or ``None`` for an unsupported explicit one.
+
+    ``explicit`` defaults to the request's ``format`` form field. ``alpha``
+    says the frame has transparency, which rules out JPEG.
+    """
+    default = "png" if alpha else "jpeg"
+    if explicit is None:
+        explicit = request.POST.get("format")
+    if explicit:
+        format = normalize(explicit)
+        if format == "jpeg" and alpha:
+            return "png"
+        return format
+
+    formats = available_formats()
+    for media_type, q in _accepted(request.headers.get("Accept", "")):
+        if q <= 0:
+            continue
+        if media_type in ("*/*", "image/*"):
+            return default
+        for format in formats:
+            if CONTENT_TYPES[format] == media_type and not (format == "jpeg" and alpha):
+                return format
+    return default
+
+
+def encode(pixels, format="jpeg", quality=None, effort=None):
+    """Encode an RGB(A) uint8 frame and return the bytes.
+
+    ``quality`` applies to JPEG, WebP and AVIF; ``effort`` is the zlib level
+    for PNG and the ``method`` (0 fast - 6 small) for WebP. Both default to
+    the ``ENCODE_*`` settings.
+    """
+    with metrics.track("encode", pixels.shape[0] * pixels.shape[1] / 1e6) as record:
+        data = _encode(pixels, format, quality, effort)
+        record["output_bytes"] = len(data)
+    return data
+
+
+def _encode(pixels, format, quality, effort):
+    format = normalize(format)
+    if format is None:
+        raise ValueError("Unsupported output format")
+    alpha = pixels.shape[2] == 4
+
+    if format == "jpeg":
+        quality = settings.ENCODE_JPEG_QUALITY if quality is None else quality
+        bgr = cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGR if alpha else cv2.COLOR_RGB2BGR)
+        ok, data = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    elif format == "png":
+        effort = settings.ENCODE_PNG_LEVEL if effort is None else effort
+        bgr = cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGRA if alpha else cv2.COLOR_RGB2BGR)
+        ok, data = cv2.imencode(".png", bgr, [cv2.IMWRITE_PNG_COMPRESSION, int(effort)])
+    else:
+        output = io.BytesIO()
+        image = Image.fromarray(pixels)
+        if format == "webp":
+            quality = settings.ENCODE_WEBP_QUALITY if quality is None else quality
+            effort = settings.ENCODE_WEBP_METHOD if effort is None else effort
+            image.save(output, format="WEBP", quality=int(quality), method=int(effort))
+        else:
+            quality = settings.ENCODE_AVIF_QUALITY if quality is None else quality
+            image.save(output, format="AVIF", quality=int(quality))
+        return output.getvalue()
+
+    if not ok:
+        raise ValueError(f"Could not encode image as {format.upper()}")
+    return data.tobytes()
@@ -0,0 +1,256 @@
+"""Pass frames to and from worker processes through shared memory.
+
+With ``FRAME_PROCESSES`` set, background jobs run their pipeline in a
+process pool instead of on the job thread. Pickling a frame through the
+pool's pipe copies it four times (serialise, write, read, deserialise)
+each way. Here a frame crosses as a ``FrameHandle`` instead: the name of a
+``multiprocessing.shared_memory`` segment plus its shape and dtype.
+
+- ``load`` decodes uploads straight into a segment, and a working image
+  keeps the segment its last job left it in, so the worker maps the
+  processor's own frame. A frame that isn't in a segment yet (decoded by
+  Pillow, or loaded before the first job) is copied in once and the
+  processor adopts the copy.
+- The worker edits that frame in place where the operation allows.
+  Operations that allocate their output through ``mapped.allocate_frame``
+  (tiled filters, denoise, HDR, oil painting, collage, stitching) write
+  it into a new segment, which the parent maps as the processor's buffer.
+- Only a result that cv2 or Pillow allocated itself (filters on frames
+  small enough for one strip, transforms, super resolution, background
+  removal) is copied into a segment by the worker. Frames large enough
+  for ``mapped`` stay file-backed and are always copied.
+
+A segment is unlinked when the array that owns it is collected, so it
+lives exactly as long as the frame using it. A worker hands ownership of
+its result to the parent. Segment names carry the parent's pid, so
+``sweep`` (run when the pool starts and by ``manage.py cleanup_media``)
+can remove segments left behind by a process that crashed. Names also
+carry the call, so a worker that dies mid-call can be cleaned up after.
+
+The worker's edits aren't seen by the processor's journal, so ``run``
+records the pipeline's calls in it for the undo history.
+"""
+import os
+import threading
+import time
+import uuid
+import weakref
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from django.conf import settings
+
+from . import history, mapped
+from .image_processing import ImageProcessor
+from .lazy import lazy_import
+from .pipeline import calls, run_pipeline
+
+np = lazy_import("numpy")
+
+PREFIX = "clarifi_"
+# Where POSIX shared memory segments appear as files (Linux).
+SHM_DIR = "/dev/shm"
+
+FrameHandle = namedtuple("FrameHandle", "name shape dtype")
+
+_pool = None
+_lock = threading.Lock()
+# Segments whose arrays have been collected, closed on the next call.
+_unmapped = []
+# Data address -> handle of each mapped array that owns its segment.
+_owned = {}
+
+
+def segment_name(owner=None, call=""):
+    """A new segment name owned by process ``owner`` (this one by default), optionally for ``call``."""
+    return f"{PREFIX}{owner or os.getpid()}_{call}{uuid.uuid4().hex[:16]}"
+
+
+def _open(name, size=0):
+    try:
+        return shared_memory.SharedMemory(name, create=size > 0, size=size, track=False)
+    except TypeError:
+        # Python < 3.13 has no track flag; the resource tracker shared by the
+        # pool then also unlinks leftovers once every process has exited.
+        return shared_memory.SharedMemory(name, create=size > 0, size=size)
+
+
+def _address(array):
+    return array.__array_interface__["data"][0]
+
+
+def _map(segment, handle, own):
+    """Array over ``segment``; the segment is closed once the array and its views are gone.
+
+    If ``own``, the segment is also unlinked then, unless ``disown`` was called.
+    """
+    _close_unmapped()
+    array = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=segment.buf)
+    if own:
+        _owned[_address(array)] = handle
+    # Closing from the finalizer would fail while the array still holds the
+    # buffer, so closing waits for the next call.
+    weakref.finalize(array, _unmap, segment, _address(array))
+    return array
+
+
+def _unmap(segment, address):
+    if _owned.pop(address, None) is not None:
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+    _unmapped.append(segment)
+
+
+def _close_unmapped():
+    while _unmapped:
+        _unmapped.pop().close()
+
+
+def allocate(shape, dtype, name=None):
+    """Create a segment owned by the returned array; returns ``(handle, array)``."""
+    dtype = np.dtype(dtype)
+    handle = FrameHandle(name or segment_name(), tuple(shape), dtype.str)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    return handle, _map(_open(handle.name, size), handle, own=True)
+
+
+def attach(handle, own=False):
+    """Map an existing segment as an array, without copying; ``own`` takes over unlinking it."""
+    return _map(_open(handle.name), handle, own)
+
+
+def handle_of(array):
+    """The handle of the segment ``array`` owns and covers exactly, or None."""
+    handle = _owned.get(_address(array))
+    if (handle is None or tuple(array.shape) != handle.shape or array.dtype.str != handle.dtype
+            or not array.flags.c_contiguous):
+        return None
+    return handle
+
+
+def disown(array):
+    """Leave the segment of ``array`` linked when the array goes (ownership passes elsewhere)."""
+    _owned.pop(_address(array), None)
+
+
+def release(name):
+    """Unlink segment ``name`` if it exists; arrays already mapping it stay valid."""
+    try:
+        segment = _open(name)
+    except FileNotFoundError:
+        return False
+    segment.unlink()
+    segment.close()
+    return True
+
+
+def _segments():
+    try:
+        return [name for name in os.listdir(SHM_DIR) if name.startswith(PREFIX)]
+    except FileNotFoundError:
+        return []
+
+
+def sweep():
+    """Unlink segments whose owning process has exited; returns how many."""
+    removed = 0
+    for name in _segments():
+        try:
+            pid = int(name[len(PREFIX):].split("_")[0])
+            os.kill(pid, 0)
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            removed += release(name)
+        except PermissionError:
+            pass
+    return removed
+
+
+def load(image_file):
+    """``ImageProcessor(image_file)``, decoded into a segment when jobs use the frame pool."""
+    if not settings.FRAME_PROCESSES:
+        return ImageProcessor(image_file)
+    with mapped.allocating(lambda shape, dtype: allocate(shape, dtype)[1]):
+        return ImageProcessor(image_file)
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            sweep()
+            _pool = ProcessPoolExecutor(max_workers=settings.FRAME_PROCESSES)
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _run_in_worker(frame, steps, owner, call):
+    """Pool worker: edit ``frame`` in place, or return the handle of a new segment holding the result."""
+    pixels = attach(frame)
+    processor = ImageProcessor.from_array(pixels)
+    # Segments are named for the parent and this call, so the parent can
+    # clean them up if this process dies.
+    with mapped.allocating(lambda shape, dtype: allocate(shape, dtype, segment_name(owner, call))[1]):
+        run_pipeline(processor, steps)
+    result = processor.pixels
+    if _address(result) == _address(pixels) and result.shape == pixels.shape:
+        return frame, processor.denoise_tier
+    handle = handle_of(result)
+    if handle is None:
+        handle, array = allocate(result.shape, result.dtype, segment_name(owner, call))
+        array[...] = result
+        result = array
+    disown(result)
+    return handle, processor.denoise_tier
+
+
+def _journal(processor, steps, seconds):
+    """Record the calls of ``steps`` in ``processor.journal``, as ``run_pipeline`` would have."""
+    if processor.journal is None:
+        return
+    made = list(calls(steps))
+    for op, kwargs in made:
+        params = kwargs if history.replayable(op, kwargs) else None
+        processor.journal.append(history.Step(op, params, seconds / len(made), None))
+
+
+def run(processor, steps):
+    """Apply pipeline ``steps`` to ``processor``, in the frame pool if ``FRAME_PROCESSES`` is set."""
+    if not settings.FRAME_PROCESSES:
+        return run_pipeline(processor, steps)
+    frame = handle_of(processor.pixels)
+    if frame is None:
+        frame, pixels = allocate(processor.pixels.shape, processor.pixels.dtype)
+        pixels[...] = processor.pixels
+        processor._commit(pixels)
+    call = f"{uuid.uuid4().hex[:8]}-"
+    pool = _get_pool()
+    start = time.perf_counter()
+    try:
+        result, tier = pool.submit(_run_in_worker, frame, steps, os.getpid(), call).result()
+    except BrokenProcessPool:
+        # A worker died (killed for memory, say); later jobs get a fresh pool.
+        _discard_pool(pool)
+        prefix = segment_name(call=call)[:-16]
+        for name in _segments():
+            if name.startswith(prefix):
+                release(name)
+        raise
+    # An in-place edit changed the frame under the processor's views, so commit either way.
+    processor._commit(processor.pixels if result == frame else attach(result, own=True))
+    _journal(processor, steps, time.perf_counter() - start)
+    if tier:
+        processor.denoise_tier = tier
+    return processor
@@ -0,0 +1,287 @@
+"""Server-side undo/redo history of studio working images.
+
+``@journaled`` makes every ``ImageProcessor`` operation that changes the
+frame append a ``Step`` to ``processor.journal`` while it is a list.
+``WorkingImageStore.checkout`` turns on the journal for the block and adds
+one history entry per request that changed the image.
+
+An entry is usually just the operations and their parameters, a few
+hundred bytes of JSON, and is replayed on undo/redo. The frame itself is
+only stored:
+
+- as a checkpoint (a full ``.npy`` frame) every ``HISTORY_CHECKPOINT_EVERY``
+  entries, after a request slower than ``HISTORY_CHECKPOINT_SECONDS``, and
+  after an operation that can't be replayed and changed most of the frame
+  (or its size);
+- as a patch of the changed rows and columns for an operation that can't be
+  replayed but only touched part of the frame.
+
+Crops, rotations and flips are parametric like any other replayable step.
+Moving through the history rebuilds the frame from the nearest checkpoint
+at or before the target (the original upload when there is none) and
+replays the entries after it. Entries past ``HISTORY_MAX_ENTRIES`` are
+dropped oldest first, a whole checkpoint interval at a time, so the
+history always starts at a checkpoint.
+"""
+import inspect
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import namedtuple
+from functools import wraps
+
+from django.conf import settings
+
+from .lazy import lazy_import
+from .pipeline import OPERATIONS
+
+np = lazy_import("numpy")
+
+# Operations whose result isn't determined by their parameters (random
+# noise, GrabCut's shared RNG, denoiser tiers picked against a time budget);
+# their result is stored instead of replayed.
+NOT_REPLAYABLE = {"noise", "remove_background", "denoise", "restore"}
+# A patch covering more than this fraction of the frame becomes a checkpoint.
+_MAX_PATCH_FRACTION = 0.5
+LOG = "log.json"
+
+# Parameter converters of replayable operations: the pipeline's, plus the
+# fused colour steps it hands to ``point_ops``.
+CONVERTERS = {**OPERATIONS, "point_ops": {"steps": lambda steps: [(op, params) for op, params in steps]}}
+
+# ``params`` is set for replayable calls; otherwise ``patch`` holds
+# ``(top, left, pixels)`` of the changed region, or is None if the whole
+# frame has to be kept.
+Step = namedtuple("Step", "op params seconds patch")
+
+
+def _arguments(op, params):
+    """``params`` as loaded from JSON, converted the way pipeline steps are."""
+    converters = CONVERTERS.get(op, {})
+    return {name: converters[name](value) if name in converters else value for name, value in params.items()}
+
+
+def replayable(op, params):
+    """True if calling ``op`` with ``params`` again, after a JSON round trip, repeats the edit."""
+    if op not in CONVERTERS or op in NOT_REPLAYABLE:
+        return False
+    try:
+        stored = json.loads(json.dumps(params))
+    except (TypeError, ValueError):
+        return False
+    return _arguments(op, stored) == params
+
+
+def _patch(before, after):
+    """``(top, left, pixels)`` of the region where ``after`` differs from ``before``, if small enough."""
+    if before.shape != after.shape or np.may_share_memory(before, after):
+        return None
+    changed = (before != after).any(axis=2)
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not len(rows):
+        return 0, 0, after[:0, :0].copy()
+    cols = np.flatnonzero(changed.any(axis=0))
+    top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    if (bottom - top) * (right - left) > _MAX_PATCH_FRACTION * changed.size:
+        return None
+    return int(top), int(left), after[top:bottom, left:right].copy()
+
+
+def _journaled(name, method):
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.journal is None or self._journaling:
+            return method(self, *args, **kwargs)
+        params = dict(signature.bind(self, *args, **kwargs).arguments)
+        del params["self"]
+        replay = replayable(name, params)
+        before, revision = self.pixels, self.revision
+        self._journaling = True
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._journaling = False
+        if self.revision != revision:
+            seconds = time.perf_counter() - start
+            if replay:
+                self.journal.append(Step(name, params, seconds, None))
+            else:
+                self.journal.append(Step(name, None, seconds, _patch(before, self.pixels)))
+        return result
+    return wrapper
+
+
+def journaled(cls):
+    """Class decorator logging public methods that change the frame to ``self.journal``."""
+    for name, member in list(vars(cls).items()):
+        if inspect.isfunction(member) and not name.startswith("_"):
+            setattr(cls, name, _journaled(name, member))
+    cls.journal = None
+    cls._journaling = False
+    return cls
+
+
+class EditHistory:
+    """The history of one working image, kept in ``directory``.
+
+    ``original`` returns the frame the history starts from when no
+    checkpoint precedes it (the decoded upload). ``cursor`` is the number
+    of entries applied to the current image; entries after it can be redone.
+    """
+
+    def __init__(self, directory, original):
+        self.directory = directory
+        self.original = original
+        try:
+            with open(os.path.join(directory, LOG)) as f:
+                log = json.load(f)
+        except FileNotFoundError:
+            log = {"base": None, "cursor": 0, "entries": []}
+        self.base = log["base"]
+        self.cursor = log["cursor"]
+        self.entries = log["entries"]
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, LOG))
+
+    def start(self, pixels):
+        """Begin the history at ``pixels`` instead of the original upload."""
+        self.base = self._store(pixels)
+        self._save()
+
+    def record(self, steps, pixels):
+        """Add an entry for ``steps``, which turned the current image into ``pixels``.
+
+        Entries that could have been redone are dropped. An empty ``steps``
+        (the frame was changed outside a journaled call) is kept as a
+        checkpoint.
+        """
+        for entry in self.entries[self.cursor:]:
+            self._remove(entry)
+        del self.entries[self.cursor:]
+
+        since = 0
+        while since < len(self.entries) and "frame" not in self.entries[-1 - since]:
+            since += 1
+        checkpoint = (not steps or since + 1 >= settings.HISTORY_CHECKPOINT_EVERY
+                      or sum(step.seconds for step in steps) >= settings.HISTORY_CHECKPOINT_SECONDS
+                      or any(step.params is None and step.patch is None for step in steps))
+        entry = {"ops": []}
+        for step in steps or [Step("edit", None, 0.0, None)]:
+            op = {"op": step.op}
+            if step.params is not None:
+                op["params"] = step.params
+            elif step.patch is not None and not checkpoint:
+                top, left, patch = step.patch
+                op.update(at=[top, left], patch=self._store(patch))
+            entry["ops"].append(op)
+        if checkpoint:
+            entry["frame"] = self._store(pixels)
+
+        self.entries.append(entry)
+        self.cursor = len(self.entries)
+        self._trim()
+        self._save()
+
+    def move(self, processor, offset):
+        """Undo (negative ``offset``) or redo entries on ``processor``; False if out of range."""
+        target = self.cursor + offset
+        if offset == 0 or not 0 <= target <= len(self.entries):
+            return False
+        self._rebuild(processor, target)
+        self.cursor = target
+        self._save()
+        return True
+
+    def status(self):
+        return {
+            "cursor": self.cursor,
+            "length": len(self.entries),
+            "entries": ["+".join(op["op"] for op in entry["ops"]) for entry in self.entries],
+        }
+
+    def _rebuild(self, processor, index):
+        """Make ``processor`` hold the image after the first ``index`` entries."""
+        start = index
+        while start and "frame" not in self.entries[start - 1]:
+            start -= 1
+        if start:
+            processor._commit(self._load(self.entries[start - 1]["frame"]))
+        elif self.base:
+            processor._commit(self._load(self.base))
+        else:
+            processor._commit(self.original())
+        for entry in self.entries[start:index]:
+            for op in entry["ops"]:
+                if "params" in op:
+                    getattr(processor, op["op"])(**_arguments(op["op"], op["params"]))
+                elif "patch" in op:
+                    top, left = op["at"]
+                    patch = self._load(op["patch"])
+                    processor._writable()[top:top + patch.shape[0], left:left + patch.shape[1]] = patch
+
+    def _trim(self):
+        """Drop the oldest entries past ``HISTORY_MAX_ENTRIES``, up to a checkpoint that becomes the base."""
+        excess = len(self.entries) - settings.HISTORY_MAX_ENTRIES
+        if excess <= 0:
+            return
+        for keep in range(excess, min(self.cursor, len(self.entries)) + 1):
+            if "frame" in self.entries[keep - 1]:
+                break
+        else:
+            return
+        base = self.entries[keep - 1].pop("frame")
+        for entry in self.entries[:keep]:
+            self._remove(entry)
+        if self.base:
+            self._delete(self.base)
+        self.base = base
+        del self.entries[:keep]
+        self.cursor -= keep
+
+    def _store(self, pixels):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{uuid.uuid4().hex}.npy"
+        with open(os.path.join(self.directory, name), "wb") as f:
+            np.save(f, pixels)
+        return name
+
+    def _load(self, name):
+        return np.load(os.path.join(self.directory, name))
+
+    def _delete(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _remove(self, entry):
+        for name in [entry.get("frame")] + [op.get("patch") for op in entry["ops"]]:
+            if name:
+                self._delete(name)
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, LOG)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"base": self.base, "cursor": self.cursor, "entries": self.entries}, f)
+        os.replace(tmp, path)
+
+
+def remove(directory):
+    """Delete a history directory; returns the bytes freed."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    freed = sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+    shutil.rmtree(directory, ignore_errors=True)
+    return freed
@@ -1,22 +1,174 @@
+import inspect
 import io
-import numpy as np
-from PIL import Image, ImageEnhance, ImageDraw, ImageFont, ImageFilter
-import cv2
-from django.core.files.uploadedfile import InMemoryUploadedFile
-import colorsys
-import random
-import pytesseract
-from scipy.ndimage import label
-
+import statistics
+
+from . import denoising, encoding, history, mapped, metrics, pointops, quantize, tiling
+from .ingest import decode, probe
+from .lazy import lazy_import
+from .resources import EYE_CASCADE, FACE_CASCADE, detect, get_font
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFilter = lazy_import("PIL.ImageFilter")
+
+# Row count for strip-wise float scratch buffers in pointwise effects.
+_STRIP_ROWS = 256
+# compress_image predicts encoded sizes from a grid of tiles (tile edge, tiles
+# per side) and makes at most this many full-resolution encodes per target,
+# the one it returns included.
+_SIZE_SAMPLE_TILE = 64
+_SIZE_SAMPLE_GRID = 8
+_MAX_SIZE_PROBES = 4
+# Default longest edge GrabCut analyses in remove_background (0 = full
+# resolution), and the margin of its initial rectangle at full resolution.
+GRABCUT_ANALYSIS_EDGE = 640
+_GRABCUT_MARGIN = 50
+
+
+@metrics.instrument
+@history.journaled
 class ImageProcessor:
-    def __init__(self, image_file):
-        """Initialize with an uploaded image file."""
-        self.image = Image.open(image_file).convert("RGB")
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers = [self.image.copy()]  
+    """Image editing operations over a single canonical pixel buffer.
+
+    ``pixels`` is an RGB (or RGBA after background removal) uint8 array and
+    is the only full-frame copy the processor owns. ``image`` (PIL) and
+    ``cv_image`` (BGR) are views built on demand for operations that need
+    them and dropped whenever the buffer changes. ``revision`` increases on
+    every change so callers can tell whether an operation touched the frame.
+    """
+
+    # Denoiser tier chosen by the last denoise/restore call, if any.
+    denoise_tier = None
+
+    def __init__(self, image_file, draft_size=None):
+        """Initialize with an uploaded image file.
+
+        ``draft_size`` is the smallest ``(width, height)`` the caller will
+        use, or a longest edge; JPEGs may then be decoded at reduced scale
+        (see ``editor.utils.ingest.decode``) and ``decode_scale`` records
+        the factor relative to the original.
+        """
+        pixels, scale = decode(image_file, draft_size)
+        self._setup(pixels)
+        self.decode_scale = scale
+
+    @classmethod
+    def from_array(cls, pixels):
+        """Build a processor around an existing RGB(A) uint8 array."""
+        processor = cls.__new__(cls)
+        processor._setup(pixels)
+        return processor
+
+    @classmethod
+    def from_collage(cls, images, layout="2x2"):
+        """Build a processor around a collage of ``images``.
+
+        Cells take the median input size, so one outsized image doesn't
+        inflate the canvas. Inputs are decoded one at a time (JPEGs at
+        reduced scale when much larger than a cell) and large canvases are
+        disk-backed (see ``editor.utils.mapped``).
+        """
+        return cls.from_array(_collage_frame(images, layout))
+
+    @classmethod
+    def from_stitch(cls, images):
+        """Build a processor around a panorama stitched from ``images``."""
+        return cls.from_array(_stitch_frame(images))
+
+    def _setup(self, pixels):
+        self.decode_scale = 1.0
+        self.layers = [None]
+        self.revision = 0
+        self._proxy = None
+        self._size_curves = {}
+        self._commit(pixels)
+
+    @property
+    def pixels(self):
+        """Canonical RGB(A) uint8 buffer."""
+        return self._pixels
+
+    @property
+    def image(self):
+        """PIL view of the pixel buffer, built on first use."""
+        if self._pil is None:
+            self._pil = Image.fromarray(self._pixels)
+        return self._pil
+
+    @image.setter
+    def image(self, img):
+        self._commit(np.asarray(img))
+
+    @property
+    def cv_image(self):
+        """BGR view of the pixel buffer for cv2 calls that assume BGR order."""
+        if self._bgr is None:
+            code = cv2.COLOR_RGBA2BGR if self._pixels.shape[2] == 4 else cv2.COLOR_RGB2BGR
+            self._bgr = cv2.cvtColor(self._pixels, code)
+        return self._bgr
+
+    def _commit(self, pixels):
+        """Make ``pixels`` the canonical buffer and drop stale views."""
+        if pixels.ndim == 2:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_GRAY2RGB)
+        self._pixels = pixels
+        self._pil = None
+        self._bgr = None
+        self.layers[-1] = pixels
+        self.revision += 1
+
+    def _commit_bgr(self, bgr):
+        """Adopt a BGR result from cv2, swapping channels in place."""
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=bgr)
+        self._commit(bgr)
+
+    def _rgb(self):
+        """Return the buffer as contiguous 3-channel RGB."""
+        if self._pixels.shape[2] == 4:
+            return cv2.cvtColor(self._pixels, cv2.COLOR_RGBA2RGB)
+        return self._pixels
+
+    def _writable(self):
+        """Return the pixel buffer, copying it first if it is read-only."""
+        if not self._pixels.flags.writeable:
+            self._commit(self._pixels.copy())
+        self._pil = None
+        self._bgr = None
+        self.revision += 1
+        return self._pixels
+
+    def preview(self, max_edge=1024):
+        """Return ``(processor, scale)`` for a throwaway low-resolution copy.
+
+        The downscaled proxy is cached until the frame changes, so repeated
+        slider previews skip the resize. The proxy is read-only; operations
+        on the returned processor never touch this one. ``scale`` is relative
+        to the original image, even if it was decoded at reduced size.
+        """
+        height, width = self._pixels.shape[:2]
+        scale = min(1.0, max_edge / max(height, width))
+        if self._proxy is None or self._proxy[0] != (self.revision, max_edge):
+            if scale < 1.0:
+                size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                proxy = cv2.resize(self._pixels, size, interpolation=cv2.INTER_AREA)
+            else:
+                proxy = self._pixels.view()
+            proxy.flags.writeable = False
+            self._proxy = ((self.revision, max_edge), proxy)
+        return ImageProcessor.from_array(self._proxy[1]), scale * self.decode_scale
+
+    def save_preview(self, quality=80):
+        """Encode quickly for interactive previews; returns ``(bytes, content_type)``."""
+        if self._pixels.shape[2] == 4:
+            return encoding.encode(self._pixels, "png", effort=encoding.PREVIEW_PNG_LEVEL), "image/png"
+        return encoding.encode(self._pixels, "jpeg", quality=quality), "image/jpeg"
 
     def save_image(self, format="JPEG"):
-        """Save the processed image to a BytesIO buffer."""
+        """Encode the image; JPEG, PNG, WebP and AVIF go through ``encoding.encode``."""
+        if encoding.normalize(format):
+            return encoding.encode(self._pixels, format)
         output = io.BytesIO()
         self.image.save(output, format=format.upper())
         output.seek(0)
@@ -24,115 +176,85 @@ class ImageProcessor:
 
     def adjust_brightness(self, factor):
         """Adjust brightness (factor: 0.0 to 2.0, 1.0 is original)."""
-        if not 0.0 <= factor <= 2.0:
-            raise ValueError("Factor must be between 0.0 and 2.0")
-        enhancer = ImageEnhance.Brightness(self.image)
-        self.image = enhancer.enhance(factor)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self._commit(pointops.apply(self._pixels, [pointops.brightness(factor)]))
 
     def adjust_contrast(self, factor):
         """Adjust contrast (factor: 0.0 to 2.0, 1.0 is original)."""
-        if not 0.0 <= factor <= 2.0:
-            raise ValueError("Factor must be between 0.0 and 2.0")
-        enhancer = ImageEnhance.Contrast(self.image)
-        self.image = enhancer.enhance(factor)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self._commit(pointops.apply(self._pixels, [pointops.contrast(factor)]))
 
     def adjust_saturation(self, factor):
         """Adjust saturation (factor: 0.0 to 2.0, 1.0 is original)."""
-        if not 0.0 <= factor <= 2.0:
-            raise ValueError("Factor must be between 0.0 and 2.0")
-        enhancer = ImageEnhance.Color(self.image)
-        self.image = enhancer.enhance(factor)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self._commit(pointops.apply(self._pixels, [pointops.saturation(factor)]))
 
     def adjust_hue(self, factor):
         """Adjust hue (factor: -0.5 to 0.5)."""
         if not -0.5 <= factor <= 0.5:
             raise ValueError("Factor must be between -0.5 and 0.5")
-        hsv = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2HSV)
-        hsv[:, :, 0] = (hsv[:, :, 0] + int(factor * 180)) % 180
-        self.cv_image = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        hsv = cv2.cvtColor(self._rgb(), cv2.COLOR_RGB2HSV)
+        shift = (np.arange(256) + int(factor * 180)) % 180
+        hsv[:, :, 0] = shift.astype(np.uint8)[hsv[:, :, 0]]
+        self._commit(cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB, dst=hsv))
 
     def grayscale(self):
         """Convert to grayscale."""
-        self.image = self.image.convert("L").convert("RGB")
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self._commit(pointops.apply(self._pixels, [pointops.grayscale()]))
 
     def sepia(self):
         """Apply sepia filter."""
-        sepia_matrix = np.array([[0.272, 0.534, 0.131],
-                                 [0.349, 0.686, 0.168],
-                                 [0.393, 0.769, 0.189]])
-        img_array = np.array(self.image)
-        sepia_img = np.clip(np.dot(img_array, sepia_matrix.T), 0, 255).astype(np.uint8)
-        self.image = Image.fromarray(sepia_img)
-        self.cv_image = cv2.cvtColor(sepia_img, cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self._commit(pointops.apply(self._pixels, [pointops.sepia()]))
+
+    def point_ops(self, steps):
+        """Apply ``(name, kwargs)`` colour steps from ``pointops.OPS`` in fused passes."""
+        self._commit(pointops.apply(self._pixels, pointops.compile_steps(steps)))
 
     def blur(self, radius):
         """Apply Gaussian blur."""
         if not 0 <= radius <= 10:
             raise ValueError("Radius must be between 0 and 10")
-        self.cv_image = cv2.GaussianBlur(self.cv_image, (0, 0), sigmaX=radius)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        # cv2 sizes an 8-bit Gaussian kernel to 3 sigma either side.
+        self._commit(tiling.apply(lambda strip: cv2.GaussianBlur(strip, (0, 0), sigmaX=radius),
+                                  self.pixels, halo=int(np.ceil(radius * 3)) + 1))
 
     def sharpen(self):
         """Apply sharpen filter."""
         kernel = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]])
-        self.cv_image = cv2.filter2D(self.cv_image, -1, kernel)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(tiling.apply(lambda strip: cv2.filter2D(strip, -1, kernel), self.pixels, halo=1))
 
     def edge_detection(self):
         """Apply Canny edge detection."""
-        gray = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 100, 200)
-        self.cv_image = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        # Hysteresis follows edges across the whole frame, so only the
+        # grayscale conversion is split into strips.
+        gray = tiling.apply(lambda strip: cv2.cvtColor(strip, cv2.COLOR_RGB2GRAY), self._rgb())
+        self._commit(cv2.Canny(gray, 100, 200))
 
     def crop(self, left, top, right, bottom):
         """Crop image to specified box."""
         if any(v < 0 for v in [left, top, right, bottom]) or right <= left or bottom <= top:
             raise ValueError("Invalid crop dimensions")
-        self.image = self.image.crop((left, top, right, bottom))
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        height, width = self.pixels.shape[:2]
+        if right <= width and bottom <= height:
+            self._commit(self.pixels[top:bottom, left:right].copy())
+        else:
+            self.image = self.image.crop((left, top, right, bottom))
 
     def resize(self, width, height):
         """Resize image to specified dimensions."""
         if width <= 0 or height <= 0:
             raise ValueError("Width and height must be positive")
         self.image = self.image.resize((width, height), Image.Resampling.LANCZOS)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
 
     def rotate(self, angle):
         """Rotate image by specified angle."""
         if angle not in [90, 180, 270]:
             raise ValueError("Angle must be 90, 180, or 270")
-        self.image = self.image.rotate(angle, expand=True)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        codes = {90: cv2.ROTATE_90_COUNTERCLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_CLOCKWISE}
+        self._commit(cv2.rotate(self.pixels, codes[angle]))
 
     def flip(self, direction):
         """Flip image horizontally or vertically."""
         if direction not in ["horizontal", "vertical"]:
             raise ValueError("Direction must be 'horizontal' or 'vertical'")
-        if direction == "horizontal":
-            self.image = self.image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-        else:
-            self.image = self.image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self._commit(cv2.flip(self.pixels, 1 if direction == "horizontal" else 0))
 
     def add_text(self, text, x, y, font_size, color):
         """Add text overlay."""
@@ -144,15 +266,11 @@ class ImageProcessor:
             r, g, b = tuple(int(color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
         except:
             raise ValueError("Invalid color format")
-        draw = ImageDraw.Draw(self.image)
-        font = ImageFont.load_default()  
-        try:
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except:
-            pass
+        img = self.image
+        draw = ImageDraw.Draw(img)
+        font = get_font(font_size)
         draw.text((x, y), text, fill=(r, g, b), font=font)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self.image = img
 
     def watermark(self, watermark_text, opacity):
         """Add watermark with specified opacity."""
@@ -162,73 +280,93 @@ class ImageProcessor:
             raise ValueError("Opacity must be between 0 and 1")
         watermark = Image.new("RGBA", self.image.size, (255, 255, 255, 0))
         draw = ImageDraw.Draw(watermark)
-        font = ImageFont.load_default()
-        try:
-            font = ImageFont.truetype("arial.ttf", 50)
-        except:
-            pass
+        font = get_font(50)
         draw.text((10, 10), watermark_text, fill=(255, 255, 255, int(255 * opacity)), font=font)
         self.image = Image.alpha_composite(self.image.convert("RGBA"), watermark).convert("RGB")
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
 
     def vignette(self, intensity):
         """Apply vignette effect (optimized)."""
         if not 0 <= intensity <= 1:
             raise ValueError("Intensity must be between 0 and 1")
-        height, width = self.cv_image.shape[:2]
+        height, width = self.pixels.shape[:2]
         kernel_size = min(width, height) // 2
         kernel = cv2.getGaussianKernel(kernel_size * 2, kernel_size / 2)
-        mask = kernel * kernel.T
-        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
-        mask = mask / mask.max() * intensity
-        mask = 1 - mask
-        self.cv_image = (self.cv_image.astype(np.float32) * mask[..., np.newaxis]).astype(np.uint8)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        # The 2D mask is an outer product and bilinear resize is separable,
+        # so resize the 1D kernels and build the mask one strip at a time.
+        mask_x = cv2.resize(kernel.T, (width, 1), interpolation=cv2.INTER_LINEAR)[0]
+        mask_y = cv2.resize(kernel, (1, height), interpolation=cv2.INTER_LINEAR)[:, 0]
+        scale = intensity / (mask_x.max() * mask_y.max())
+        mask_x = mask_x.astype(np.float32)
+        pixels = self._rgb()
+        result = np.empty_like(pixels)
+
+        def shade(span):
+            for top in range(span.start, span.stop, _STRIP_ROWS):
+                rows = slice(top, min(top + _STRIP_ROWS, span.stop))
+                mask = 1 - np.outer(mask_y[rows] * scale, mask_x)
+                np.multiply(pixels[rows], mask[..., np.newaxis], out=result[rows], casting="unsafe")
+
+        tiling.for_strips(shade, height, width)
+        self._commit(result)
 
     def noise(self, intensity):
         """Add noise effect (optimized)."""
         if not 0 <= intensity <= 1:
             raise ValueError("Intensity must be between 0 and 1")
-        noise = np.random.normal(0, intensity * 255, self.cv_image.shape)
-        self.cv_image = np.clip(self.cv_image.astype(np.float32) + noise, 0, 255).astype(np.uint8)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        # Generators aren't thread-safe, so each strip seeds its own.
+        entropy = np.random.SeedSequence().entropy
+        pixels = self._rgb()
+        result = np.empty_like(pixels)
+
+        def add(span):
+            rng = np.random.default_rng([span.start, entropy])
+            for top in range(span.start, span.stop, _STRIP_ROWS):
+                rows = slice(top, min(top + _STRIP_ROWS, span.stop))
+                strip = rng.standard_normal(pixels[rows].shape, dtype=np.float32)
+                strip *= intensity * 255
+                strip += pixels[rows]
+                np.clip(strip, 0, 255, out=strip)
+                result[rows] = strip
+
+        tiling.for_strips(add, *pixels.shape[:2])
+        self._commit(result)
 
     def hdr(self):
         """Apply HDR effect."""
-        img_float = np.float32(self.cv_image) / 255.0
-        img_hdr = cv2.detailEnhance(img_float, sigma_s=12, sigma_r=0.15)
-        self.cv_image = np.clip(img_hdr * 255, 0, 255).astype(np.uint8)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        bgr = self.cv_image
+        self._commit_bgr(cv2.detailEnhance(bgr, mapped.allocate_frame(bgr.shape), sigma_s=12, sigma_r=0.15))
 
     def cartoon(self):
         """Apply cartoon effect."""
-        gray = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2GRAY)
+        pixels = self._rgb()
+        gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
         gray = cv2.medianBlur(gray, 5)
         edges = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 9)
-        color = cv2.bilateralFilter(self.cv_image, 9, 250, 250)
-        self.cv_image = cv2.bitwise_and(color, color, mask=edges)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
-
-    def remove_background(self):
-        """Remove background using GrabCut."""
-        height, width = self.cv_image.shape[:2]
-        mask = np.zeros((height, width), np.uint8)
-        bgd_model = np.zeros((1, 65), np.float64)
-        fgd_model = np.zeros((1, 65), np.float64)
-        rect = (50, 50, width - 100, height - 100)  
-        cv2.grabCut(self.cv_image, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
-        mask2 = np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
-        self.cv_image = self.cv_image * mask2[:, :, np.newaxis]
-        rgba = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB)
-        alpha = mask2 * 255
-        rgba = np.dstack((rgba, alpha))
-        self.image = Image.fromarray(rgba, 'RGBA')
-        self.layers[-1] = self.image.copy()
+        color = cv2.bilateralFilter(pixels, 9, 250, 250)
+        self._commit(cv2.bitwise_and(color, color, mask=edges))
+
+    def remove_background(self, analysis_edge=GRABCUT_ANALYSIS_EDGE):
+        """Remove background using GrabCut.
+
+        GrabCut runs on a proxy whose longest edge is ``analysis_edge``
+        pixels (0 for full resolution). The proxy mask is upsampled and only
+        a band along its boundary is refined at full resolution, with a
+        guided filter that pulls the edge onto the image's own edges.
+        """
+        if analysis_edge and analysis_edge < 64:
+            raise ValueError("Analysis edge must be 0 (full resolution) or at least 64")
+        rgb = self._rgb()
+        height, width = rgb.shape[:2]
+        scale = analysis_edge / max(height, width) if analysis_edge else 1.0
+        if scale >= 1.0:
+            alpha = _grabcut(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), _GRABCUT_MARGIN)
+        else:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            proxy = cv2.cvtColor(cv2.resize(rgb, size, interpolation=cv2.INTER_AREA), cv2.COLOR_RGB2BGR)
+            coarse = _grabcut(proxy, max(1, round(_GRABCUT_MARGIN * scale)))
+            alpha = _refine_mask(rgb, coarse, scale)
+        rgba = np.dstack((rgb, alpha))
+        self._commit(cv2.bitwise_and(rgba, rgba, mask=alpha))
 
     def super_resolution(self, scale=2):
         """Apply super-resolution (upscaling with sharpening)."""
@@ -238,115 +376,92 @@ class ImageProcessor:
         new_size = (width * scale, height * scale)
         self.image = self.image.resize(new_size, Image.Resampling.LANCZOS)
         self.image = self.image.filter(ImageFilter.UnsharpMask(radius=2, percent=150, threshold=3))
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
 
     def auto_enhance(self):
         """Apply auto-enhance (contrast, brightness, sharpen)."""
-        enhancer = ImageEnhance.Contrast(self.image)
-        self.image = enhancer.enhance(1.2)
-        enhancer = ImageEnhance.Brightness(self.image)
-        self.image = enhancer.enhance(1.1)
+        self._commit(pointops.apply(self._pixels, [pointops.contrast(1.2), pointops.brightness(1.1)]))
         self.image = self.image.filter(ImageFilter.UnsharpMask(radius=1, percent=100, threshold=3))
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
 
     def colorize(self):
         """Colorize a grayscale image (simple hue mapping)."""
-        if self.image.mode != "L":
-            self.image = self.image.convert("L")
-        img_array = np.array(self.image)
-        hsv = np.zeros((img_array.shape[0], img_array.shape[1], 3), dtype=np.uint8)
+        img_array = cv2.cvtColor(self._rgb(), cv2.COLOR_RGB2GRAY)
+        hsv = np.empty((img_array.shape[0], img_array.shape[1], 3), dtype=np.uint8)
         hsv[:, :, 0] = (img_array // 2) % 180
         hsv[:, :, 1] = 255
         hsv[:, :, 2] = img_array
-        self.cv_image = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB, dst=hsv))
 
     def oil_painting(self):
         """Apply oil painting effect."""
         try:
-            self.cv_image = cv2.xphoto.oilPainting(self.cv_image, size=7, dynRatio=1)
+            bgr = self.cv_image
+            self._commit_bgr(cv2.xphoto.oilPainting(bgr, size=7, dynRatio=1, dst=mapped.allocate_frame(bgr.shape)))
         except:
-            self.cv_image = cv2.stylization(self.cv_image, sigma_s=60, sigma_r=0.6)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+            rgb = self._rgb()
+            self._commit(cv2.stylization(rgb, mapped.allocate_frame(rgb.shape), sigma_s=60, sigma_r=0.6))
 
     def watercolor(self):
         """Apply watercolor effect."""
-        self.cv_image = cv2.stylization(self.cv_image, sigma_s=60, sigma_r=0.6)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(cv2.stylization(self._rgb(), sigma_s=60, sigma_r=0.6))
 
     def sketch(self):
         """Apply pencil sketch effect."""
         gray, _ = cv2.pencilSketch(self.cv_image, sigma_s=60, sigma_r=0.07, shade_factor=0.05)
-        self.cv_image = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(gray)
 
     def emboss(self):
         """Apply emboss effect."""
         kernel = np.array([[-2, -1, 0], [-1, 1, 1], [0, 1, 2]])
-        self.cv_image = cv2.filter2D(self.cv_image, -1, kernel)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(tiling.apply(lambda strip: cv2.filter2D(strip, -1, kernel), self.pixels, halo=1))
 
     def inpaint(self, x, y, radius):
         """Remove object at (x, y) with specified radius."""
         if radius <= 0:
             raise ValueError("Radius must be positive")
-        mask = np.zeros(self.cv_image.shape[:2], dtype=np.uint8)
+        mask = np.zeros(self.pixels.shape[:2], dtype=np.uint8)
         cv2.circle(mask, (x, y), radius, 255, -1)
-        self.cv_image = cv2.inpaint(self.cv_image, mask, 3, cv2.INPAINT_TELEA)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(cv2.inpaint(self._rgb(), mask, 3, cv2.INPAINT_TELEA))
 
     def face_detection(self, action="crop"):
         """Detect faces and crop or blur them."""
         if action not in ["crop", "blur"]:
             raise ValueError("Action must be 'crop' or 'blur'")
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-        gray = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        if action == "crop" and faces:
+        gray = cv2.cvtColor(self._rgb(), cv2.COLOR_RGB2GRAY)
+        faces = detect(FACE_CASCADE, gray, 1.3, 5)
+        if action == "crop" and len(faces):
             x, y, w, h = faces[0]
-            self.image = self.image.crop((x, y, x + w, y + h))
-            self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        elif action == "blur":
+            self._commit(self.pixels[y:y+h, x:x+w].copy())
+        elif action == "blur" and len(faces):
+            pixels = self._writable()
             for (x, y, w, h) in faces:
-                face = self.cv_image[y:y+h, x:x+w]
-                face = cv2.GaussianBlur(face, (23, 23), 30)
-                self.cv_image[y:y+h, x:x+w] = face
-            self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+                pixels[y:y+h, x:x+w] = cv2.GaussianBlur(pixels[y:y+h, x:x+w], (23, 23), 30)
 
     def batch_process(self, images, operation, params):
-        """Apply an operation to multiple images."""
-        results = []
-        for img_file in images:
-            processor = ImageProcessor(img_file)
-            getattr(processor, operation)(*params)
-            results.append(processor.save_image())
+        """Apply an operation to multiple images in parallel, keeping input order."""
+        from .batch import iter_batch
+        names = list(inspect.signature(getattr(ImageProcessor, operation)).parameters)[1:]
+        steps = [(operation, dict(zip(names, params)))]
+        results = [None] * len(images)
+        for index, _, _, data in iter_batch(images, steps):
+            if isinstance(data, Exception):
+                raise data
+            results[index] = data
         return results
 
     def add_layer(self, image_file):
         """Add a new layer from an uploaded image."""
         new_layer = Image.open(image_file).convert("RGB").resize(self.image.size)
-        self.layers.append(new_layer)
+        self.layers.append(np.asarray(new_layer))
 
     def merge_layers(self, opacity=1.0):
         """Merge all layers with specified opacity for top layers."""
         if not 0 <= opacity <= 1:
             raise ValueError("Opacity must be between 0 and 1")
-        base = self.layers[0].convert("RGBA")
+        base = Image.fromarray(self.layers[0]).convert("RGB")
         for layer in self.layers[1:]:
-            layer_rgba = layer.convert("RGBA")
-            base = Image.blend(base, layer_rgba, opacity)
-        self.image = base.convert("RGB")
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers = [self.image.copy()]
+            base = Image.blend(base, Image.fromarray(layer).convert("RGB"), opacity)
+        self.layers = [None]
+        self.image = base
 
     def meme_generator(self, top_text, bottom_text, font_size=50, color=(255, 255, 255)):
         """Create a meme with top and bottom text."""
@@ -354,65 +469,30 @@ class ImageProcessor:
             raise ValueError("At least one text required")
         if font_size <= 0:
             raise ValueError("Font size must be positive")
-        draw = ImageDraw.Draw(self.image)
-        font = ImageFont.load_default()
-        try:
-            font = ImageFont.truetype("arial.ttf", font_size)
-        except:
-            pass
-        width, height = self.image.size
+        img = self.image
+        draw = ImageDraw.Draw(img)
+        font = get_font(font_size)
+        width, height = img.size
         top_bbox = draw.textbbox((0, 0), top_text, font=font)
         bottom_bbox = draw.textbbox((0, 0), bottom_text, font=font)
         draw.text(((width - top_bbox[2]) / 2, 10), top_text, fill=color, font=font)
         draw.text(((width - bottom_bbox[2]) / 2, height - bottom_bbox[3] - 10), bottom_text, fill=color, font=font)
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        self.image = img
 
     def collage(self, images, layout="2x2"):
-        """Create a collage with specified layout."""
-        if layout not in ["2x2", "3x1", "1x3", "1x2", "2x1"]:
-            raise ValueError("Invalid layout")
-        imgs = [Image.open(img).convert("RGB") for img in images]
-        if layout == "2x2":
-            rows, cols = 2, 2
-        elif layout == "3x1":
-            rows, cols = 3, 1
-        elif layout == "1x3":
-            rows, cols = 1, 3
-        elif layout == "1x2":
-            rows, cols = 1, 2
-        else:
-            rows, cols = 2, 1
-        max_width = max(img.size[0] for img in imgs)
-        max_height = max(img.size[1] for img in imgs)
-        collage_width = max_width * cols
-        collage_height = max_height * rows
-        collage = Image.new("RGB", (collage_width, collage_height), (255, 255, 255))
-        for i, img in enumerate(imgs[:rows * cols]):
-            img = img.resize((max_width, max_height), Image.Resampling.LANCZOS)
-            x = (i % cols) * max_width
-            y = (i // cols) * max_height
-            collage.paste(img, (x, y))
-        self.image = collage
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers = [self.image.copy()]
-
-    def extract_palette(self, num_colors=5):
-        """Extract dominant colors from the image."""
+        """Create a collage with specified layout (see ``from_collage``)."""
+        self.layers = [None]
+        self._commit(_collage_frame(images, layout))
+
+    def extract_palette(self, num_colors=5, mode="fast"):
+        """Extract dominant colors with their pixel shares (see ``editor.utils.quantize``)."""
         if num_colors < 1:
             raise ValueError("Number of colors must be positive")
-        img = self.image.resize((150, 150))
-        pixels = np.float32(img).reshape(-1, 3)
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, 0.1)
-        _, labels, centers = cv2.kmeans(pixels, num_colors, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
-        palette = centers.astype(np.uint8).tolist()
-        return palette
-
-    def restore(self):
-        """Restore image by reducing noise and scratches."""
-        self.cv_image = cv2.fastNlMeansDenoisingColored(self.cv_image, None, 10, 10, 7, 21)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        return quantize.extract_palette(self._pixels, num_colors, mode)
+
+    def restore(self, tier="auto", budget=None):
+        """Restore image by reducing noise and scratches (see ``denoise`` for ``tier``)."""
+        self._denoise(10, tier, budget)
 
     def convert_format(self, format, quality=90, compression=6, width=0, height=0, aspect=True, strip=False, color="RGB", dpi=72, background="#ffffff"):
         """Convert image format with customization."""
@@ -429,6 +509,7 @@ class ImageProcessor:
         img = self.image
         if width > 0 and height > 0:
             if aspect:
+                img = img.copy()
                 img.thumbnail((width, height), Image.Resampling.LANCZOS)
             else:
                 img = img.resize((width, height), Image.Resampling.LANCZOS)
@@ -457,7 +538,13 @@ class ImageProcessor:
         return output.getvalue()
 
     def compress_image(self, target_size_kb, format="JPEG", quality=80, compression=6, lossless=False, progressive=False, strip_metadata=False, quantization="standard"):
-        """Compress image with advanced options."""
+        """Compress image with advanced options.
+
+        For lossy formats the highest quality (10 up to the requested one)
+        that fits ``target_size_kb`` is found by bisection. Each probe is
+        predicted from a downscaled sample and calibrated against the full
+        encodes so far, so a target is usually hit in two or three encodes.
+        """
         if target_size_kb <= 0:
             raise ValueError("Target size must be positive")
         if format not in ["JPEG", "PNG", "WEBP"]:
@@ -469,102 +556,168 @@ class ImageProcessor:
         if quantization not in ["standard", "high", "low"]:
             raise ValueError("Invalid quantization mode")
 
-        img = self.image
-        output = io.BytesIO()
-        save_params = {}
-
-        quality_adjust = {"standard": 0, "high": 10, "low": -10}
-        adjusted_quality = min(max(quality + quality_adjust[quantization], 1), 100)
-
-        if format == "JPEG":
-            save_params["quality"] = adjusted_quality
-            save_params["progressive"] = progressive
-            save_params["optimize"] = True
-        elif format == "PNG":
-            save_params["compress_level"] = compression
-            save_params["optimize"] = True
-        elif format == "WEBP":
-            save_params["quality"] = adjusted_quality if not lossless else 100
-            save_params["lossless"] = lossless
-            save_params["method"] = 6  
-
-        if strip_metadata:
-            img.info = {}
-
-        current_quality = adjusted_quality
-        while current_quality >= 10:
-            output.seek(0)
-            output.truncate(0)
-            try:
-                img.save(output, format=format, **save_params)
-                size_kb = output.getbuffer().nbytes / 1024
-                if size_kb <= target_size_kb or format == "PNG" or lossless:
-                    break
-                current_quality -= 5
-                save_params["quality"] = current_quality
-            except Exception as e:
-                raise ValueError(f"Compression failed: {str(e)}")
+        adjusted_quality = self._adjusted_quality(quality, quantization)
+        try:
+            if format == "PNG" or lossless:
+                data = self._encode_full(format, None, compression, lossless, progressive)[1]
+            else:
+                data = self._fit_quality(target_size_kb * 1024, format, adjusted_quality, progressive)
+        except Exception as e:
+            raise ValueError(f"Compression failed: {str(e)}")
 
-        output.seek(0)
-        self.image = Image.open(output).convert("RGB")
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
-        return output.getvalue()
+        self.image = Image.open(io.BytesIO(data)).convert("RGB")
+        return data
 
     def get_compressed_size(self, format="JPEG", quality=80, compression=6, lossless=False, progressive=False, strip_metadata=False, quantization="standard"):
         """Estimate compressed file size without modifying the image."""
-        img = self.image.copy()
-        output = io.BytesIO()
-        save_params = {}
+        adjusted_quality = None if format == "PNG" or lossless else self._adjusted_quality(quality, quantization)
+        size, _ = self._encode_full(format, adjusted_quality, compression, lossless, progressive, keep=False)
+        return size / 1024
 
+    @staticmethod
+    def _adjusted_quality(quality, quantization):
         quality_adjust = {"standard": 0, "high": 10, "low": -10}
-        adjusted_quality = min(max(quality + quality_adjust[quantization], 1), 100)
+        return min(max(quality + quality_adjust[quantization], 1), 100)
 
+    @staticmethod
+    def _save_params(format, quality, compression, lossless, progressive):
         if format == "JPEG":
-            save_params["quality"] = adjusted_quality
-            save_params["progressive"] = progressive
-            save_params["optimize"] = True
-        elif format == "PNG":
-            save_params["compress_level"] = compression
-            save_params["optimize"] = True
-        elif format == "WEBP":
-            save_params["quality"] = adjusted_quality if not lossless else 100
-            save_params["lossless"] = lossless
-            save_params["method"] = 6
-
-        if strip_metadata:
-            img.info = {}
-
-        img.save(output, format=format, **save_params)
-        size_kb = output.getbuffer().nbytes / 1024
-        return size_kb
+            return {"quality": quality, "progressive": progressive, "optimize": True}
+        if format == "PNG":
+            return {"compress_level": compression, "optimize": True}
+        return {"quality": 100 if lossless else quality, "lossless": lossless, "method": 6}
+
+    def _size_curve(self, *key):
+        """Encoded sizes for the current frame, as ``{"full": {q: n}, "sample": {q: n}}``.
+
+        Curves are kept per encoder configuration and dropped when the frame
+        changes, so repeated size queries and targets reuse earlier encodes.
+        """
+        if self._size_curves.get("revision") != self.revision:
+            self._size_curves = {"revision": self.revision}
+        return self._size_curves.setdefault(key, {"full": {}, "sample": {}})
+
+    def _encode_full(self, format, quality, compression, lossless, progressive, keep=True):
+        """Return ``(size, data)`` of a full-resolution encode; ``data`` is None when cached."""
+        curve = self._size_curve(format, compression if format == "PNG" else 0, lossless, progressive)
+        if not keep and quality in curve["full"]:
+            return curve["full"][quality], None
+        output = io.BytesIO()
+        self.image.save(output, format=format, **self._save_params(format, quality, compression, lossless, progressive))
+        curve["full"][quality] = output.getbuffer().nbytes
+        return curve["full"][quality], output.getvalue()
+
+    def _sample_size(self, format, quality, progressive):
+        """Encoded size of a sample mosaic, scaled up by the pixel ratio.
+
+        The sample is a grid of full-resolution tiles rather than a
+        downscaled copy: shrinking the image changes its detail per pixel,
+        so a thumbnail's size-vs-quality curve has a different shape from
+        the full frame's, while native-resolution tiles track it closely.
+        """
+        curve = self._size_curve(format, 0, False, progressive)
+        if quality not in curve["sample"]:
+            if self._size_curves.get("sample") is None:
+                pixels = self._rgb()
+                height, width = pixels.shape[:2]
+                tile = _SIZE_SAMPLE_TILE
+                rows, cols = min(_SIZE_SAMPLE_GRID, height // tile), min(_SIZE_SAMPLE_GRID, width // tile)
+                if rows and cols and rows * cols * tile * tile < height * width:
+                    tops = np.linspace(0, height - tile, rows).astype(int) // 16 * 16
+                    lefts = np.linspace(0, width - tile, cols).astype(int) // 16 * 16
+                    sample = np.vstack([np.hstack([pixels[top:top + tile, left:left + tile] for left in lefts]) for top in tops])
+                else:
+                    sample = pixels
+                ratio = (height * width) / (sample.shape[0] * sample.shape[1])
+                self._size_curves["sample"] = (Image.fromarray(sample), ratio)
+            sample, ratio = self._size_curves["sample"]
+            output = io.BytesIO()
+            sample.save(output, format=format, **self._save_params(format, quality, 0, False, progressive))
+            curve["sample"][quality] = output.getbuffer().nbytes * ratio
+        return curve["sample"][quality]
+
+    def _fit_quality(self, target_bytes, format, max_quality, progressive):
+        """Encode at the highest quality in [10, max_quality] that fits ``target_bytes``.
+
+        The first probe is ``max_quality`` itself, which settles the common
+        already-small-enough case and calibrates the sample curve. Later
+        probes aim a little under the target so the search lands on the
+        fitting side. The search keeps one of the ``_MAX_SIZE_PROBES``
+        encodes back for the result. When nothing fits, the smallest encode
+        made is returned, quality 10 (or ``max_quality`` if lower) among them.
+        """
+        lowest = min(10, max_quality)
+        curve = self._size_curve(format, 0, False, progressive)["full"]
+        encoded = {}
+        for probe in range(_MAX_SIZE_PROBES - 1):
+            fits = [q for q, n in curve.items() if lowest <= q <= max_quality and n <= target_bytes]
+            misses = [q for q, n in curve.items() if lowest <= q <= max_quality and n > target_bytes]
+            floor = max(fits, default=lowest - 1)
+            ceiling = min(misses, default=max_quality + 1)
+            if ceiling - floor <= 1:
+                break
+            if max_quality not in curve:
+                quality = max_quality
+            else:
+                # Aim lower on the last probe if nothing has fitted yet.
+                aim = target_bytes * (0.9 if not fits and probe == _MAX_SIZE_PROBES - 2 else 0.97)
+                # Calibrate the sample curve with the full/sample ratios measured so far.
+                measured = sorted(curve)
+                ratios = [curve[q] / self._sample_size(format, q, progressive) for q in measured]
+                low, high = floor + 1, ceiling - 1
+                while low < high:
+                    middle = (low + high + 1) // 2
+                    correction = np.interp(middle, measured, ratios)
+                    if self._sample_size(format, middle, progressive) * correction <= aim:
+                        low = middle
+                    else:
+                        high = middle - 1
+                quality = low
+            encoded[quality] = self._encode_full(format, quality, 0, False, progressive)[1]
+        fits = [q for q, n in curve.items() if lowest <= q <= max_quality and n <= target_bytes]
+        if not fits:
+            if lowest not in encoded:
+                encoded[lowest] = self._encode_full(format, lowest, 0, False, progressive)[1]
+            return min(encoded.values(), key=len)
+        best = max(fits)
+        if best not in encoded:
+            encoded[best] = self._encode_full(format, best, 0, False, progressive)[1]
+        return encoded[best]
 
     def remove_red_eye(self):
         """Detect and remove red-eye effect."""
-        gray = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2GRAY)
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-        eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_eye.xml")
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        gray = cv2.cvtColor(self._rgb(), cv2.COLOR_RGB2GRAY)
+        faces = detect(FACE_CASCADE, gray, 1.3, 5)
+        if not len(faces):
+            return
+        pixels = self._writable()
         for (x, y, w, h) in faces:
             roi_gray = gray[y:y+h, x:x+w]
-            roi_color = self.cv_image[y:y+h, x:x+w]
-            eyes = eye_cascade.detectMultiScale(roi_gray)
+            roi_color = pixels[y:y+h, x:x+w]
+            eyes = detect(EYE_CASCADE, roi_gray)
             for (ex, ey, ew, eh) in eyes:
                 eye = roi_color[ey:ey+eh, ex:ex+ew]
-                b, g, r = cv2.split(eye)
+                r, g, b = (eye[:, :, i].astype(np.int16) for i in range(3))
                 red_mask = (r > 150) & (r > g + 20) & (r > b + 20)
-                eye[red_mask] = [b[red_mask], g[red_mask], g[red_mask]]
-                roi_color[ey:ey+eh, ex:ex+ew] = cv2.merge((b, g, r))
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+                eye[red_mask, 0] = eye[red_mask, 1]
+
+    def denoise(self, strength=10, tier="auto", budget=None):
+        """Advanced noise reduction.
 
-    def denoise(self, strength=10):
-        """Advanced noise reduction."""
+        ``tier`` is "fast", "balanced", "quality" or "auto", which picks the
+        best tier expected to finish within ``budget`` seconds (see
+        ``editor.utils.denoising``). The tier that ran is left in
+        ``denoise_tier``.
+        """
         if not 1 <= strength <= 30:
             raise ValueError("Strength must be between 1 and 30")
-        self.cv_image = cv2.fastNlMeansDenoisingColored(self.cv_image, None, strength, strength, 7, 21)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._denoise(strength, tier, budget)
+
+    def _denoise(self, strength, tier, budget):
+        height, width = self._pixels.shape[:2]
+        tier = denoising.resolve_tier(tier, width, height, budget)
+        self._commit_bgr(denoising.apply(self.cv_image, strength, tier))
+        self.denoise_tier = tier
 
     def perspective_correction(self, points):
         """Correct perspective using four points."""
@@ -575,23 +728,16 @@ class ImageProcessor:
         height = max(np.linalg.norm(src_pts[0] - src_pts[3]), np.linalg.norm(src_pts[1] - src_pts[2]))
         dst_pts = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
         matrix = cv2.getPerspectiveTransform(src_pts, dst_pts)
-        self.cv_image = cv2.warpPerspective(self.cv_image, matrix, (int(width), int(height)))
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(cv2.warpPerspective(self.pixels, matrix, (int(width), int(height))))
 
     def stitch_images(self, images):
         """Stitch multiple images into a panorama."""
-        imgs = [cv2.cvtColor(np.array(Image.open(img).convert("RGB")), cv2.COLOR_RGB2BGR) for img in images]
-        stitcher = cv2.Stitcher_create()
-        status, stitched = stitcher.stitch(imgs)
-        if status != cv2.Stitcher_OK:
-            raise ValueError("Stitching failed")
-        self.cv_image = stitched
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+        self._commit(_stitch_frame(images))
 
     def extract_text(self):
         """Extract text from image using Tesseract."""
+        import pytesseract
+
         try:
             text = pytesseract.image_to_string(self.image)
             return text.strip()
@@ -602,15 +748,18 @@ class ImageProcessor:
         """Highlight colors within hue range, desaturate others."""
         if not 0 <= hue_range[0] <= 180 or not 0 <= hue_range[1] <= 180:
             raise ValueError("Hue range must be between 0 and 180")
-        hsv = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2HSV)
-        mask = cv2.inRange(hsv, (hue_range[0], 50, 50), (hue_range[1], 255, 255))
-        gray = cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2GRAY)
-        gray = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-        gray_hsv = cv2.cvtColor(gray, cv2.COLOR_BGR2HSV)
-        hsv[np.logical_not(mask)] = gray_hsv[np.logical_not(mask)]
-        self.cv_image = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-        self.image = Image.fromarray(cv2.cvtColor(self.cv_image, cv2.COLOR_BGR2RGB))
-        self.layers[-1] = self.image.copy()
+
+        def pop(pixels):
+            hsv = cv2.cvtColor(pixels, cv2.COLOR_RGB2HSV)
+            inside = cv2.inRange(hsv, (hue_range[0], 50, 50), (hue_range[1], 255, 255))
+            # A gray pixel in HSV is (0, 0, luma), so there is no need to build
+            # a full gray frame just to convert it back to HSV.
+            hsv[:, :, 0] &= inside
+            hsv[:, :, 1] &= inside
+            np.copyto(hsv[:, :, 2], cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY), where=inside == 0)
+            return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB, dst=hsv)
+
+        self._commit(tiling.apply(pop, self._rgb()))
 
     def add_border(self, width, color="#ffffff"):
         """Add a border around the image."""
@@ -620,10 +769,113 @@ class ImageProcessor:
             r, g, b = tuple(int(color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
         except:
             raise ValueError("Invalid color format")
-        new_width = self.image.width + 2 * width
-        new_height = self.image.height + 2 * width
-        bordered = Image.new("RGB", (new_width, new_height), (r, g, b))
-        bordered.paste(self.image, (width, width))
-        self.image = bordered
-        self.cv_image = cv2.cvtColor(np.array(self.image), cv2.COLOR_RGB2BGR)
-        self.layers[-1] = self.image.copy()
+        pixels = self._rgb()
+        self._commit(cv2.copyMakeBorder(pixels, width, width, width, width, cv2.BORDER_CONSTANT, value=(r, g, b)))
+
+
+def _collage_frame(images, layout):
+    """RGB canvas of ``images`` laid out as ``layout`` (see ``ImageProcessor.from_collage``)."""
+    if layout not in ["2x2", "3x1", "1x3", "1x2", "2x1"]:
+        raise ValueError("Invalid layout")
+    if layout == "2x2":
+        rows, cols = 2, 2
+    elif layout == "3x1":
+        rows, cols = 3, 1
+    elif layout == "1x3":
+        rows, cols = 1, 3
+    elif layout == "1x2":
+        rows, cols = 1, 2
+    else:
+        rows, cols = 2, 1
+    images = images[:rows * cols]
+    sizes = [probe(img)[:2] for img in images]
+    cell_width = statistics.median_low(width for width, _ in sizes)
+    cell_height = statistics.median_low(height for _, height in sizes)
+    collage = mapped.allocate_frame((cell_height * rows, cell_width * cols, 3))
+    for i in range(rows * cols):
+        y, x = (i // cols) * cell_height, (i % cols) * cell_width
+        cell = collage[y:y + cell_height, x:x + cell_width]
+        if i >= len(images):
+            cell[...] = 255
+        else:
+            pixels, _ = decode(images[i], (cell_width, cell_height))
+            if pixels.shape[:2] != (cell_height, cell_width):
+                pixels = Image.fromarray(pixels).resize((cell_width, cell_height), Image.Resampling.LANCZOS)
+            cell[...] = pixels
+            del pixels
+        # Written pages stay in the file; drop them from this process.
+        mapped.release_rows(collage, y, y + cell_height)
+    return collage
+
+
+def _stitch_frame(images):
+    """RGB panorama stitched from ``images``."""
+    imgs = [cv2.cvtColor(decode(img)[0], cv2.COLOR_RGB2BGR) for img in images]
+    stitcher = cv2.Stitcher_create()
+    status, stitched = stitcher.stitch(imgs)
+    del imgs
+    if status != cv2.Stitcher_OK:
+        raise ValueError("Stitching failed")
+    height, width = stitched.shape[:2]
+    if not mapped.is_large(height, width):
+        cv2.cvtColor(stitched, cv2.COLOR_BGR2RGB, dst=stitched)
+        return stitched
+    # Keep the panorama disk-backed from here on; cv2 only returns it in
+    # memory.
+    pixels = mapped.allocate_frame((height, width, 3))
+
+    def convert(rows):
+        cv2.cvtColor(stitched[rows], cv2.COLOR_BGR2RGB, dst=pixels[rows])
+        mapped.release_rows(pixels, rows.start, rows.stop)
+
+    tiling.for_strips(convert, height, width)
+    return pixels
+
+
+def _grabcut(bgr, margin):
+    """Return a 0/255 foreground mask from 5 GrabCut iterations seeded with an inset rect."""
+    height, width = bgr.shape[:2]
+    mask = np.zeros((height, width), np.uint8)
+    bgd_model = np.zeros((1, 65), np.float64)
+    fgd_model = np.zeros((1, 65), np.float64)
+    rect = (margin, margin, width - 2 * margin, height - 2 * margin)
+    cv2.grabCut(bgr, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
+    return np.where((mask == cv2.GC_BGD) | (mask == cv2.GC_PR_BGD), 0, 255).astype(np.uint8)
+
+
+def _guided_filter(guide, src, radius, eps):
+    """Edge-preserving smoothing of ``src`` steered by ``guide`` (He et al.), both float32."""
+    size = (2 * radius + 1, 2 * radius + 1)
+    mean_i = cv2.boxFilter(guide, -1, size)
+    mean_p = cv2.boxFilter(src, -1, size)
+    cov_ip = cv2.boxFilter(guide * src, -1, size) - mean_i * mean_p
+    var_i = cv2.boxFilter(guide * guide, -1, size) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return cv2.boxFilter(a, -1, size) * guide + cv2.boxFilter(b, -1, size)
+
+
+def _refine_mask(rgb, coarse, scale):
+    """Upsample a proxy mask to ``rgb``'s size, refining a band around its edge.
+
+    The band is a couple of proxy pixels wide; inside it the alpha comes
+    from a guided filter over the full-resolution luma, elsewhere it is the
+    upsampled mask. Works strip by strip, so no full-frame float buffers.
+    """
+    height, width = rgb.shape[:2]
+    radius = max(2, int(np.ceil(1.5 / scale)))
+    upsampled = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_LINEAR)
+    cv2.threshold(upsampled, 127, 255, cv2.THRESH_BINARY, dst=upsampled)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+    guide_and_mask = np.dstack((cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY), upsampled))
+
+    def refine(strip):
+        mask = strip[..., 1]
+        band = cv2.dilate(mask, kernel) != cv2.erode(mask, kernel)
+        guide = strip[..., 0].astype(np.float32) / 255
+        smooth = _guided_filter(guide, mask.astype(np.float32) / 255, radius, 1e-2)
+        alpha = mask.copy()
+        alpha[band] = np.clip(smooth[band] * 255 + 0.5, 0, 255).astype(np.uint8)
+        return alpha
+
+    return tiling.apply(refine, guide_and_mask, halo=3 * radius + 1)
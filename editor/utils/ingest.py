@@ -0,0 +1,114 @@
+"""Header-first image decoding with a pixel budget.
+
+``probe`` reads only the image header, so oversized uploads are rejected
+before any pixel is decoded. ``decode`` then picks the cheapest route to
+an RGB uint8 array: JPEG DCT scaling via PIL's ``draft()`` when the caller
+only needs a smaller image, or cv2 straight into a NumPy buffer for
+common formats, which avoids PIL's 4-byte-per-pixel frame and the
+``tobytes`` copy behind ``np.asarray``. cv2 reads uploads Django spooled to
+disk from their temporary file, so only small uploads are held in memory
+as encoded bytes.
+"""
+import math
+
+from django.conf import settings
+
+from . import mapped, metrics
+from .lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+# Formats and modes cv2 decodes to the same pixels PIL's convert("RGB") gives.
+_CV2_MODES = {"JPEG": {"RGB", "L"}, "PNG": {"RGB", "RGBA", "L"}, "WEBP": {"RGB", "RGBA"}}
+
+
+class ImageTooLarge(ValueError):
+    """Raised when an image exceeds ``MAX_IMAGE_MEGAPIXELS``."""
+
+
+def check_dimensions(width, height):
+    limit = settings.MAX_IMAGE_MEGAPIXELS * 1_000_000
+    if width * height > limit:
+        raise ImageTooLarge(
+            f"Image is {width}x{height} ({width * height / 1e6:.1f} MP); "
+            f"the limit is {settings.MAX_IMAGE_MEGAPIXELS} MP")
+
+
+def _open(image_file):
+    """``Image.open``, reporting Pillow's decompression bomb check as ``ImageTooLarge``."""
+    try:
+        return Image.open(image_file)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e)) from e
+
+
+def probe(image_file):
+    """Return ``(width, height, format)`` from the header, enforcing the pixel budget."""
+    with _open(image_file) as img:
+        size, format = img.size, img.format
+    _rewind(image_file)
+    check_dimensions(*size)
+    return size[0], size[1], format
+
+
+def decode(image_file, draft_size=None):
+    """Decode ``image_file`` (a path or file object) to ``(pixels, scale)``.
+
+    ``pixels`` is an RGB uint8 array and ``scale`` its width relative to
+    the original (1.0 unless a draft decode kicked in).
+
+    ``draft_size`` is the smallest ``(width, height)`` the caller needs, or
+    an int for the longest edge; JPEGs are then decoded at the smallest
+    1/2, 1/4 or 1/8 scale that still covers it. The returned array may be
+    larger than ``draft_size``.
+    """
+    with metrics.track("decode") as record:
+        pixels, scale = _decode(image_file, draft_size)
+        record["megapixels"] = pixels.shape[0] * pixels.shape[1] / 1e6
+        record["output_bytes"] = pixels.nbytes
+    return pixels, scale
+
+
+def _decode(image_file, draft_size):
+    with _open(image_file) as img:
+        width, height = img.size
+        check_dimensions(width, height)
+        if draft_size and img.format == "JPEG":
+            if isinstance(draft_size, int):
+                scale = draft_size / max(width, height)
+                draft_size = (math.ceil(width * scale), math.ceil(height * scale))
+            img.draft("RGB", draft_size)
+        elif img.mode in _CV2_MODES.get(img.format, ()):
+            pixels = _cv2_decode(image_file)
+            if pixels is not None:
+                return pixels, 1.0
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return np.asarray(img), img.size[0] / width
+
+
+def _cv2_decode(image_file):
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    if isinstance(image_file, str):
+        bgr = cv2.imread(image_file, flags)
+    elif hasattr(image_file, "temporary_file_path"):
+        # Django spooled the upload to disk; decode from there instead of
+        # reading it all into memory first.
+        bgr = cv2.imread(image_file.temporary_file_path(), flags)
+    else:
+        # In memory already (uploads under FILE_UPLOAD_MAX_MEMORY_SIZE).
+        _rewind(image_file)
+        bgr = cv2.imdecode(np.frombuffer(image_file.read(), np.uint8), flags)
+    if bgr is None:
+        return None
+    # Swap channels in place, or into the frame an allocator hands out
+    # (e.g. shared memory, see ``frames.load``).
+    dst = mapped.allocate_frame(bgr.shape) if mapped.redirected() else bgr
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=dst)
+
+
+def _rewind(image_file):
+    if hasattr(image_file, "seek"):
+        image_file.seek(0)
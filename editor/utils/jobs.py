@@ -0,0 +1,160 @@
+"""Background jobs for slow tools, with progress polling.
+
+Heavy operations (GrabCut, NL-means, stitching, ...) run on a small
+in-process worker pool instead of blocking the request. Job state and
+results are written to ``MEDIA_ROOT/jobs`` so any worker process can
+answer ``/jobs/<id>`` polls. Admission is bounded: once ``JOB_WORKERS``
+jobs are running and ``JOB_QUEUE_SIZE`` are waiting, ``submit`` raises
+``QueueFull`` so a burst of heavy requests is turned away instead of
+piling up behind the cheap endpoints.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    """Raised when the job queue has no free slot."""
+
+
+class Job:
+    """Handle passed to a job function for reporting progress."""
+
+    def __init__(self, queue, record):
+        self._queue = queue
+        self.id = record["id"]
+        self.record = record
+
+    def progress(self, fraction, stage=None):
+        self.record["progress"] = round(min(max(fraction, 0.0), 1.0), 3)
+        if stage:
+            self.record["stage"] = stage
+        self._queue._write(self.record)
+
+
+class JobQueue:
+    """Bounded worker pool with filesystem-backed job records."""
+
+    def __init__(self, root, workers, queue_size, ttl_seconds):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._last_sweep = 0.0
+
+    def submit(self, fn, tool, owner=None):
+        """Queue ``fn(job)`` and return the new job record.
+
+        ``fn`` returns ``(data, content_type)`` or ``(data, content_type,
+        meta)``; ``meta`` is merged into the finished record.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull("Too many jobs queued, try again shortly")
+        self._sweep()
+        now = time.time()
+        record = {
+            "id": str(uuid.uuid4()),
+            "tool": tool,
+            "owner": owner,
+            "status": QUEUED,
+            "progress": 0.0,
+            "stage": None,
+            "error": None,
+            "content_type": None,
+            "created": now,
+            "updated": now,
+        }
+        self._write(record)
+        try:
+            self._executor.submit(self._run, fn, record)
+        except BaseException:
+            self._slots.release()
+            raise
+        return record
+
+    def get(self, job_id):
+        """Return the record for ``job_id`` or ``None``."""
+        try:
+            with open(self._path(job_id, "json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def result_path(self, job_id):
+        return self._path(job_id, "bin")
+
+    def _run(self, fn, record):
+        job = Job(self, record)
+        try:
+            record["status"] = RUNNING
+            self._write(record)
+            result = fn(job)
+            data, content_type = result[:2]
+            if len(result) > 2:
+                record.update(result[2])
+            self._write_result(record["id"], data)
+            record.update(status=DONE, progress=1.0, stage=None, content_type=content_type)
+        except Exception as e:
+            logger.error("Job %s (%s) failed: %s", record["id"], record["tool"], str(e))
+            record.update(status=FAILED, error=str(e))
+        finally:
+            self._write(record)
+            self._slots.release()
+
+    def _path(self, job_id, ext):
+        return os.path.join(self.root, f"{job_id}.{ext}")
+
+    def _write(self, record):
+        record["updated"] = time.time()
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(record["id"], "json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp, path)
+
+    def _write_result(self, job_id, data):
+        path = self.result_path(job_id)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _sweep(self):
+        """Delete records and results older than the TTL, at most once a minute."""
+        now = time.time()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl_seconds:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+jobs = JobQueue(
+    root=os.path.join(settings.MEDIA_ROOT, "jobs"),
+    workers=settings.JOB_WORKERS,
+    queue_size=settings.JOB_QUEUE_SIZE,
+    ttl_seconds=settings.JOB_TTL_SECONDS,
+)
@@ -0,0 +1,62 @@
+"""Deferred imports for the heavy imaging libraries.
+
+NumPy, OpenCV and Pillow take most of a worker's start-up time, while
+pages like ``index`` and ``studio`` only render templates. Modules here
+bind them through ``lazy_import``, which returns a stand-in that imports
+the real module on first attribute access. Importing the URL conf therefore
+loads none of them. ``preload`` imports everything eagerly. gunicorn.conf.py
+calls it when the app is preloaded, so forked workers share those pages
+copy-on-write instead of each importing them.
+"""
+import importlib
+import threading
+
+# Imported by preload(), slowest first.
+HEAVY_MODULES = ("numpy", "cv2", "PIL.Image", "PIL.ImageDraw", "PIL.ImageFilter", "PIL.ImageFont")
+
+_lock = threading.Lock()
+
+
+class LazyModule:
+    """Proxy for a module that is imported the first time one of its attributes is used.
+
+    Attributes are copied onto the proxy as they are looked up, so only the
+    first access of each name goes through ``__getattr__``.
+    """
+
+    def __init__(self, name):
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            with _lock:
+                if self._lazy_module is None:
+                    self._lazy_module = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    def __getattr__(self, attr):
+        if attr.startswith("_lazy_"):
+            raise AttributeError(attr)
+        value = getattr(self._load(), attr)
+        setattr(self, attr, value)
+        return value
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._lazy_module is not None else "not loaded"
+        return f"<lazy module {self._lazy_name!r} ({state})>"
+
+
+def lazy_import(name):
+    """Return a ``LazyModule`` for ``name``."""
+    return LazyModule(name)
+
+
+def preload():
+    """Import the heavy libraries and every editor.utils module now."""
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+    importlib.import_module("editor.views")
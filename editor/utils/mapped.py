@@ -0,0 +1,108 @@
+"""Disk-backed buffers for very large frames.
+
+Frames of at least ``LARGE_FRAME_MEGAPIXELS`` (collage canvases, stitched
+panoramas, the output of tiled filters) are allocated in a memory-mapped
+file under ``LARGE_FRAME_DIR`` instead of anonymous memory. The file is
+unlinked as soon as it is mapped, so it disappears with the last array
+using it, even if the process is killed. Its pages are page cache that the
+kernel can write back and reclaim under pressure, instead of anonymous
+memory that can only be swapped or OOM-killed.
+
+Code that fills or reads a mapped frame strip by strip calls
+``release_rows`` when it is done with a strip. That drops the strip's pages
+from the process, so resident memory stays near one strip per worker
+rather than the whole frame. The data stays in the page cache and comes
+back on the next access.
+
+Inside ``allocating(fn)``, frames below the threshold come from ``fn``
+instead of the heap; ``frames`` uses this to have operations write their
+output straight into shared memory.
+"""
+import contextvars
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+
+_allocator = contextvars.ContextVar("frame_allocator", default=None)
+
+
+def is_large(height, width):
+    """True if a ``height`` x ``width`` frame should be disk-backed."""
+    threshold = settings.LARGE_FRAME_MEGAPIXELS
+    return threshold > 0 and height * width >= threshold * 1_000_000
+
+
+@contextmanager
+def allocating(fn):
+    """Have ``allocate_frame`` take frames that aren't large from ``fn(shape, dtype)``."""
+    token = _allocator.set(fn)
+    try:
+        yield
+    finally:
+        _allocator.reset(token)
+
+
+def redirected():
+    """True inside ``allocating``."""
+    return _allocator.get() is not None
+
+
+def allocate_frame(shape, dtype="uint8"):
+    """Uninitialised array of ``shape``, file-backed if the frame is large.
+
+    Like ``np.memmap`` over a temporary file, but the file is already
+    unlinked and the mapping is kept as the array's base for
+    ``release_rows``. Mapped frames start out zeroed.
+    """
+    dtype = np.dtype(dtype)
+    if len(shape) < 2 or not is_large(shape[0], shape[1]):
+        allocator = _allocator.get()
+        return allocator(shape, dtype) if allocator else np.empty(shape, dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    os.makedirs(settings.LARGE_FRAME_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="frame-", dir=settings.LARGE_FRAME_DIR)
+    try:
+        os.unlink(path)
+        os.ftruncate(fd, size)
+        mapping = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    return np.ndarray(shape, dtype, buffer=mapping)
+
+
+def _mapping(array):
+    base = array
+    while base is not None and not isinstance(base, mmap.mmap):
+        base = getattr(base, "base", None)
+    return base
+
+
+def is_mapped(array):
+    return _mapping(array) is not None
+
+
+def release_rows(array, top, bottom):
+    """Drop rows ``top:bottom`` of a mapped frame from resident memory.
+
+    Only whole pages inside the rows are released, so strips sharing a page
+    with a neighbour never lose each other's writes. Does nothing for
+    in-memory arrays or views that aren't whole-row slices of a mapping.
+    """
+    mapping = _mapping(array)
+    if mapping is None or not array.flags.c_contiguous or bottom <= top:
+        return
+    row_bytes = array.strides[0]
+    offset = array.__array_interface__["data"][0] - np.frombuffer(mapping, np.uint8, 1).ctypes.data
+    start = offset + top * row_bytes
+    stop = offset + bottom * row_bytes
+    start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+    stop = stop // mmap.PAGESIZE * mmap.PAGESIZE
+    if stop > start:
+        mapping.madvise(mmap.MADV_DONTNEED, start, stop - start)
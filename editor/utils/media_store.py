@@ -0,0 +1,268 @@
+"""Content-addressed storage for uploaded studio images.
+
+Each upload is hashed while it streams to disk and stored once under
+``MEDIA_ROOT/objects/ab/cd/<sha256>.<ext>``. A session refers to it
+through a hard link at ``MEDIA_ROOT/refs/<key[:2]>/<key>/<sha256>.<ext>``,
+and that relative path is what ``session["studio_image"]`` holds, so
+``get_studio_image`` and the working-image store read it like any other
+file. The link count of the object is its reference count: an object
+whose only link is its own path is unreferenced and can go. Because a
+reference is a link to the same inode, deleting an object never breaks a
+session that still refers to it.
+
+``cleanup`` drops references whose session has expired or moved on to
+another image (least recently used sessions first), the working-image
+spills and edit histories that belonged to them, and unreferenced objects.
+It runs from ``manage.py cleanup_media``. ``MEDIA_STORAGE_BYTES`` is the
+budget for everything the app keeps on disk, including the result cache
+and job results, which also trim themselves to their own limits. When an
+upload would exceed it, the upload is refused and a cleanup starts on a
+background thread, because checking sessions loads each one from the
+session backend. Objects, references and the temporary directory must be
+on one filesystem.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from importlib import import_module
+
+from django.conf import settings
+from django.db import connection
+
+from .session_store import working_images
+
+logger = logging.getLogger(__name__)
+
+# Extensions for the formats probe() reports.
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "BMP": "bmp", "TIFF": "tiff"}
+
+
+class StorageFull(Exception):
+    """Raised when an upload doesn't fit in the storage budget."""
+
+
+def session_is_live(session_key, source):
+    """True if the session still exists and ``source`` is its current studio image."""
+    engine = import_module(settings.SESSION_ENGINE)
+    return engine.SessionStore(session_key).load().get("studio_image") == source
+
+
+class MediaStore:
+    """Deduplicated upload storage with link-count references and a byte budget."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, "objects")
+        self.refs = os.path.join(root, "refs")
+        self.tmp = os.path.join(root, "tmp")
+        self._lock = threading.Lock()
+        self._usage = None
+        self._cleaning = False
+
+    def store(self, upload, session_key, format):
+        """Store ``upload`` for ``session_key`` and return its path relative to the root.
+
+        ``format`` is the PIL format name from ``probe``. Identical bytes
+        are stored once; the session gets a new reference to the object.
+        """
+        size = upload.size or 0
+        if self.usage() + size > self.max_bytes:
+            self.cleanup_in_background(target_bytes=self.max_bytes * 0.9 - size)
+            raise StorageFull("Image storage is full, try again later")
+
+        os.makedirs(self.tmp, exist_ok=True)
+        tmp = os.path.join(self.tmp, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        with open(tmp, "wb") as f:
+            for chunk in upload.chunks():
+                digest.update(chunk)
+                f.write(chunk)
+        name = f"{digest.hexdigest()}.{EXTENSIONS.get(format, 'img')}"
+        obj = self._object_path(name)
+        ref = os.path.join(self.refs, session_key[:2], session_key, name)
+        os.makedirs(os.path.dirname(ref), exist_ok=True)
+
+        # The temporary file keeps a link to new content until the reference
+        # exists, so cleanup never sees the object unreferenced.
+        created = False
+        try:
+            while True:
+                try:
+                    os.link(obj, ref)
+                except FileExistsError:
+                    # This session already holds the same image.
+                    break
+                except FileNotFoundError:
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    try:
+                        os.link(tmp, obj)
+                        created = True
+                        self._add_usage(size)
+                    except FileExistsError:
+                        # A concurrent upload of the same bytes created it first.
+                        pass
+                    continue
+                if not created:
+                    logger.info("Deduplicated upload %s", name)
+                break
+        finally:
+            os.remove(tmp)
+        self.touch(os.path.relpath(ref, self.root))
+        return os.path.relpath(ref, self.root)
+
+    def release(self, source):
+        """Drop a reference returned by ``store``; returns the bytes freed."""
+        if not source.startswith("refs" + os.sep):
+            return 0
+        path = os.path.join(self.root, source)
+        freed = working_images.remove_spill(source)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return freed
+        obj = self._object_path(os.path.basename(path))
+        try:
+            stat = os.stat(obj)
+            if stat.st_nlink == 1:
+                os.remove(obj)
+                freed += stat.st_size
+        except FileNotFoundError:
+            pass
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        self._add_usage(-freed)
+        return freed
+
+    def touch(self, source):
+        """Mark the session owning ``source`` as recently used."""
+        if source.startswith("refs" + os.sep):
+            try:
+                os.utime(os.path.dirname(os.path.join(self.root, source)))
+            except FileNotFoundError:
+                pass
+
+    def usage(self, refresh=False):
+        """Bytes on disk under the root and the working directories (rescanned at most once a minute).
+
+        Besides objects, that is working-image spills and histories, job
+        results, the result cache and large-frame files, wherever they are
+        configured. Each file is counted once however many links it has.
+        """
+        with self._lock:
+            if refresh or self._usage is None or time.monotonic() - self._usage[1] > 60:
+                total = _tree_size(self.root, working_images.spill_dir, working_images.history_dir,
+                                   settings.RESULT_CACHE_DIR, settings.LARGE_FRAME_DIR)
+                self._usage = [total, time.monotonic()]
+            return self._usage[0]
+
+    def cleanup_in_background(self, target_bytes):
+        """Start ``cleanup(target_bytes)`` on a daemon thread unless one is already running."""
+        with self._lock:
+            if self._cleaning:
+                return
+            self._cleaning = True
+
+        def run():
+            try:
+                self.cleanup(target_bytes=target_bytes)
+            except Exception:
+                logger.exception("Background media cleanup failed")
+            finally:
+                connection.close()
+                with self._lock:
+                    self._cleaning = False
+
+        threading.Thread(target=run, name="media-cleanup", daemon=True).start()
+
+    def cleanup(self, target_bytes=None, legacy_age=None, is_live=session_is_live):
+        """Release dead references, oldest sessions first, and delete orphans.
+
+        With ``target_bytes`` it stops once usage is at or below it. Without,
+        it checks every session and also deletes unreferenced objects, spills
+        whose source is gone and, if ``legacy_age`` is given, top-level
+        uploads from before this store older than that many seconds.
+        Returns counters.
+        """
+        stats = {"sessions": 0, "released": 0, "objects": 0, "legacy": 0, "spills": 0, "bytes_freed": 0}
+        for _, key, directory in sorted(self._sessions()):
+            if target_bytes is not None and self.usage() <= target_bytes:
+                return stats
+            stats["sessions"] += 1
+            for name in os.listdir(directory):
+                source = os.path.relpath(os.path.join(directory, name), self.root)
+                if not is_live(key, source):
+                    stats["bytes_freed"] += self.release(source)
+                    stats["released"] += 1
+        if target_bytes is not None:
+            return stats
+
+        for path, stat in _walk(self.objects):
+            if stat.st_nlink == 1:
+                os.remove(path)
+                stats["objects"] += 1
+                stats["bytes_freed"] += stat.st_size
+        if legacy_age is not None:
+            now = time.time()
+            for entry in os.scandir(self.root):
+                content_type, _ = mimetypes.guess_type(entry.name)
+                if (entry.is_file() and content_type and content_type.startswith("image/")
+                        and now - entry.stat().st_mtime > legacy_age):
+                    os.remove(entry.path)
+                    working_images.remove_spill(entry.name)
+                    stats["legacy"] += 1
+        spills, freed = working_images.sweep_spills()
+        stats["spills"] += spills
+        stats["bytes_freed"] += freed
+        self.usage(refresh=True)
+        return stats
+
+    def _sessions(self):
+        """Yield ``(last_used, session_key, directory)`` for every session with references."""
+        if not os.path.isdir(self.refs):
+            return
+        for shard in os.scandir(self.refs):
+            if not shard.is_dir():
+                continue
+            for session in os.scandir(shard.path):
+                if session.is_dir():
+                    yield session.stat().st_mtime, session.name, session.path
+
+    def _object_path(self, name):
+        return os.path.join(self.objects, name[:2], name[2:4], name)
+
+    def _add_usage(self, nbytes):
+        with self._lock:
+            if self._usage is not None:
+                self._usage[0] += nbytes
+
+
+def _walk(root):
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            try:
+                yield path, os.stat(path)
+            except FileNotFoundError:
+                pass
+
+
+def _tree_size(*roots):
+    """Total size of the files under ``roots``, counting each inode once."""
+    sizes = {}
+    for root in roots:
+        for _, stat in _walk(root):
+            sizes[stat.st_dev, stat.st_ino] = stat.st_size
+    return sum(sizes.values())
+
+
+media_store = MediaStore(
+    root=settings.MEDIA_ROOT,
+    max_bytes=settings.MEDIA_STORAGE_BYTES,
+)
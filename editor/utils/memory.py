@@ -0,0 +1,43 @@
+"""Resident memory of this process, for metrics and the benchmark commands.
+
+Reads ``/proc/self/status`` where it exists (Linux) and falls back to
+``getrusage``, whose maximum RSS can't be reset.
+"""
+import resource
+
+
+def _proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_kb():
+    """Resident set size of this process in KiB."""
+    rss = _proc_status("VmRSS")
+    return rss if rss is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_rss_kb():
+    """High-water resident set size of this process in KiB."""
+    peak = _proc_status("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    """Reset the RSS high-water mark where the kernel allows it.
+
+    Returns False when the peak cannot be reset, in which case the peak
+    reported afterwards still includes everything before the call.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,215 @@
+"""Latency, size and memory metrics for requests and image operations.
+
+``track(name, megapixels)`` times a block: decode (``ingest.decode``),
+every public ``ImageProcessor`` operation (see ``instrument``) and encode
+(``encoding.encode``). Each tracked block records four histograms, all
+labelled by operation:
+
+- duration
+- input megapixels
+- peak memory growth
+- output bytes (the pixel buffer after an edit, or the encoded file)
+
+Blocks nested inside another tracked block, like ``auto_enhance`` calling
+``point_ops``, count towards the outer one only. ``MetricsMiddleware``
+adds the total request time per view, and answers with a ``Server-Timing``
+header that lists the request's tracked blocks.
+
+Peak memory is the growth of the process's resident high-water mark over
+the resident size at the start of the block. The mark is reset through
+``/proc/self/clear_refs`` (see ``memory.reset_peak_rss``), so this is
+Linux-only and includes cv2's internal buffers. It is skipped elsewhere.
+Resetting and reading the mark costs two ``/proc`` round trips, so only
+one operation in ``METRICS_MEMORY_SAMPLE_EVERY`` is measured. Concurrent
+requests in one process share the mark, so treat it as an upper bound.
+
+``render()`` returns everything in the Prometheus text format for
+``/metrics``, plus the values of registered collectors (cache and queue
+statistics). Each worker process keeps its own metrics, so scrape every
+worker or run one per container.
+"""
+import contextvars
+import inspect
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+from .memory import current_rss_kb, peak_rss_kb, reset_peak_rss
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MEGAPIXEL_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 12, 16, 24, 48)
+BYTE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(9))  # 64 KB to 4 GB
+
+# ImageProcessor methods that aren't edits; encode is tracked on its own.
+_UNTRACKED = {"preview", "save_preview", "save_image"}
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values."""
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for label_values, (counts, total, count) in sorted(series.items()):
+            labels = "".join(f'{name}="{_escape(value)}",' for name, value in zip(self.labels, label_values))
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {count}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total!r}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+request_seconds = Histogram("clarifi_request_seconds", "Time to build the response, by view.",
+                            DURATION_BUCKETS, ("view", "method", "status"))
+operation_seconds = Histogram("clarifi_operation_seconds", "Time spent in decode, encode and each image operation.",
+                              DURATION_BUCKETS, ("operation",))
+operation_megapixels = Histogram("clarifi_operation_input_megapixels", "Size of the frame an operation started from.",
+                                 MEGAPIXEL_BUCKETS, ("operation",))
+operation_peak_bytes = Histogram("clarifi_operation_peak_bytes", "Growth of resident memory during an operation.",
+                                 BYTE_BUCKETS, ("operation",))
+operation_output_bytes = Histogram("clarifi_operation_output_bytes",
+                                   "Size of an operation's result: pixel buffer, or encoded bytes for encode.",
+                                   BYTE_BUCKETS, ("operation",))
+HISTOGRAMS = [request_seconds, operation_seconds, operation_megapixels, operation_peak_bytes, operation_output_bytes]
+
+_collectors = []
+
+
+def register_collector(collect):
+    """Add ``collect()`` to ``/metrics``; it returns ``[(name, type, help, value), ...]``."""
+    _collectors.append(collect)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for collect in _collectors:
+        for name, kind, help, value in collect():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value!r}"]
+    return "\n".join(lines) + "\n"
+
+
+# Tracked blocks of the current request, as (name, seconds), for Server-Timing.
+_timings = contextvars.ContextVar("metrics_timings", default=None)
+_local = threading.local()
+# Counts tracked blocks to pick the ones whose peak memory is measured.
+_blocks = itertools.count()
+
+
+@contextmanager
+def track(name, megapixels=0.0):
+    """Record the enclosed block as operation ``name``.
+
+    Yields a dict; set ``"output_bytes"`` in it to record the result size,
+    or ``"megapixels"`` if the input size is only known inside the block.
+    """
+    record = {}
+    if getattr(_local, "depth", 0):
+        yield record
+        return
+    _local.depth = 1
+    every = settings.METRICS_MEMORY_SAMPLE_EVERY
+    sampled = every > 0 and next(_blocks) % every == 0
+    before = current_rss_kb() if sampled and reset_peak_rss() else None
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        _local.depth = 0
+        operation_seconds.observe(seconds, name)
+        operation_megapixels.observe(record.get("megapixels", megapixels), name)
+        if before is not None:
+            operation_peak_bytes.observe(max(0, peak_rss_kb() - before) * 1024, name)
+        if "output_bytes" in record:
+            operation_output_bytes.observe(record["output_bytes"], name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, seconds))
+
+
+def operation(name, method):
+    """Wrap an ``ImageProcessor`` method so each call is tracked as ``name``."""
+    @wraps(method)
+    def tracked(self, *args, **kwargs):
+        height, width = self.pixels.shape[:2]
+        with track(name, width * height / 1e6) as record:
+            result = method(self, *args, **kwargs)
+            record["output_bytes"] = self.pixels.nbytes
+        return result
+    return tracked
+
+
+def instrument(cls):
+    """Class decorator tracking every public instance method except previews and saving."""
+    for name, member in list(vars(cls).items()):
+        if inspect.isfunction(member) and not name.startswith("_") and name not in _UNTRACKED:
+            setattr(cls, name, operation(name, member))
+    return cls
+
+
+def start_request():
+    """Begin collecting Server-Timing entries; returns the token for ``end_request``."""
+    return _timings.set([])
+
+
+def end_request(token):
+    """Stop collecting and return the request's ``[(name, seconds), ...]``."""
+    timings = _timings.get()
+    _timings.reset(token)
+    return timings or []
+
+
+def request_timings():
+    """The Server-Timing entries recorded so far in this request, as a list copy."""
+    return list(_timings.get() or [])
+
+
+def add_timings(timings):
+    """Report ``[(name, seconds), ...]`` in this request's Server-Timing."""
+    current = _timings.get()
+    if current is not None:
+        current.extend((name, seconds) for name, seconds in timings)
+
+
+def server_timing(timings, total):
+    """Format a ``Server-Timing`` header; repeated operations are summed."""
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0.0) + seconds
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
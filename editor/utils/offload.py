@@ -0,0 +1,210 @@
+"""Async tool views: blocking work on a bounded pool, connections on the event loop.
+
+Under ASGI, Django runs every sync view on one shared thread, so a single
+slow stitch holds up the whole process. ``offload(endpoint)`` turns a sync
+view into an async one instead. Django's ASGI handler has already read the
+request body on the event loop by the time the view runs. The view itself
+(form parsing, decoding, the ``ImageProcessor`` work, encoding) runs on a
+pool of ``OFFLOAD_WORKERS`` threads. Streaming responses are read chunk by
+chunk on the pool and sent from the loop, so slow clients only cost a
+connection.
+
+``OFFLOAD_LIMITS`` caps how many requests of one endpoint run at once
+(the rest wait on the loop without holding a thread), leaving threads for
+cheap edits while heavy tools are busy. Once ``OFFLOAD_MAX_WAITING``
+requests wait for the same endpoint, further ones get a 503. A request
+keeps its endpoint slot until its response has been streamed, because
+``batch`` does its work while streaming, and until its view returns even
+if the client has gone.
+
+Under WSGI the wrapped views still work; Django runs them through
+``async_to_sync`` and the limits apply across request threads.
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import JsonResponse
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_limiters = {}
+_lock = threading.Lock()
+
+
+class Busy(Exception):
+    """Raised when too many requests are already waiting for an endpoint."""
+
+
+class Limiter:
+    """Counting semaphore that async callers wait on from any event loop.
+
+    ``asyncio.Semaphore`` belongs to one loop, but under WSGI every request
+    gets its own, so waiters park on a future of their loop and are woken
+    through ``call_soon_threadsafe``.
+    """
+
+    def __init__(self, limit, max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return
+            if len(self._waiters) >= self.max_waiting:
+                raise Busy("Server busy, try again shortly")
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await waiter
+        except BaseException:
+            with self._lock:
+                if (loop, waiter) in self._waiters:
+                    self._waiters.remove((loop, waiter))
+                    raise
+            # Woken and cancelled at once: the slot is ours, hand it on.
+            self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            # The slot passes straight to the next waiter; ``active`` is unchanged.
+            loop, waiter = self._waiters.popleft()
+        loop.call_soon_threadsafe(_wake, waiter)
+
+    def stats(self):
+        with self._lock:
+            return self.active, len(self._waiters)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.OFFLOAD_WORKERS, thread_name_prefix="offload")
+        return _pool
+
+
+def limiter(endpoint):
+    """The ``Limiter`` for ``endpoint``, or ``None`` if it isn't in ``OFFLOAD_LIMITS``."""
+    limit = settings.OFFLOAD_LIMITS.get(endpoint)
+    if limit is None:
+        return None
+    with _lock:
+        if endpoint not in _limiters:
+            _limiters[endpoint] = Limiter(limit, settings.OFFLOAD_MAX_WAITING)
+        return _limiters[endpoint]
+
+
+def submit(fn, *args, **kwargs):
+    """Run ``fn`` on the pool with the caller's context (for Server-Timing); returns an asyncio future."""
+    context = contextvars.copy_context()
+
+    def call():
+        try:
+            return context.run(fn, *args, **kwargs)
+        finally:
+            # Pool threads outlive requests; close connections like a request thread would.
+            close_old_connections()
+
+    return asyncio.get_running_loop().run_in_executor(_get_pool(), call)
+
+
+async def _stream(chunks):
+    """Read a sync iterator on the pool and yield its chunks on the loop."""
+    done = object()
+    while True:
+        chunk = await submit(next, chunks, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+def _hold(request, response, release):
+    """Release the endpoint slot now, or once a streamed response has been sent and closed."""
+    if not response.streaming:
+        release()
+        return
+    if isinstance(request, ASGIRequest) and not response.is_async:
+        response.streaming_content = _stream(iter(response.streaming_content))
+    response._resource_closers.append(release)
+
+
+def _abandoned(request, future, release):
+    """Clean up after a view whose client disconnected while it ran."""
+    if future.cancelled() or future.exception() is not None:
+        release()
+        return
+    response = future.result()
+    _hold(request, response, release)
+    response.close()
+
+
+def offload(endpoint):
+    """Make a sync view async, running it on the pool under ``endpoint``'s limit."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            slots = limiter(endpoint)
+            if slots is not None:
+                try:
+                    await slots.acquire()
+                except Busy as e:
+                    logger.error("Too many %s requests waiting", endpoint)
+                    response = JsonResponse({"error": str(e)}, status=503)
+                    response["Retry-After"] = "5"
+                    return response
+            release = slots.release if slots is not None else lambda: None
+            future = submit(view, request, *args, **kwargs)
+            try:
+                response = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The thread can't be stopped; keep the slot until the view returns.
+                future.add_done_callback(lambda done: _abandoned(request, done, release))
+                raise
+            except BaseException:
+                release()
+                raise
+            _hold(request, response, release)
+            return response
+        return wrapper
+    return decorator
+
+
+def _collect():
+    active = waiting = 0
+    for endpoint in settings.OFFLOAD_LIMITS:
+        counts = limiter(endpoint).stats()
+        active += counts[0]
+        waiting += counts[1]
+    return [
+        ("clarifi_offload_active", "gauge", "Requests of rate-limited endpoints running on the offload pool.", active),
+        ("clarifi_offload_waiting", "gauge", "Requests waiting for an endpoint slot.", waiting),
+    ]
+
+
+metrics.register_collector(_collect)
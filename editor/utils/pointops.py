@@ -0,0 +1,189 @@
+"""Fuse chains of per-pixel colour operations into single passes.
+
+Brightness, contrast, saturation, grayscale and sepia each look at one
+pixel at a time, so a run of them doesn't need a full frame per step.
+``apply`` folds consecutive operations into stages made of a per-channel
+256-entry table, a 3x3 colour matrix and a second table, and runs each
+stage strip by strip with ``cv2.LUT`` and ``cv2.transform``.
+
+Brightness and contrast are tables that reproduce ``ImageEnhance``
+exactly. Saturation, grayscale and sepia are matrices. Two matrices are
+multiplied together only when the first can't leave 0-255, so no clipping
+is skipped and fused output stays within one level of running the steps
+one at a time. Contrast needs the frame's mean, which comes from channel
+histograms of the stage input, so it can't follow a matrix in the same
+stage. The alpha channel of RGBA frames passes through untouched.
+"""
+
+from . import tiling
+from .lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+# ITU-R 601 luma weights, as used by PIL's "L" conversion.
+LUMA = (0.299, 0.587, 0.114)
+SEPIA = ((0.272, 0.534, 0.131),
+         (0.349, 0.686, 0.168),
+         (0.393, 0.769, 0.189))
+
+
+class Table:
+    """Per-channel lookup table; ``build(mean)`` returns it as a (3, 256) uint8 array.
+
+    ``mean`` is the luma mean of the frame the table applies to, and is
+    only computed for tables created with ``needs_mean``.
+    """
+
+    def __init__(self, build, needs_mean=False):
+        self.build = build
+        self.needs_mean = needs_mean
+
+
+class Matrix:
+    """3x3 colour matrix applied to RGB vectors."""
+
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+
+def _check_factor(factor):
+    if not 0.0 <= factor <= 2.0:
+        raise ValueError("Factor must be between 0.0 and 2.0")
+
+
+def _blend(base, factor):
+    """``Image.blend(degenerate, image, factor)`` for every level, rounded the way PIL does."""
+    base = np.float32(base)
+    out = np.clip(base + np.float32(factor) * (np.arange(256, dtype=np.float32) - base), 0, 255).astype(np.uint8)
+    return np.tile(out, (3, 1))
+
+
+def brightness(factor):
+    _check_factor(factor)
+    return Table(lambda mean: _blend(0, factor))
+
+
+def contrast(factor):
+    _check_factor(factor)
+    return Table(lambda mean: _blend(mean, factor), needs_mean=True)
+
+
+def saturation(factor):
+    _check_factor(factor)
+    return Matrix(factor * np.eye(3) + (1 - factor) * np.tile(LUMA, (3, 1)))
+
+
+def grayscale():
+    return Matrix(np.tile(LUMA, (3, 1)))
+
+
+def sepia():
+    return Matrix(SEPIA)
+
+
+# ImageProcessor method name -> builder taking the method's keyword arguments.
+OPS = {
+    "adjust_brightness": brightness,
+    "adjust_contrast": contrast,
+    "adjust_saturation": saturation,
+    "grayscale": grayscale,
+    "sepia": sepia,
+}
+
+
+def compile_steps(steps):
+    """Turn ``(method name, kwargs)`` steps into operations for ``apply``."""
+    return [OPS[op](**kwargs) for op, kwargs in steps]
+
+
+def _contained(matrix):
+    """True if ``matrix`` maps every 0-255 colour back into 0-255."""
+    return (matrix >= 0).all() and (matrix.sum(axis=1) <= 1 + 1e-9).all()
+
+
+class _Stage:
+    """One fused pass: table, then matrix, then table."""
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.pre = None
+        self.matrix = None
+        self.post = None
+
+    def accepts(self, op):
+        if isinstance(op, Table):
+            return not (op.needs_mean and self.matrix is not None)
+        return self.post is None and (self.matrix is None or _contained(self.matrix))
+
+    def add(self, op):
+        if isinstance(op, Matrix):
+            self.matrix = op.matrix if self.matrix is None else op.matrix @ self.matrix
+            return
+        table = op.build(self._mean() if op.needs_mean else None)
+        if self.matrix is None:
+            self.pre = table if self.pre is None else np.take_along_axis(table, self.pre, axis=1)
+        else:
+            self.post = table if self.post is None else np.take_along_axis(table, self.post, axis=1)
+
+    def _mean(self):
+        """Luma mean of the frame after ``pre``, from per-channel histograms."""
+        pre = _identity() if self.pre is None else self.pre
+        count = self.pixels.shape[0] * self.pixels.shape[1]
+        means = [cv2.calcHist([self.pixels], [c], None, [256], [0, 256])[:, 0] @ pre[c] / count
+                 for c in range(3)]
+        return int(np.dot(LUMA, means) + 0.5)
+
+    def run(self):
+        pixels = self.pixels
+        channels = pixels.shape[2]
+        pre, post, matrix = (_lut(self.pre, channels), _lut(self.post, channels),
+                             _transform(self.matrix, channels))
+        if pre is None and matrix is None:
+            return pixels
+
+        def run(strip):
+            if pre is not None:
+                strip = cv2.LUT(strip, pre)
+            if matrix is not None:
+                strip = cv2.transform(strip, matrix)
+            if post is not None:
+                strip = cv2.LUT(strip, post, dst=strip)
+            return strip
+
+        return tiling.apply(run, pixels)
+
+
+def _identity():
+    return np.tile(np.arange(256, dtype=np.uint8), (3, 1))
+
+
+def _lut(table, channels):
+    """Shape a (3, 256) table for ``cv2.LUT``, passing alpha through."""
+    if table is None:
+        return None
+    if channels == 4:
+        table = np.vstack([table, np.arange(256, dtype=np.uint8)])
+    return np.ascontiguousarray(table.T[np.newaxis])
+
+
+def _transform(matrix, channels):
+    if matrix is None or channels == 3:
+        return matrix
+    full = np.eye(4)
+    full[:3, :3] = matrix
+    return full
+
+
+def apply(pixels, ops):
+    """Return ``pixels`` (RGB or RGBA uint8) with ``ops`` applied in order.
+
+    ``pixels`` is never modified; the result may be ``pixels`` itself when
+    every operation is a no-op.
+    """
+    stage = _Stage(pixels)
+    for op in ops:
+        if not stage.accepts(op):
+            stage = _Stage(stage.run())
+        stage.add(op)
+    return stage.run()
@@ -0,0 +1,143 @@
+"""Dominant-colour palettes.
+
+``extract_palette`` works on a thumbnail of at most ``ANALYSIS_EDGE`` px.
+The default ``fast`` mode bins the thumbnail into a 16x16x16 colour
+histogram and runs weighted k-means over the occupied bins. The seeds are
+k-means++ made greedy: first the heaviest bin, then each time the bin with
+the largest weight times squared distance to the nearest seed. Nothing is
+random, so the same image always gives the same palette. ``kmeans`` runs
+``cv2.kmeans`` on every thumbnail pixel, with a fixed RNG seed.
+
+Each colour comes with its share of the (opaque) pixels. Results are
+cached by a hash of the thumbnail, so re-extracting from an unchanged image
+only costs the resize.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+
+MODES = ("fast", "kmeans")
+ANALYSIS_EDGE = 128
+CACHE_ENTRIES = 256
+
+_BITS = 4
+_MAX_ITERATIONS = 10
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def _thumbnail(pixels):
+    height, width = pixels.shape[:2]
+    scale = ANALYSIS_EDGE / max(height, width)
+    if scale >= 1:
+        return np.ascontiguousarray(pixels)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # Subsample large frames first: area-averaging a few pixels per output
+    # pixel is plenty for a palette and keeps the resize cheap.
+    step = int(1 / scale) // 4
+    if step > 1:
+        pixels = pixels[::step, ::step]
+    return cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
+
+
+def _histogram_kmeans(colors, num_colors):
+    """Weighted k-means over the occupied bins of a 4-bit-per-channel histogram."""
+    quantized = (colors >> (8 - _BITS)).astype(np.int32)
+    index = (quantized[:, 0] << 2 * _BITS) | (quantized[:, 1] << _BITS) | quantized[:, 2]
+    bins = 1 << 3 * _BITS
+    counts = np.bincount(index, minlength=bins)
+    occupied = np.flatnonzero(counts)
+    weights = counts[occupied].astype(np.float64)
+    # Each bin stands for the mean colour of its pixels, not its corner.
+    points = np.stack([np.bincount(index, colors[:, c], bins)[occupied] for c in range(3)], axis=1)
+    points /= weights[:, None]
+
+    k = min(num_colors, len(points))
+    centers = [points[np.argmax(weights)]]
+    nearest = ((points - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        centers.append(points[np.argmax(weights * nearest)])
+        nearest = np.minimum(nearest, ((points - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    norms = (points ** 2).sum(axis=1)[:, None]
+    for _ in range(_MAX_ITERATIONS):
+        labels = _nearest(points, norms, centers)
+        mass = np.bincount(labels, weights, k)
+        sums = np.stack([np.bincount(labels, weights * points[:, c], k) for c in range(3)], axis=1)
+        moved = np.where(mass[:, None] > 0, sums / np.maximum(mass, 1)[:, None], centers)
+        converged = np.abs(moved - centers).max() < 1
+        centers = moved
+        if converged:
+            break
+    mass = np.bincount(_nearest(points, norms, centers), weights, k)
+    return centers, mass
+
+
+def _nearest(points, norms, centers):
+    """Index of the nearest centre for each point (|p|^2 - 2 p.c + |c|^2 as one matrix product)."""
+    return (norms - 2 * points @ centers.T + (centers ** 2).sum(axis=1)).argmin(axis=1)
+
+
+def _pixel_kmeans(colors, num_colors):
+    """``cv2.kmeans`` with k-means++ seeding on every thumbnail pixel."""
+    samples = colors.astype(np.float32)
+    k = min(num_colors, len(np.unique(colors, axis=0)))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.5)
+    cv2.setRNGSeed(0)
+    _, labels, centers = cv2.kmeans(samples, k, None, criteria, 3, cv2.KMEANS_PP_CENTERS)
+    return centers.astype(np.float64), np.bincount(labels.ravel(), minlength=k).astype(np.float64)
+
+
+def extract_palette(pixels, num_colors=5, mode="fast"):
+    """Return up to ``num_colors`` dominant colours of an RGB(A) frame, most common first.
+
+    Each entry is ``{"rgb": [r, g, b], "hex": "#rrggbb", "weight": share}``;
+    fully transparent pixels don't count.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Mode must be one of: {', '.join(MODES)}")
+    thumbnail = _thumbnail(pixels)
+    digest = hashlib.blake2b(thumbnail.tobytes(), digest_size=16)
+    digest.update(f"{thumbnail.shape}:{num_colors}:{mode}".encode())
+    key = digest.hexdigest()
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _copy(_cache[key])
+
+    if thumbnail.shape[2] == 4:
+        colors = thumbnail[thumbnail[..., 3] > 0][:, :3]
+    else:
+        colors = thumbnail.reshape(-1, 3)
+    palette = []
+    if len(colors):
+        engine = _histogram_kmeans if mode == "fast" else _pixel_kmeans
+        centers, mass = engine(colors, num_colors)
+        for i in np.argsort(-mass, kind="stable"):
+            if mass[i] == 0:
+                continue
+            rgb = [int(round(min(max(value, 0), 255))) for value in centers[i]]
+            palette.append({
+                "rgb": rgb,
+                "hex": "#{:02x}{:02x}{:02x}".format(*rgb),
+                "weight": round(float(mass[i] / mass.sum()), 4),
+            })
+
+    with _lock:
+        _cache[key] = palette
+        while len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return _copy(palette)
+
+
+def _copy(palette):
+    # Cached palettes are shared; hand out copies callers may modify.
+    return [{**entry, "rgb": list(entry["rgb"])} for entry in palette]
@@ -0,0 +1,86 @@
+"""Process-wide caches for classifiers and fonts used by ImageProcessor.
+
+Haar cascades are parsed from XML once per process and fonts are kept in an
+LRU keyed by (path, size). ``warm_up`` loads the common ones ahead of the
+first request; gunicorn.conf.py calls it from ``post_fork``.
+"""
+import logging
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+
+from .lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+ImageFont = lazy_import("PIL.ImageFont")
+
+logger = logging.getLogger(__name__)
+
+FACE_CASCADE = "haarcascade_frontalface_default.xml"
+EYE_CASCADE = "haarcascade_eye.xml"
+
+# Font sizes loaded by warm_up: watermark and meme defaults.
+WARM_FONT_SIZES = (50,)
+
+_cascades = {}
+_cascades_lock = threading.Lock()
+_warned_fallback = threading.Event()
+
+
+class _Cascade:
+    """A loaded classifier plus the lock that serialises detection on it."""
+
+    def __init__(self, name):
+        self.classifier = cv2.CascadeClassifier(cv2.data.haarcascades + name)
+        if self.classifier.empty():
+            raise RuntimeError(f"Could not load cascade {name}")
+        self.lock = threading.Lock()
+
+
+def _cascade(name):
+    cascade = _cascades.get(name)
+    if cascade is None:
+        with _cascades_lock:
+            cascade = _cascades.get(name)
+            if cascade is None:
+                cascade = _cascades[name] = _Cascade(name)
+    return cascade
+
+
+def detect(name, gray, *args, **kwargs):
+    """Run ``detectMultiScale`` with the shared cascade ``name``.
+
+    A classifier isn't safe to use from two threads at once, and batch and
+    job workers share this process, so calls on one cascade are serialised.
+    """
+    cascade = _cascade(name)
+    with cascade.lock:
+        return cascade.classifier.detectMultiScale(gray, *args, **kwargs)
+
+
+@lru_cache(maxsize=64)
+def get_font(size, path=None):
+    """Return a font at ``size`` from ``path`` or the first usable TEXT_FONT_PATHS entry.
+
+    Falls back to the scalable font bundled with Pillow, so text is never
+    silently rendered with the tiny bitmap default. Results are cached per
+    (size, path), misses included.
+    """
+    for candidate in [path] if path else settings.TEXT_FONT_PATHS:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    if not _warned_fallback.is_set():
+        _warned_fallback.set()
+        logger.warning("No usable font in %s, using Pillow's bundled font", settings.TEXT_FONT_PATHS)
+    return ImageFont.load_default(size)
+
+
+def warm_up():
+    """Load cascades and common fonts so the first request doesn't pay for it."""
+    for name in (FACE_CASCADE, EYE_CASCADE):
+        _cascade(name)
+    for size in WARM_FONT_SIZES:
+        get_font(size)
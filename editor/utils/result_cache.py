@@ -0,0 +1,258 @@
+"""Content-addressed cache of tool responses.
+
+A response is keyed by a hash of the uploaded bytes, the endpoint and the
+normalised form parameters, so re-running a tool on the same input is
+served from disk without decoding anything. Entries live under
+``RESULT_CACHE_DIR`` and are evicted least-recently-used (by mtime, which
+hits refresh) once ``RESULT_CACHE_BYTES`` is exceeded. Responses carry an
+``ETag`` and conditional requests with a matching ``If-None-Match`` get
+304. A hit carries the ``CACHED_HEADERS`` of the response that was stored,
+and its Server-Timing repeats that response's operation stages, so it only
+differs from a computed response in ``X-Cache`` and the total. Only
+requests that upload their image are cached: tools working on a session's
+image must also advance it, so they always run.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Form fields that don't affect the output.
+IGNORED_PARAMS = {"csrfmiddlewaretoken"}
+# Response headers stored with the body and restored on a hit.
+CACHED_HEADERS = ("X-Denoise-Tier",)
+
+
+class ResultCache:
+    """Disk-backed LRU of response bodies keyed by content hash."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Entries and bytes on disk, counted once and then kept up to date.
+        self._entries = None
+        self._total = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def key(self, request):
+        """Hash the uploads, path and normalised parameters of ``request``."""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(request.path.encode())
+        # Output format can be negotiated from Accept.
+        digest.update(request.headers.get("Accept", "").encode())
+        for name, value in sorted((k, _normalize(v)) for k, values in request.POST.lists()
+                                  for v in values if k not in IGNORED_PARAMS):
+            digest.update(f"\0{name}={value}".encode())
+        for field in sorted(request.FILES):
+            for upload in request.FILES.getlist(field):
+                digest.update(f"\0{field}:{upload.size}".encode())
+                for chunk in upload.chunks():
+                    digest.update(chunk)
+                upload.seek(0)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return ``(body, meta)`` or ``None``; a hit refreshes the entry.
+
+        ``meta`` holds the ``content_type``, the stored ``headers`` and the
+        ``timings`` of the request that computed the response.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                meta, body = f.read().split(b"\n", 1)
+            meta = json.loads(meta)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            # ValueError also covers entries written before headers were stored.
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += len(body)
+        return body, meta
+
+    def put(self, key, body, content_type, headers=None, timings=()):
+        if len(body) > self.max_bytes // 4:
+            return
+        meta = json.dumps({"content_type": content_type, "headers": headers or {}, "timings": list(timings)})
+        data = meta.encode() + b"\n" + body
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        with self._lock:
+            self._count()
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = None
+            os.replace(tmp, path)
+            if replaced is None:
+                self._entries += 1
+            self._total += len(data) - (replaced or 0)
+            over = self._total > self.max_bytes
+        if over:
+            self._evict()
+
+    def count_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self._lock:
+            self._count()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "bytes_served": self.bytes_served,
+                "not_modified": self.not_modified,
+                "evictions": self.evictions,
+                "entries": self._entries,
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _files(self):
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith(".tmp"):
+                    yield os.path.join(dirpath, name)
+
+    def _count(self):
+        """Walk the cache once to seed the entry and byte counters (call with the lock held)."""
+        if self._total is not None:
+            return
+        entries = size = 0
+        for path in self._files():
+            try:
+                size += os.path.getsize(path)
+                entries += 1
+            except FileNotFoundError:
+                pass
+        self._entries, self._total = entries, size
+
+    def _evict(self):
+        """Delete least recently used entries until 90% of the budget is free."""
+        files = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        entries = len(files)
+        evicted = 0
+        for _, size, path in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._entries = entries - evicted
+            self._total = total
+            self.evictions += evicted
+
+
+def _normalize(value):
+    """Canonical form of a parameter, so "1", "1.0" and " 1 " share a key."""
+    value = value.strip()
+    try:
+        return repr(float(value))
+    except ValueError:
+        return value
+
+
+def cached_result(skip=None):
+    """Serve a tool view from ``result_cache`` when the request uploads its input.
+
+    ``skip(request, **kwargs)`` returns True for requests whose output isn't
+    deterministic (e.g. the noise filter).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (not settings.RESULT_CACHE_ENABLED or request.method != "POST" or not request.FILES
+                    or request.POST.get("async") == "1" or (skip and skip(request, *args, **kwargs))):
+                return view(request, *args, **kwargs)
+
+            key = result_cache.key(request)
+            etag = f'"{key}"'
+            if etag in request.headers.get("If-None-Match", ""):
+                result_cache.count_not_modified()
+                response = HttpResponseNotModified()
+                response["ETag"] = etag
+                patch_vary_headers(response, ["Accept"])
+                return response
+
+            cached = result_cache.get(key)
+            if cached is not None:
+                body, meta = cached
+                response = HttpResponse(body, content_type=meta["content_type"])
+                for name, value in meta["headers"].items():
+                    response[name] = value
+                metrics.add_timings(meta["timings"])
+                response["X-Cache"] = "HIT"
+            else:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200 or response.streaming:
+                    return response
+                headers = {name: response[name] for name in CACHED_HEADERS if response.has_header(name)}
+                try:
+                    result_cache.put(key, response.content, response["Content-Type"], headers,
+                                     metrics.request_timings())
+                except OSError as e:
+                    logger.error("Result cache write failed: %s", str(e))
+                response["X-Cache"] = "MISS"
+            response["ETag"] = etag
+            patch_vary_headers(response, ["Accept"])
+            return response
+        return wrapper
+    return decorator
+
+
+result_cache = ResultCache(
+    root=settings.RESULT_CACHE_DIR,
+    max_bytes=settings.RESULT_CACHE_BYTES,
+)
+
+
+def _collect():
+    stats = result_cache.stats()
+    return [
+        ("clarifi_result_cache_hits_total", "counter", "Tool responses served from the result cache.", stats["hits"]),
+        ("clarifi_result_cache_misses_total", "counter", "Cacheable tool responses computed.", stats["misses"]),
+        ("clarifi_result_cache_bytes", "gauge", "Bytes stored in the result cache.", stats["bytes"]),
+        ("clarifi_result_cache_entries", "gauge", "Responses stored in the result cache.", stats["entries"]),
+    ]
+
+
+metrics.register_collector(_collect)
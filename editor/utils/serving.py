@@ -0,0 +1,120 @@
+"""Serve stored images from disk without reading them into worker memory.
+
+``serve_file`` answers conditional requests (``If-None-Match`` /
+``If-Modified-Since``) with 304, honours a single-range ``Range`` header
+(with ``If-Range``), and otherwise streams the file with ``FileResponse``,
+which lets the WSGI server use ``sendfile``. Behind a reverse proxy,
+``SENDFILE_BACKEND`` hands the transfer to the proxy instead: ``"nginx"``
+sets ``X-Accel-Redirect`` to ``SENDFILE_URL_PREFIX`` plus the path
+relative to ``MEDIA_ROOT`` (map that prefix to ``MEDIA_ROOT`` in an
+``internal`` location), ``"sendfile"`` sets ``X-Sendfile`` to the absolute
+path for Apache mod_xsendfile or lighttpd.
+"""
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_CHUNK = 64 * 1024
+
+
+def file_etag(stat):
+    """Validator for a stored file: changes whenever it is rewritten."""
+    return quote_etag(f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+
+def _byte_range(header, size):
+    """Return ``(start, end)`` (inclusive), ``None`` for the whole file, or ``False`` if unsatisfiable.
+
+    Only single ranges are supported; anything else is served in full,
+    which RFC 9110 allows.
+    """
+    match = _RANGE.match(header.replace(" ", ""))
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith(("\"", "W/")):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(last_modified)
+
+
+def _read_range(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(_CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, path, content_type, cache_control="private, no-cache"):
+    """Return a response serving ``path`` (raises ``FileNotFoundError`` if it is gone)."""
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _file_response(request, path, content_type, stat.st_size, etag, last_modified)
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = cache_control
+    return response
+
+
+def _file_response(request, path, content_type, size, etag, last_modified):
+    backend = settings.SENDFILE_BACKEND
+    if backend == "nginx":
+        # nginx applies Range and the remaining conditionals itself.
+        response = HttpResponse(content_type=content_type)
+        relative = os.path.relpath(path, settings.MEDIA_ROOT)
+        response["X-Accel-Redirect"] = settings.SENDFILE_URL_PREFIX.rstrip("/") + "/" + relative
+        return response
+    if backend == "sendfile":
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = os.path.abspath(path)
+        return response
+
+    span = None
+    header = request.headers.get("Range")
+    if header and request.method == "GET" and _if_range_matches(request, etag, last_modified):
+        span = _byte_range(header, size)
+    if span is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+    elif span is not None:
+        start, end = span
+        length = end - start + 1
+        response = StreamingHttpResponse(_read_range(path, start, length), status=206,
+                                         content_type=content_type)
+        response["Content-Length"] = str(length)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    else:
+        response = FileResponse(open(path, "rb"), content_type=content_type)
+    response["Accept-Ranges"] = "bytes"
+    return response
@@ -0,0 +1,266 @@
+"""Per-session cache of decoded studio images.
+
+Tool endpoints can work on the session's current image without the
+browser re-uploading it. Decoded frames live in an in-process LRU bounded
+by a byte budget and an idle timeout. Committed edits are spilled to raw
+``.npy`` files under ``MEDIA_ROOT/working`` (on every commit by default,
+or only on eviction), and the original upload is the fallback when no
+spill exists. A version counter kept in the session lets a worker notice
+that another worker has moved the image on and reload it from disk. Each
+image's undo/redo history is kept under ``MEDIA_ROOT/history`` (see
+``history.py``).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+
+from django.conf import settings
+
+from . import history, metrics
+from .image_processing import ImageProcessor
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+
+
+class _Entry:
+    __slots__ = ("source", "processor", "version", "revision", "nbytes", "last_used", "dirty", "lock")
+
+    def __init__(self, source):
+        self.source = source
+        self.processor = None
+        self.version = -1
+        self.revision = None
+        self.nbytes = 0
+        self.last_used = time.monotonic()
+        self.dirty = False
+        self.lock = threading.Lock()
+
+
+class SessionSnapshot(dict):
+    """Detached copy of the session fields ``checkout`` uses.
+
+    Background jobs outlive their request, so they check out against a
+    snapshot; the resulting ``studio_version`` is copied back into the real
+    session when the client next polls the job.
+    """
+
+    def __init__(self, session):
+        super().__init__(studio_image=session.get("studio_image"),
+                         studio_version=session.get("studio_version", 0))
+        self.session_key = session.session_key
+
+
+class WorkingImageStore:
+    """LRU of session working images with a byte budget and idle eviction."""
+
+    def __init__(self, max_bytes, idle_seconds, spill_dir, history_dir, write_through=True, preview_edge=None):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.spill_dir = spill_dir
+        self.history_dir = history_dir
+        self.write_through = write_through
+        self.preview_edge = preview_edge
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def spill_path(self, source):
+        # Sources are per-session references under MEDIA_ROOT, so flattening
+        # the relative path keeps spills of the same upload apart. Quoting
+        # is reversible, which ``sweep_spills`` relies on.
+        return os.path.join(self.spill_dir, f"{quote(source, safe='')}.npy")
+
+    def history_path(self, source):
+        return os.path.join(self.history_dir, quote(source, safe=""))
+
+    def history(self, source):
+        """The ``EditHistory`` of ``source``'s working image."""
+        return history.EditHistory(self.history_path(source), lambda: self._decode(source).pixels)
+
+    @contextmanager
+    def checkout(self, session, record=True):
+        """Yield the working ``ImageProcessor`` for ``session``.
+
+        Edits made inside the block are kept for the next request and the
+        session's ``studio_version`` is bumped. With ``record``, they are
+        also added to the image's undo history as one entry. If the block
+        raises, the cached frame is dropped so a half-applied edit is never
+        served.
+        """
+        key = session.session_key
+        source = session.get("studio_image")
+        if not key or not source:
+            raise LookupError("No studio image in session")
+        version = session.get("studio_version", 0)
+
+        entry = self._acquire(key, source)
+        with entry.lock:
+            if entry.processor is None or entry.version < version:
+                self._load(entry, version)
+            journal = None
+            if record:
+                journal = entry.processor.journal = []
+                if version and not history.EditHistory.exists(self.history_path(source)):
+                    # Edited before history was kept; start from the current frame.
+                    self.history(source).start(entry.processor.pixels)
+            try:
+                yield entry.processor
+            except BaseException:
+                self.discard(key, entry)
+                raise
+            finally:
+                entry.processor.journal = None
+            if entry.processor.revision != entry.revision:
+                if journal is not None:
+                    self.history(source).record(journal, entry.processor.pixels)
+                entry.version = max(entry.version, version) + 1
+                entry.revision = entry.processor.revision
+                entry.dirty = True
+                if self.write_through:
+                    self._spill(entry)
+                if self.preview_edge:
+                    # Rebuild the slider proxy now so the next preview stays fast.
+                    entry.processor.preview(self.preview_edge)
+                session["studio_version"] = entry.version
+            entry.last_used = time.monotonic()
+            self._resize(key, entry)
+        self._evict()
+
+    def reset(self, session):
+        """Forget the working image of ``session`` (e.g. after a new upload)."""
+        key = session.session_key
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._total -= entry.nbytes
+        if entry is not None:
+            self.remove_spill(entry.source)
+        if session.get("studio_image"):
+            self.remove_spill(session["studio_image"])
+        session["studio_version"] = 0
+
+    def discard(self, key, entry=None):
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and (entry is None or current is entry):
+                del self._entries[key]
+                self._total -= current.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total, "max_bytes": self.max_bytes}
+
+    def _acquire(self, key, source):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.source != source:
+                if entry is not None:
+                    self._total -= entry.nbytes
+                entry = _Entry(source)
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry.last_used = time.monotonic()
+            return entry
+
+    def _decode(self, source):
+        return ImageProcessor(os.path.join(settings.MEDIA_ROOT, source))
+
+    def _load(self, entry, version):
+        spill = self.spill_path(entry.source)
+        if os.path.exists(spill):
+            entry.processor = ImageProcessor.from_array(np.load(spill))
+        else:
+            entry.processor = self._decode(entry.source)
+        entry.version = version
+        entry.revision = entry.processor.revision
+        entry.dirty = False
+
+    def _spill(self, entry):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = self.spill_path(entry.source)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, entry.processor.pixels)
+        os.replace(tmp, path)
+        entry.dirty = False
+
+    def remove_spill(self, source):
+        """Delete the spilled frame and history of ``source``; returns the bytes freed."""
+        freed = history.remove(self.history_path(source))
+        path = self.spill_path(source)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return freed
+        return freed + size
+
+    def sweep_spills(self):
+        """Delete spills and histories whose source file is gone; returns ``(count, bytes)``."""
+        count = freed = 0
+        names = set()
+        try:
+            names.update(name[:-len(".npy")] for name in os.listdir(self.spill_dir) if name.endswith(".npy"))
+        except FileNotFoundError:
+            pass
+        try:
+            names.update(os.listdir(self.history_dir))
+        except FileNotFoundError:
+            pass
+        for name in names:
+            source = unquote(name)
+            if not os.path.exists(os.path.join(settings.MEDIA_ROOT, source)):
+                freed += self.remove_spill(source)
+                count += 1
+        return count, freed
+
+    def _resize(self, key, entry):
+        nbytes = entry.processor.pixels.nbytes
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self._total += nbytes - entry.nbytes
+            entry.nbytes = nbytes
+
+    def _evict(self):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            for key in list(self._entries):
+                entry = self._entries[key]
+                idle = now - entry.last_used > self.idle_seconds
+                if not idle and self._total <= self.max_bytes:
+                    break
+                if entry.lock.locked():
+                    continue
+                del self._entries[key]
+                self._total -= entry.nbytes
+                evicted.append(entry)
+        for entry in evicted:
+            with entry.lock:
+                if entry.dirty and entry.processor is not None:
+                    self._spill(entry)
+
+
+working_images = WorkingImageStore(
+    max_bytes=settings.WORKING_IMAGE_CACHE_BYTES,
+    idle_seconds=settings.WORKING_IMAGE_IDLE_SECONDS,
+    spill_dir=os.path.join(settings.MEDIA_ROOT, "working"),
+    history_dir=os.path.join(settings.MEDIA_ROOT, "history"),
+    write_through=settings.WORKING_IMAGE_WRITE_THROUGH,
+    preview_edge=settings.PREVIEW_MAX_EDGE,
+)
+
+
+def _collect():
+    stats = working_images.stats()
+    return [
+        ("clarifi_working_images", "gauge", "Decoded session images held in memory.", stats["entries"]),
+        ("clarifi_working_image_bytes", "gauge", "Bytes of decoded session images held in memory.", stats["bytes"]),
+    ]
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,125 @@
+"""Run per-pixel and neighbourhood filters over horizontal strips in parallel.
+
+cv2 and NumPy release the GIL, so splitting a frame into strips and
+running them on a thread pool uses every core on one large image. Filters
+with a kernel get ``halo`` extra rows of real neighbours on each side of
+a strip; those rows are cropped before the strip is written back, so the
+result matches a whole-frame call. Small frames and calls made from a
+strip worker run inline. Large frames (see ``editor.utils.mapped``) are
+always split, get a disk-backed output, and have each strip's pages
+released once it is written.
+"""
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import mapped
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# Frames below this many pixels aren't worth splitting.
+MIN_PIXELS = 1_000_000
+# Minimum strip height, so halos stay a small share of each strip.
+MIN_ROWS = 64
+# Strips per worker; a few per worker smooths out uneven strips.
+STRIPS_PER_WORKER = 4
+# Largest strip of a disk-backed frame, which bounds what is resident.
+LARGE_STRIP_PIXELS = 4_000_000
+
+_pool = None
+_workers = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(workers):
+    """Replace the strip pool with one of ``workers`` threads (benchmarks use this)."""
+    global _pool, _workers
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+        _pool = None
+        _workers = workers
+
+
+def workers():
+    return _workers or settings.TILE_WORKERS
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=workers(), thread_name_prefix="tile",
+                                       initializer=_mark_worker)
+        return _pool
+
+
+def _mark_worker():
+    _local.in_worker = True
+
+
+def spans(height, width):
+    """Return ``[(top, bottom), ...]`` strips covering ``height`` rows."""
+    count = workers()
+    if height * width < MIN_PIXELS or getattr(_local, "in_worker", False):
+        return [(0, height)]
+    if mapped.is_large(height, width):
+        # Split even with one worker, so only a few strips are resident.
+        count = max(count * STRIPS_PER_WORKER, math.ceil(height * width / LARGE_STRIP_PIXELS))
+    elif count == 1:
+        return [(0, height)]
+    else:
+        count *= STRIPS_PER_WORKER
+    count = max(1, min(count, height // MIN_ROWS))
+    bounds = np.linspace(0, height, count + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def for_strips(fn, height, width):
+    """Call ``fn(rows)`` for every strip, where ``rows`` is a row slice."""
+    strips = spans(height, width)
+    if len(strips) == 1:
+        fn(slice(0, height))
+        return
+    futures = [_get_pool().submit(fn, slice(top, bottom)) for top, bottom in strips]
+    for future in futures:
+        future.result()
+
+
+def apply(fn, src, halo=0):
+    """Return ``fn(src)`` computed strip by strip.
+
+    ``fn`` maps an array to one with the same number of rows (channels and
+    dtype may change). Each strip is passed with up to ``halo`` rows of
+    context above and below, which must cover the filter's kernel radius.
+    """
+    height = src.shape[0]
+    strips = spans(height, src.shape[1])
+    if len(strips) == 1:
+        return fn(src)
+
+    def run(top, bottom):
+        start, stop = max(0, top - halo), min(height, bottom + halo)
+        result = fn(src[start:stop])
+        mapped.release_rows(src, start, stop)
+        return result[top - start:top - start + bottom - top]
+
+    # The first strip tells us the output's dtype and channel count.
+    first = run(*strips[0])
+    out = mapped.allocate_frame((height,) + first.shape[1:], first.dtype)
+    out[:len(first)] = first
+    mapped.release_rows(out, 0, len(first))
+
+    def fill(span):
+        top, bottom = span
+        out[top:bottom] = run(top, bottom)
+        mapped.release_rows(out, top, bottom)
+
+    futures = [_get_pool().submit(fill, span) for span in strips[1:]]
+    for future in futures:
+        future.result()
+    return out
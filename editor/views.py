@@ -1,14 +1,28 @@
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.utils.cache import patch_vary_headers
 from django.views.decorators.csrf import csrf_exempt
+from .utils.batch import iter_batch, multipart_boundary, stream_multipart, stream_zip
+from .utils.encoding import CONTENT_TYPES, negotiate, normalize
 from .utils.image_processing import ImageProcessor
-import uuid
+from .utils.ingest import ImageTooLarge, probe
+from .utils.jobs import DONE, QueueFull, jobs
+from .utils.media_store import StorageFull, media_store
+from .utils import frames, metrics
+from .utils.offload import offload
+from .utils.pipeline import PipelineError, parse_steps, run_pipeline
+from .utils.quantize import MODES as PALETTE_MODES
+from .utils.result_cache import cached_result, result_cache
+from .utils.serving import serve_file
+from .utils.session_store import SessionSnapshot, working_images
+from contextlib import contextmanager, nullcontext
+import io
+import json
 import os
 import mimetypes
 from django.conf import settings
 import logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -17,20 +31,34 @@ def index(request):
 
 
 @csrf_exempt
+@offload("upload_image")
 def upload_image(request):
     if request.method == "POST" and request.FILES.get("image"):
         image = request.FILES["image"]
         if not image.content_type.startswith("image/"):
             logger.error("Invalid image format: %s", image.content_type)
             return JsonResponse({"error": "Invalid image format"}, status=400)
-
-        filename = f"{uuid.uuid4()}.{image.name.split('.')[-1]}"
-        filepath = os.path.join(settings.MEDIA_ROOT, filename)
-        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
-        with open(filepath, "wb") as f:
-            for chunk in image.chunks():
-                f.write(chunk)
-
+        try:
+            _, _, image_format = probe(image)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
+        except OSError:
+            logger.error("Unreadable image upload: %s", image.name)
+            return JsonResponse({"error": "Invalid image file"}, status=400)
+
+        if not request.session.session_key:
+            request.session.save()
+        try:
+            filename = media_store.store(image, request.session.session_key, image_format)
+        except StorageFull as e:
+            logger.error("Upload rejected: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=507)
+
+        previous = request.session.get("studio_image")
+        working_images.reset(request.session)
+        if previous and previous != filename:
+            media_store.release(previous)
         request.session["studio_image"] = filename
         request.session.modified = True
         logger.info("Image uploaded: %s, session: %s",
@@ -53,47 +81,281 @@ def remove_background(request):
     return render(request, "remove.html")
 
 
+def _studio_image_path(request):
+    """Return the on-disk path of the session's studio image, if any."""
+    filename = request.session.get("studio_image")
+    if not filename:
+        return None
+    filepath = os.path.join(settings.MEDIA_ROOT, filename)
+    return filepath if os.path.exists(filepath) else None
+
+
+def _has_image(request):
+    """True if the request carries an upload or the session has a studio image."""
+    return bool(request.FILES.get("image") or request.session.get("studio_image"))
+
+
+@contextmanager
+def _open_processor(request, draft_size=None):
+    """Yield a processor for the uploaded image, or the session's working image.
+
+    Without an upload, the tool runs on the studio image cached for this
+    session and the result becomes the new working image. ``draft_size``
+    lets an uploaded JPEG be decoded at reduced scale when the tool only
+    needs that much (see ``ImageProcessor``).
+    """
+    if request.FILES.get("image"):
+        yield ImageProcessor(request.FILES["image"], draft_size=draft_size)
+    else:
+        media_store.touch(request.session.get("studio_image", ""))
+        with working_images.checkout(request.session) as processor:
+            yield processor
+
+
+def _image_response(request, processor):
+    """Encode the result in the format the client asked for (see ``encoding.negotiate``)."""
+    format = negotiate(request, alpha=processor.pixels.shape[2] == 4)
+    if format is None:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+    response = HttpResponse(processor.save_image(format), content_type=CONTENT_TYPES[format])
+    patch_vary_headers(response, ["Accept"])
+    if processor.denoise_tier:
+        response["X-Denoise-Tier"] = processor.denoise_tier
+    return response
+
+
+def _output_formats(request, explicit=None):
+    """Negotiated format for an opaque and a transparent result, for work done after the request."""
+    return {alpha: negotiate(request, alpha, explicit) for alpha in (False, True)}
+
+
+def _background_params(data):
+    """Optional ``analysis_edge`` for remove_background (longest proxy edge, 0 = full resolution)."""
+    if data.get("analysis_edge"):
+        return {"analysis_edge": int(data["analysis_edge"])}
+    return {}
+
+
+def _denoise_params(data):
+    """Optional denoiser ``tier`` and latency ``budget`` (seconds) for denoise/restore."""
+    params = {"tier": data.get("tier", "auto")}
+    if data.get("budget"):
+        params["budget"] = float(data["budget"])
+    return params
+
+
+# Slow tools that run as background jobs when the request sends async=1.
+# Each maps the POST data to pipeline steps, so parameters are validated
+# before anything is queued.
+ASYNC_TOOLS = {
+    "filter": {
+        "hdr": lambda data: [("hdr", {})],
+        "oil_painting": lambda data: [("oil_painting", {})],
+    },
+    "premium": {
+        "remove-background": lambda data: [("remove_background", _background_params(data))],
+        "restore": lambda data: [("restore", _denoise_params(data))],
+        "denoise": lambda data: [("denoise", {"strength": int(data.get("strength", 10)), **_denoise_params(data)})],
+        "super-resolution": lambda data: [("super_resolution", {"scale": int(data.get("scale", 2))})],
+    },
+    "format": {
+        "remove-background": lambda data: [("remove_background", _background_params(data))],
+    },
+}
+
+
+def _wants_job(request, view, tool):
+    return request.POST.get("async") == "1" and tool in ASYNC_TOOLS.get(view, {})
+
+
+def _enqueue(request, name, work):
+    """Queue ``work(job)`` and answer 202 with the job's URLs, or 503 if full."""
+    try:
+        record = jobs.submit(work, name, owner=request.session.session_key)
+    except QueueFull as e:
+        logger.error("Job queue full, rejected %s", name)
+        response = JsonResponse({"error": str(e)}, status=503)
+        response["Retry-After"] = "5"
+        return response
+    logger.info("Job queued: %s %s", name, record["id"])
+    return JsonResponse({
+        "job": record["id"],
+        "status_url": f"/jobs/{record['id']}",
+        "result_url": f"/jobs/{record['id']}/result",
+    }, status=202)
+
+
+def _enqueue_tool(request, view, tool):
+    """Queue an ``ASYNC_TOOLS`` entry on the upload or the session's working image."""
+    try:
+        steps = ASYNC_TOOLS[view][tool](request.POST)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    formats = _output_formats(request)
+    if formats[False] is None:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+
+    if request.FILES.get("image"):
+        # The upload is gone once the request ends; keep the encoded bytes.
+        payload = request.FILES["image"].read()
+        try:
+            probe(io.BytesIO(payload))
+        except ImageTooLarge as e:
+            return JsonResponse({"error": str(e)}, status=413)
+        except OSError:
+            return JsonResponse({"error": "Invalid image file"}, status=400)
+        snapshot = None
+        open_processor = lambda: nullcontext(frames.load(io.BytesIO(payload)))
+    else:
+        snapshot = SessionSnapshot(request.session)
+        open_processor = lambda: working_images.checkout(snapshot)
+
+    def work(job):
+        job.progress(0.05, "loading")
+        with open_processor() as processor:
+            job.progress(0.1, "processing")
+            frames.run(processor, steps)
+            job.progress(0.9, "encoding")
+            output_format = formats[processor.pixels.shape[2] == 4]
+            processed = processor.save_image(format=output_format)
+        meta = {}
+        if snapshot is not None:
+            meta = {"studio_image": snapshot["studio_image"], "studio_version": snapshot["studio_version"]}
+        if processor.denoise_tier:
+            meta["denoise_tier"] = processor.denoise_tier
+        return processed, CONTENT_TYPES[output_format], meta
+
+    return _enqueue(request, f"{view}/{tool}", work)
+
+
+def _job_for(request, job_id):
+    """Return the job record if it exists and belongs to this session."""
+    record = jobs.get(str(job_id))
+    if record is None or (record["owner"] and record["owner"] != request.session.session_key):
+        return None
+    if (record["status"] == DONE and record.get("studio_image")
+            and record["studio_image"] == request.session.get("studio_image")):
+        # The job moved the working image on; let the session catch up.
+        version = max(request.session.get("studio_version", 0), record["studio_version"])
+        request.session["studio_version"] = version
+    return record
+
+
+def job_status(request, job_id):
+    record = _job_for(request, job_id)
+    if record is None:
+        return JsonResponse({"error": "Job not found"}, status=404)
+    status = {key: record[key] for key in ("id", "tool", "status", "progress", "stage", "error")}
+    if record["status"] == DONE:
+        status["result_url"] = f"/jobs/{record['id']}/result"
+    if record.get("denoise_tier"):
+        status["denoise_tier"] = record["denoise_tier"]
+    return JsonResponse(status)
+
+
+@offload("job_result")
+def job_result(request, job_id):
+    record = _job_for(request, job_id)
+    if record is None:
+        return JsonResponse({"error": "Job not found"}, status=404)
+    if record["status"] != DONE:
+        return JsonResponse({"error": "Job not finished", "status": record["status"]}, status=409)
+    try:
+        # Results never change once written, so the browser may keep them.
+        return serve_file(request, jobs.result_path(record["id"]), record["content_type"],
+                          cache_control=f"private, max-age={settings.JOB_TTL_SECONDS}, immutable")
+    except FileNotFoundError:
+        return JsonResponse({"error": "Job result expired"}, status=404)
+
+
+@offload("get_studio_image")
 def get_studio_image(request):
     if "studio_image" not in request.session:
         logger.error("No studio image in session")
         return HttpResponse(status=404)
 
     filename = request.session["studio_image"]
-    filepath = os.path.join(settings.MEDIA_ROOT, filename)
-    if not os.path.exists(filepath):
-        logger.error("Image file not found: %s", filepath)
+    filepath = _studio_image_path(request)
+    if filepath is None:
+        logger.error("Image file not found: %s", filename)
         return HttpResponse(status=404)
 
     content_type, _ = mimetypes.guess_type(filepath)
     content_type = content_type or "image/png"
-    with open(filepath, "rb") as f:
-        logger.info("Serving studio image: %s", filename)
-        return HttpResponse(f.read(), content_type=content_type)
+    logger.info("Serving studio image: %s", filename)
+    media_store.touch(filename)
+    # Same URL for every upload in the session, so revalidate each time.
+    return serve_file(request, filepath, content_type)
+
+
+def history_status(request):
+    """Undo/redo position of the session's studio image."""
+    source = request.session.get("studio_image")
+    if not source:
+        return JsonResponse({"error": "No studio image in session"}, status=404)
+    return JsonResponse(working_images.history(source).status())
+
+
+HISTORY_STEPS = {"undo": -1, "redo": 1}
+
+
+@csrf_exempt
+@offload("history_step")
+def history_step(request, tool):
+    if request.method == "POST" and request.session.get("studio_image"):
+        if tool not in HISTORY_STEPS:
+            return JsonResponse({"error": "Invalid tool"}, status=400)
+        try:
+            media_store.touch(request.session["studio_image"])
+            with working_images.checkout(request.session, record=False) as processor:
+                history = working_images.history(request.session["studio_image"])
+                if not history.move(processor, HISTORY_STEPS[tool]):
+                    return JsonResponse({"error": f"Nothing to {tool}"}, status=409)
+                response = _image_response(request, processor)
+            response["X-History-Cursor"] = str(history.cursor)
+            response["X-History-Length"] = str(len(history.entries))
+            logger.info("History %s to %d of %d", tool, history.cursor, len(history.entries))
+            return response
+        except Exception as e:
+            logger.error("History %s error: %s", tool, str(e))
+            return JsonResponse({"error": str(e)}, status=500)
+    logger.error("Invalid history request")
+    return JsonResponse({"error": "Invalid request"}, status=400)
 
 
 @csrf_exempt
+@offload("adjust_image")
+@cached_result()
 def adjust_image(request, tool):
-    if request.method == "POST" and request.FILES.get("image"):
-        image = request.FILES["image"]
+    if request.method == "POST" and _has_image(request):
         factor = float(request.POST.get("factor", 1.0))
+        preview = request.POST.get("preview") == "1"
         if not 0 <= factor <= 2:
             logger.error("Invalid factor: %s", factor)
             return JsonResponse({"error": "Factor must be between 0 and 2"}, status=400)
         try:
-            processor = ImageProcessor(image)
-            if tool == "brightness":
-                processor.adjust_brightness(factor)
-            elif tool == "contrast":
-                processor.adjust_contrast(factor)
-            elif tool == "saturation":
-                processor.adjust_saturation(factor)
-            elif tool == "hue":
-                processor.adjust_hue(factor)
-            else:
-                return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
-            logger.info("Adjusted image: %s with factor %s", tool, factor)
-            return HttpResponse(processed, content_type="image/png")
+            with _open_processor(request, settings.PREVIEW_MAX_EDGE if preview else None) as processor:
+                if preview:
+                    # Work on the cached low-res proxy; the full frame is left untouched.
+                    processor, _ = processor.preview(settings.PREVIEW_MAX_EDGE)
+                if tool == "brightness":
+                    processor.adjust_brightness(factor)
+                elif tool == "contrast":
+                    processor.adjust_contrast(factor)
+                elif tool == "saturation":
+                    processor.adjust_saturation(factor)
+                elif tool == "hue":
+                    processor.adjust_hue(factor)
+                else:
+                    return JsonResponse({"error": "Invalid tool"}, status=400)
+                if preview:
+                    processed, content_type = processor.save_preview()
+                    return HttpResponse(processed, content_type=content_type)
+                logger.info("Adjusted image: %s with factor %s", tool, factor)
+                return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Adjust image error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -102,13 +364,17 @@ def adjust_image(request, tool):
 
 
 @csrf_exempt
+@offload("filter_image")
+@cached_result(skip=lambda request, tool: tool == "noise")
 def filter_image(request, tool):
-    if request.method == "POST" and request.FILES.get("image"):
-        image = request.FILES["image"]
+    if request.method == "POST" and _has_image(request):
+        if _wants_job(request, "filter", tool):
+            return _enqueue_tool(request, "filter", tool)
         radius = float(request.POST.get("radius", 2.0)
                        ) if tool == "blur" else None
         intensity = float(request.POST.get("intensity", 0.5)) if tool in [
             "vignette", "noise"] else None
+        preview = request.POST.get("preview") == "1"
         if radius is not None and not 0 <= radius <= 10:
             logger.error("Invalid radius: %s", radius)
             return JsonResponse({"error": "Radius must be between 0 and 10"}, status=400)
@@ -116,38 +382,47 @@ def filter_image(request, tool):
             logger.error("Invalid intensity: %s", intensity)
             return JsonResponse({"error": "Intensity must be between 0 and 1"}, status=400)
         try:
-            processor = ImageProcessor(image)
-            if tool == "grayscale":
-                processor.grayscale()
-            elif tool == "sepia":
-                processor.sepia()
-            elif tool == "blur":
-                processor.blur(radius)
-            elif tool == "sharpen":
-                processor.sharpen()
-            elif tool == "edge_detection":
-                processor.edge_detection()
-            elif tool == "vignette":
-                processor.vignette(intensity)
-            elif tool == "noise":
-                processor.noise(intensity)
-            elif tool == "hdr":
-                processor.hdr()
-            elif tool == "cartoon":
-                processor.cartoon()
-            elif tool == "oil_painting":
-                processor.oil_painting()
-            elif tool == "watercolor":
-                processor.watercolor()
-            elif tool == "sketch":
-                processor.sketch()
-            elif tool == "emboss":
-                processor.emboss()
-            else:
-                return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
-            logger.info("Filtered image: %s", tool)
-            return HttpResponse(processed, content_type="image/png")
+            with _open_processor(request, settings.PREVIEW_MAX_EDGE if preview else None) as processor:
+                scale = 1.0
+                if preview:
+                    # Work on the cached low-res proxy; the full frame is left untouched.
+                    processor, scale = processor.preview(settings.PREVIEW_MAX_EDGE)
+                if tool == "grayscale":
+                    processor.grayscale()
+                elif tool == "sepia":
+                    processor.sepia()
+                elif tool == "blur":
+                    processor.blur(radius * scale)
+                elif tool == "sharpen":
+                    processor.sharpen()
+                elif tool == "edge_detection":
+                    processor.edge_detection()
+                elif tool == "vignette":
+                    processor.vignette(intensity)
+                elif tool == "noise":
+                    processor.noise(intensity)
+                elif tool == "hdr":
+                    processor.hdr()
+                elif tool == "cartoon":
+                    processor.cartoon()
+                elif tool == "oil_painting":
+                    processor.oil_painting()
+                elif tool == "watercolor":
+                    processor.watercolor()
+                elif tool == "sketch":
+                    processor.sketch()
+                elif tool == "emboss":
+                    processor.emboss()
+                else:
+                    return JsonResponse({"error": "Invalid tool"}, status=400)
+                if preview:
+                    processed, content_type = processor.save_preview()
+                    return HttpResponse(processed, content_type=content_type)
+                logger.info("Filtered image: %s", tool)
+                return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Filter image error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -156,45 +431,53 @@ def filter_image(request, tool):
 
 
 @csrf_exempt
+@offload("transform_image")
+@cached_result()
 def transform_image(request, tool):
-    if request.method == "POST" and request.FILES.get("image"):
-        image = request.FILES["image"]
+    if request.method == "POST" and _has_image(request):
         params = {}
         try:
-            processor = ImageProcessor(image)
-            if tool == "apply-crop":
-                params = {
-                    "left": int(request.POST.get("left", 0)),
-                    "top": int(request.POST.get("top", 0)),
-                    "right": int(request.POST.get("right", 0)),
-                    "bottom": int(request.POST.get("bottom", 0)),
-                }
-                if any(v < 0 for v in params.values()):
-                    return JsonResponse({"error": "Crop values must be non-negative"}, status=400)
-                processor.crop(**params)
-            elif tool == "apply-resize":
-                params = {
-                    "width": int(request.POST.get("width", 0)),
-                    "height": int(request.POST.get("height", 0)),
-                }
-                if params["width"] <= 0 or params["height"] <= 0:
-                    return JsonResponse({"error": "Width and height must be positive"}, status=400)
-                processor.resize(**params)
-            elif tool == "rotate":
-                angle = int(request.POST.get("angle", 0))
-                if angle not in [90, 180, 270]:
-                    return JsonResponse({"error": "Angle must be 90, 180, or 270"}, status=400)
-                processor.rotate(angle)
-            elif tool == "flip":
-                direction = request.POST.get("direction", "horizontal")
-                if direction not in ["horizontal", "vertical"]:
-                    return JsonResponse({"error": "Direction must be horizontal or vertical"}, status=400)
-                processor.flip(direction)
-            else:
-                return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
-            logger.info("Transformed image: %s with params %s", tool, params)
-            return HttpResponse(processed, content_type="image/png")
+            draft_size = None
+            if tool == "apply-resize":
+                draft_size = (int(request.POST.get("width", 0)), int(request.POST.get("height", 0)))
+                if min(draft_size) <= 0:
+                    draft_size = None
+            with _open_processor(request, draft_size) as processor:
+                if tool == "apply-crop":
+                    params = {
+                        "left": int(request.POST.get("left", 0)),
+                        "top": int(request.POST.get("top", 0)),
+                        "right": int(request.POST.get("right", 0)),
+                        "bottom": int(request.POST.get("bottom", 0)),
+                    }
+                    if any(v < 0 for v in params.values()):
+                        return JsonResponse({"error": "Crop values must be non-negative"}, status=400)
+                    processor.crop(**params)
+                elif tool == "apply-resize":
+                    params = {
+                        "width": int(request.POST.get("width", 0)),
+                        "height": int(request.POST.get("height", 0)),
+                    }
+                    if params["width"] <= 0 or params["height"] <= 0:
+                        return JsonResponse({"error": "Width and height must be positive"}, status=400)
+                    processor.resize(**params)
+                elif tool == "rotate":
+                    angle = int(request.POST.get("angle", 0))
+                    if angle not in [90, 180, 270]:
+                        return JsonResponse({"error": "Angle must be 90, 180, or 270"}, status=400)
+                    processor.rotate(angle)
+                elif tool == "flip":
+                    direction = request.POST.get("direction", "horizontal")
+                    if direction not in ["horizontal", "vertical"]:
+                        return JsonResponse({"error": "Direction must be horizontal or vertical"}, status=400)
+                    processor.flip(direction)
+                else:
+                    return JsonResponse({"error": "Invalid tool"}, status=400)
+                logger.info("Transformed image: %s with params %s", tool, params)
+                return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Transform image error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -203,68 +486,74 @@ def transform_image(request, tool):
 
 
 @csrf_exempt
+@offload("premium")
+@cached_result()
 def premium(request, tool):
-    if request.method == "POST" and request.FILES.get("image"):
+    if request.method == "POST" and _has_image(request):
+        if _wants_job(request, "premium", tool):
+            return _enqueue_tool(request, "premium", tool)
         try:
-            processor = ImageProcessor(request.FILES["image"])
-            if tool == "super-resolution":
-                scale = int(request.POST.get("scale", 2))
-                processor.super_resolution(scale)
-            elif tool == "auto-enhance":
-                processor.auto_enhance()
-            elif tool == "colorize":
-                processor.colorize()
-            elif tool == "remove-background":
-                processor.remove_background()
-            elif tool == "apply-inpaint":
-                x = int(request.POST.get("x", 0))
-                y = int(request.POST.get("y", 0))
-                radius = int(request.POST.get("radius", 10))
-                if radius <= 0:
-                    return JsonResponse({"error": "Radius must be positive"}, status=400)
-                processor.inpaint(x, y, radius)
-            elif tool == "apply-face":
-                action = request.POST.get("action", "crop")
-                if action not in ["crop", "blur"]:
-                    return JsonResponse({"error": "Invalid face action"}, status=400)
-                processor.face_detection(action)
-            elif tool == "restore":
-                processor.restore()
-            elif tool == "compress":
-                target_size = int(request.POST.get("target_size", 100))
-                format = request.POST.get("format", "JPEG")
-                processor.compress_image(target_size, format)
-            elif tool == "red-eye":
-                processor.remove_red_eye()
-            elif tool == "denoise":
-                strength = int(request.POST.get("strength", 10))
-                processor.denoise(strength)
-            elif tool == "perspective":
-                points = [
-                    (int(request.POST.get("x1", 0)),
-                     int(request.POST.get("y1", 0))),
-                    (int(request.POST.get("x2", 0)),
-                     int(request.POST.get("y2", 0))),
-                    (int(request.POST.get("x3", 0)),
-                     int(request.POST.get("y3", 0))),
-                    (int(request.POST.get("x4", 0)),
-                     int(request.POST.get("y4", 0))),
-                ]
-                processor.perspective_correction(points)
-            elif tool == "color-pop":
-                hue_range = (int(request.POST.get("hue_min", 0)),
-                             int(request.POST.get("hue_max", 180)))
-                tolerance = int(request.POST.get("tolerance", 30))
-                processor.color_pop(hue_range, tolerance)
-            elif tool == "add-border":
-                width = int(request.POST.get("width", 10))
-                color = request.POST.get("color", "#ffffff")
-                processor.add_border(width, color)
-            else:
-                return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
-            logger.info("Premium tool applied: %s", tool)
-            return HttpResponse(processed, content_type="image/png")
+            with _open_processor(request) as processor:
+                if tool == "super-resolution":
+                    scale = int(request.POST.get("scale", 2))
+                    processor.super_resolution(scale)
+                elif tool == "auto-enhance":
+                    processor.auto_enhance()
+                elif tool == "colorize":
+                    processor.colorize()
+                elif tool == "remove-background":
+                    processor.remove_background(**_background_params(request.POST))
+                elif tool == "apply-inpaint":
+                    x = int(request.POST.get("x", 0))
+                    y = int(request.POST.get("y", 0))
+                    radius = int(request.POST.get("radius", 10))
+                    if radius <= 0:
+                        return JsonResponse({"error": "Radius must be positive"}, status=400)
+                    processor.inpaint(x, y, radius)
+                elif tool == "apply-face":
+                    action = request.POST.get("action", "crop")
+                    if action not in ["crop", "blur"]:
+                        return JsonResponse({"error": "Invalid face action"}, status=400)
+                    processor.face_detection(action)
+                elif tool == "restore":
+                    processor.restore(**_denoise_params(request.POST))
+                elif tool == "compress":
+                    target_size = int(request.POST.get("target_size", 100))
+                    format = request.POST.get("format", "JPEG")
+                    processor.compress_image(target_size, format)
+                elif tool == "red-eye":
+                    processor.remove_red_eye()
+                elif tool == "denoise":
+                    strength = int(request.POST.get("strength", 10))
+                    processor.denoise(strength, **_denoise_params(request.POST))
+                elif tool == "perspective":
+                    points = [
+                        (int(request.POST.get("x1", 0)),
+                         int(request.POST.get("y1", 0))),
+                        (int(request.POST.get("x2", 0)),
+                         int(request.POST.get("y2", 0))),
+                        (int(request.POST.get("x3", 0)),
+                         int(request.POST.get("y3", 0))),
+                        (int(request.POST.get("x4", 0)),
+                         int(request.POST.get("y4", 0))),
+                    ]
+                    processor.perspective_correction(points)
+                elif tool == "color-pop":
+                    hue_range = (int(request.POST.get("hue_min", 0)),
+                                 int(request.POST.get("hue_max", 180)))
+                    tolerance = int(request.POST.get("tolerance", 30))
+                    processor.color_pop(hue_range, tolerance)
+                elif tool == "add-border":
+                    width = int(request.POST.get("width", 10))
+                    color = request.POST.get("color", "#ffffff")
+                    processor.add_border(width, color)
+                else:
+                    return JsonResponse({"error": "Invalid tool"}, status=400)
+                logger.info("Premium tool applied: %s", tool)
+                return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Premium tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -273,37 +562,41 @@ def premium(request, tool):
 
 
 @csrf_exempt
+@offload("text")
+@cached_result()
 def text(request, tool):
-    if request.method == "POST" and request.FILES.get("image"):
+    if request.method == "POST" and _has_image(request):
         try:
-            processor = ImageProcessor(request.FILES["image"])
-            if tool == "apply-text":
-                content = request.POST.get("content", "")
-                x = int(request.POST.get("x", 0))
-                y = int(request.POST.get("y", 0))
-                size = int(request.POST.get("size", 20))
-                color = request.POST.get("color", "#ffffff")
-                if not content:
-                    return JsonResponse({"error": "Text content required"}, status=400)
-                if size <= 0:
-                    return JsonResponse({"error": "Size must be positive"}, status=400)
-                processor.add_text(content, x, y, size, color)
-            elif tool == "apply-watermark":
-                text = request.POST.get("text", "")
-                opacity = float(request.POST.get("opacity", 0.5))
-                if not text:
-                    return JsonResponse({"error": "Watermark text required"}, status=400)
-                if not 0 <= opacity <= 1:
-                    return JsonResponse({"error": "Opacity must be between 0 and 1"}, status=400)
-                processor.watermark(text, opacity)
-            elif tool == "extract-text":
-                text = processor.extract_text()
-                return HttpResponse(text, content_type="text/plain")
-            else:
-                return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
-            logger.info("Text tool applied: %s", tool)
-            return HttpResponse(processed, content_type="image/png")
+            with _open_processor(request) as processor:
+                if tool == "apply-text":
+                    content = request.POST.get("content", "")
+                    x = int(request.POST.get("x", 0))
+                    y = int(request.POST.get("y", 0))
+                    size = int(request.POST.get("size", 20))
+                    color = request.POST.get("color", "#ffffff")
+                    if not content:
+                        return JsonResponse({"error": "Text content required"}, status=400)
+                    if size <= 0:
+                        return JsonResponse({"error": "Size must be positive"}, status=400)
+                    processor.add_text(content, x, y, size, color)
+                elif tool == "apply-watermark":
+                    text = request.POST.get("text", "")
+                    opacity = float(request.POST.get("opacity", 0.5))
+                    if not text:
+                        return JsonResponse({"error": "Watermark text required"}, status=400)
+                    if not 0 <= opacity <= 1:
+                        return JsonResponse({"error": "Opacity must be between 0 and 1"}, status=400)
+                    processor.watermark(text, opacity)
+                elif tool == "extract-text":
+                    text = processor.extract_text()
+                    return HttpResponse(text, content_type="text/plain")
+                else:
+                    return JsonResponse({"error": "Invalid tool"}, status=400)
+                logger.info("Text tool applied: %s", tool)
+                return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Text tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -312,21 +605,25 @@ def text(request, tool):
 
 
 @csrf_exempt
+@offload("meme")
+@cached_result()
 def meme(request, tool):
-    if request.method == "POST" and request.FILES.get("image"):
+    if request.method == "POST" and _has_image(request):
         try:
-            processor = ImageProcessor(request.FILES["image"])
-            if tool == "apply-meme":
-                top = request.POST.get("top", "")
-                bottom = request.POST.get("bottom", "")
-                if not top and not bottom:
-                    return JsonResponse({"error": "At least one text required"}, status=400)
-                processor.meme_generator(top, bottom)
-            else:
-                return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
-            logger.info("Meme tool applied")
-            return HttpResponse(processed, content_type="image/png")
+            with _open_processor(request) as processor:
+                if tool == "apply-meme":
+                    top = request.POST.get("top", "")
+                    bottom = request.POST.get("bottom", "")
+                    if not top and not bottom:
+                        return JsonResponse({"error": "At least one text required"}, status=400)
+                    processor.meme_generator(top, bottom)
+                else:
+                    return JsonResponse({"error": "Invalid tool"}, status=400)
+                logger.info("Meme tool applied")
+                return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Meme tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -335,25 +632,30 @@ def meme(request, tool):
 
 
 @csrf_exempt
+@offload("collage")
+@cached_result()
 def collage(request, tool):
     if request.method == "POST" and request.FILES.getlist("image"):
         try:
             images = request.FILES.getlist("image")
             if not images:
                 return JsonResponse({"error": "At least one image required"}, status=400)
-            processor = ImageProcessor(images[0])
+            if tool == "stitch" and request.POST.get("async") == "1":
+                return _enqueue_stitch(request, images)
             if tool == "apply-collage":
                 layout = request.POST.get("layout", "2x2")
                 if layout not in ["2x2", "3x1", "1x3", "1x2", "2x1"]:
                     return JsonResponse({"error": "Invalid layout"}, status=400)
-                processor.collage(images, layout)
+                processor = ImageProcessor.from_collage(images, layout)
             elif tool == "stitch":
-                processor.stitch_images(images)
+                processor = ImageProcessor.from_stitch(images)
             else:
                 return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
             logger.info("Collage tool applied: %s", tool)
-            return HttpResponse(processed, content_type="image/png")
+            return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Collage tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -361,7 +663,32 @@ def collage(request, tool):
     return JsonResponse({"error": "Invalid request"}, status=400)
 
 
+def _enqueue_stitch(request, images):
+    formats = _output_formats(request)
+    if formats[False] is None:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+    payloads = [image.read() for image in images]
+    try:
+        for payload in payloads:
+            probe(io.BytesIO(payload))
+    except ImageTooLarge as e:
+        return JsonResponse({"error": str(e)}, status=413)
+    except OSError:
+        return JsonResponse({"error": "Invalid image file"}, status=400)
+
+    def work(job):
+        job.progress(0.1, "stitching")
+        processor = ImageProcessor.from_stitch([io.BytesIO(payload) for payload in payloads])
+        job.progress(0.9, "encoding")
+        output_format = formats[processor.pixels.shape[2] == 4]
+        return processor.save_image(output_format), CONTENT_TYPES[output_format]
+
+    return _enqueue(request, "collage/stitch", work)
+
+
 @csrf_exempt
+@offload("layers")
+@cached_result()
 def layers(request, tool):
     if request.method == "POST" and request.FILES.get("image"):
         try:
@@ -378,9 +705,11 @@ def layers(request, tool):
                 processor.add_layer(new_image)
             else:
                 return JsonResponse({"error": "Invalid tool"}, status=400)
-            processed = processor.save_image()
             logger.info("Layers tool applied")
-            return HttpResponse(processed, content_type="image/png")
+            return _image_response(request, processor)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Layers tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -389,16 +718,24 @@ def layers(request, tool):
 
 
 @csrf_exempt
+@offload("palette")
+@cached_result()
 def palette(request, tool):
-    if request.method == "POST" and request.FILES.get("image"):
+    if request.method == "POST" and _has_image(request):
         try:
-            processor = ImageProcessor(request.FILES["image"])
-            if tool == "extract-palette":
-                num_colors = int(request.POST.get("num_colors", 5))
-                palette = processor.extract_palette(num_colors)
-                logger.info("Palette extracted")
-                return HttpResponse(str(palette), content_type="text/plain")
-            return JsonResponse({"error": "Invalid tool"}, status=400)
+            with _open_processor(request) as processor:
+                if tool == "extract-palette":
+                    num_colors = int(request.POST.get("num_colors", 5))
+                    mode = request.POST.get("mode", "fast")
+                    if mode not in PALETTE_MODES:
+                        return JsonResponse({"error": "Invalid palette mode"}, status=400)
+                    palette = processor.extract_palette(num_colors, mode)
+                    logger.info("Palette extracted")
+                    return JsonResponse({"palette": palette})
+                return JsonResponse({"error": "Invalid tool"}, status=400)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Palette tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -407,10 +744,19 @@ def palette(request, tool):
 
 
 @csrf_exempt
+@offload("format")
+@cached_result()
 def format(request, tool):
     if request.method == "POST" and request.FILES.get("image"):
+        if _wants_job(request, "format", tool):
+            return _enqueue_tool(request, "format", tool)
         try:
-            processor = ImageProcessor(request.FILES["image"])
+            draft_size = None
+            if tool == "convert-format":
+                draft_size = (int(request.POST.get("width", 0)), int(request.POST.get("height", 0)))
+                if min(draft_size) <= 0:
+                    draft_size = None
+            processor = ImageProcessor(request.FILES["image"], draft_size=draft_size)
             if tool == "convert-format":
                 format = request.POST.get("format", "jpeg").lower()
                 if format not in ["jpeg", "png", "webp", "bmp", "gif", "tiff"]:
@@ -437,11 +783,14 @@ def format(request, tool):
                 logger.info("Format converted: %s", format)
                 return HttpResponse(processed, content_type=f"image/{format}")
             elif tool == "remove-background":
-                processor.remove_background()
+                processor.remove_background(**_background_params(request.POST))
                 processed = processor.save_image(format="PNG")
                 logger.info("Background removed")
                 return HttpResponse(processed, content_type="image/png")
             return JsonResponse({"error": "Invalid tool"}, status=400)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Format tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -450,6 +799,8 @@ def format(request, tool):
 
 
 @csrf_exempt
+@offload("compressor_tool")
+@cached_result()
 def compressor(request, tool):
     if request.method == "POST" and request.FILES.get("image"):
         try:
@@ -481,6 +832,9 @@ def compressor(request, tool):
                 logger.info("Image compressed: %s", format)
                 return HttpResponse(processed, content_type=f"image/{format.lower()}")
             return JsonResponse({"error": "Invalid tool"}, status=400)
+        except ImageTooLarge as e:
+            logger.error("Image too large: %s", str(e))
+            return JsonResponse({"error": str(e)}, status=413)
         except Exception as e:
             logger.error("Compressor tool error: %s", str(e))
             return JsonResponse({"error": str(e)}, status=500)
@@ -488,6 +842,109 @@ def compressor(request, tool):
     return JsonResponse({"error": "Invalid request"}, status=400)
 
 
+@csrf_exempt
+@offload("pipeline")
+@cached_result(skip=lambda request: "noise" in request.POST.get("operations", ""))
+def pipeline(request):
+    """Apply an ordered list of operations and encode the result once."""
+    if request.method != "POST":
+        logger.error("Invalid pipeline request")
+        return JsonResponse({"error": "Invalid request"}, status=400)
+
+    if request.content_type == "application/json":
+        try:
+            payload = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "Invalid JSON body"}, status=400)
+        if not isinstance(payload, dict):
+            return JsonResponse({"error": "Invalid JSON body"}, status=400)
+    else:
+        payload = request.POST
+
+    try:
+        steps = parse_steps(payload.get("operations", ""))
+    except PipelineError as e:
+        logger.error("Invalid pipeline: %s", str(e))
+        return JsonResponse({"error": str(e)}, status=400)
+
+    requested = payload.get("format")
+    if requested and normalize(requested) is None:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+
+    if not request.FILES.get("image"):
+        if payload.get("image_ref") != "studio":
+            return JsonResponse({"error": "Image or image_ref required"}, status=400)
+        if _studio_image_path(request) is None:
+            logger.error("No studio image for pipeline")
+            return JsonResponse({"error": "No studio image"}, status=404)
+
+    try:
+        with _open_processor(request) as processor:
+            run_pipeline(processor, steps)
+            output_format = negotiate(request, processor.pixels.shape[2] == 4, requested)
+            processed = processor.save_image(format=output_format)
+        logger.info("Pipeline applied: %s", [op for op, _ in steps])
+        response = HttpResponse(processed, content_type=CONTENT_TYPES[output_format])
+        patch_vary_headers(response, ["Accept"])
+        if processor.denoise_tier:
+            response["X-Denoise-Tier"] = processor.denoise_tier
+        return response
+    except ImageTooLarge as e:
+        logger.error("Image too large: %s", str(e))
+        return JsonResponse({"error": str(e)}, status=413)
+    except ValueError as e:
+        logger.error("Pipeline error: %s", str(e))
+        return JsonResponse({"error": str(e)}, status=400)
+    except Exception as e:
+        logger.error("Pipeline error: %s", str(e))
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+@csrf_exempt
+@offload("batch")
+def batch(request):
+    """Run one pipeline over many uploads and stream results as they finish."""
+    if request.method != "POST":
+        logger.error("Invalid batch request")
+        return JsonResponse({"error": "Invalid request"}, status=400)
+
+    images = request.FILES.getlist("image")
+    if not images:
+        return JsonResponse({"error": "At least one image required"}, status=400)
+    if len(images) > settings.BATCH_MAX_FILES:
+        return JsonResponse({"error": f"At most {settings.BATCH_MAX_FILES} images per batch"}, status=400)
+
+    try:
+        steps = parse_steps(request.POST.get("operations", ""), allow_empty=True)
+    except PipelineError as e:
+        logger.error("Invalid batch pipeline: %s", str(e))
+        return JsonResponse({"error": str(e)}, status=400)
+
+    output_format = request.POST.get("format", "jpeg").upper()
+    if output_format not in ["JPEG", "PNG", "WEBP"]:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+
+    results = iter_batch(images, steps, output_format)
+    logger.info("Batch started: %d images, %s", len(images), [op for op, _ in steps])
+    if request.POST.get("container", "zip") == "multipart":
+        boundary = multipart_boundary()
+        return StreamingHttpResponse(stream_multipart(results, boundary),
+                                     content_type=f"multipart/mixed; boundary={boundary}")
+    response = StreamingHttpResponse(stream_zip(results), content_type="application/zip")
+    response["Content-Disposition"] = 'attachment; filename="batch.zip"'
+    return response
+
+
+def cache_stats(request):
+    """Hit ratio and size of the tool result cache (this process's counters)."""
+    return JsonResponse(result_cache.stats())
+
+
+def metrics_view(request):
+    """Request and operation histograms plus cache gauges, in Prometheus text format."""
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 def compressor_page(request):
     return render(request, "compressor.html")
 
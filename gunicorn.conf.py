@@ -0,0 +1,21 @@
+"""Gunicorn settings picked up automatically from the working directory."""
+import os
+
+
+def post_fork(server, worker):
+    """Load cascades and fonts in each worker before it takes requests."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "clarifi.settings")
+    import django
+
+    django.setup()
+    from editor.utils.resources import warm_up
+
+    warm_up()
+
+
+def when_ready(server):
+    """With --preload, import the imaging libraries in the master so workers share them."""
+    if server.cfg.preload_app:
+        from editor.utils.lazy import preload
+
+        preload()
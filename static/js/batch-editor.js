@@ -122,31 +122,60 @@ document.addEventListener('DOMContentLoaded', () => {
         processedImages = [];
         applyBatchButton.disabled = true;
         updateBatchProgress(0);
+        updateBatchStatus(`Processing ${batchFiles.length} images`);
 
-        for (let i = 0; i < batchFiles.length; i++) {
-            try {
-                updateBatchStatus(`Processing ${i + 1}/${batchFiles.length}: ${batchFiles[i].name}`);
-                const result = await processImage(batchFiles[i], i);
-                processedImages.push(result);
-                updateBatchProgress(((i + 1) / batchFiles.length) * 100);
-            } catch (error) {
-                console.error(`Error processing ${batchFiles[i].name}:`, error);
-                updateBatchStatus(`Error processing ${batchFiles[i].name}: ${error.message}`, true);
+        const formData = new FormData();
+        batchFiles.forEach(file => formData.append('image', file));
+        try {
+            const { steps, format } = batchSteps();
+            formData.append('operations', JSON.stringify(steps));
+            formData.append('format', format);
+            formData.append('container', 'multipart');
+
+            const response = await fetch('/batch', {
+                method: 'POST',
+                body: formData,
+                headers: { 'X-CSRFToken': getCookie('csrftoken') }
+            });
+            if (!response.ok) {
+                const data = await response.json().catch(() => ({}));
+                throw new Error(data.error || `HTTP ${response.status}`);
+            }
+
+            // Results arrive in completion order, one part per image.
+            let finished = 0;
+            for await (const part of readMultipart(response)) {
+                const index = parseInt(part.headers['x-batch-index'], 10);
+                const file = batchFiles[index];
+                finished++;
+                updateBatchProgress((finished / batchFiles.length) * 100);
+                if (part.headers['content-type'].startsWith('image/')) {
+                    processedImages.push({
+                        blob: new Blob([part.body], { type: part.headers['content-type'] }),
+                        originalName: file.name,
+                        index
+                    });
+                    updateBatchStatus(`Processed ${finished}/${batchFiles.length}: ${file.name}`);
+                } else {
+                    const message = new TextDecoder().decode(part.body);
+                    console.error(`Error processing ${file.name}:`, message);
+                    updateBatchStatus(`Error processing ${file.name}: ${message}`, true);
+                }
             }
+        } catch (error) {
+            console.error('Batch error:', error);
+            updateBatchStatus(`Batch error: ${error.message}`, true);
         }
 
+        processedImages.sort((a, b) => a.index - b.index);
         applyBatchButton.disabled = false;
         updateBatchStatus(`Batch processing complete: ${processedImages.length}/${batchFiles.length} images processed`);
         displayProcessedImages();
     }
 
-    async function processImage(file, index) {
+    function batchSteps() {
         const operation = batchOperation.value;
-        const formData = new FormData();
-        formData.append('image', file);
 
-        let endpoint = '';
-        
         switch (operation) {
             case 'grayscale':
             case 'sepia':
@@ -158,61 +187,94 @@ document.addEventListener('DOMContentLoaded', () => {
             case 'watercolor':
             case 'sketch':
             case 'emboss':
-                endpoint = `/filter/${operation}`;
-                break;
+                return { steps: [{ op: operation }], format: 'png' };
             case 'brightness':
             case 'contrast':
             case 'saturation':
-                endpoint = `/adjust/${operation}`;
-                formData.append('factor', document.getElementById('batch-factor')?.value || 1);
-                break;
+                return {
+                    steps: [{ op: `adjust_${operation}`, params: { factor: document.getElementById('batch-factor')?.value || 1 } }],
+                    format: 'png'
+                };
             case 'blur':
-                endpoint = '/filter/blur';
-                formData.append('radius', document.getElementById('batch-radius')?.value || 2);
-                break;
+                return {
+                    steps: [{ op: 'blur', params: { radius: document.getElementById('batch-radius')?.value || 2 } }],
+                    format: 'png'
+                };
             case 'resize':
-                endpoint = '/transform/apply-resize';
-                formData.append('width', document.getElementById('batch-width')?.value || 0);
-                formData.append('height', document.getElementById('batch-height')?.value || 0);
-                break;
+                return {
+                    steps: [{ op: 'resize', params: {
+                        width: document.getElementById('batch-width')?.value || 0,
+                        height: document.getElementById('batch-height')?.value || 0
+                    } }],
+                    format: 'png'
+                };
             case 'rotate':
-                endpoint = '/transform/rotate';
-                formData.append('angle', document.getElementById('batch-angle')?.value || 90);
-                break;
+                return {
+                    steps: [{ op: 'rotate', params: { angle: document.getElementById('batch-angle')?.value || 90 } }],
+                    format: 'png'
+                };
             case 'flip':
-                endpoint = '/transform/flip';
-                formData.append('direction', document.getElementById('batch-direction')?.value || 'horizontal');
-                break;
+                return {
+                    steps: [{ op: 'flip', params: { direction: document.getElementById('batch-direction')?.value || 'horizontal' } }],
+                    format: 'png'
+                };
             case 'auto-enhance':
             case 'colorize':
             case 'super-resolution':
             case 'restore':
-                endpoint = `/premium/${operation}`;
-                break;
+                return { steps: [{ op: operation.replace('-', '_') }], format: 'png' };
             case 'format':
-                endpoint = '/format/convert-format';
-                formData.append('format', document.getElementById('batch-format')?.value || 'jpeg');
-                break;
+                return { steps: [], format: document.getElementById('batch-format')?.value || 'jpeg' };
             default:
                 throw new Error('Unknown operation');
         }
+    }
 
-        const response = await fetch(endpoint, {
-            method: 'POST',
-            body: formData,
-            headers: { 'X-CSRFToken': getCookie('csrftoken') }
-        });
-
-        if (!response.ok) {
-            throw new Error(`HTTP ${response.status}`);
-        }
+    // Incrementally parse the multipart/mixed stream returned by /batch.
+    // Every part carries a Content-Length header, so no boundary scanning
+    // inside image data is needed.
+    async function* readMultipart(response) {
+        const boundary = response.headers.get('Content-Type').match(/boundary=([^;]+)/)[1];
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = new Uint8Array(0);
 
-        const blob = await response.blob();
-        return {
-            blob,
-            originalName: file.name,
-            index
+        const readMore = async () => {
+            const { done, value } = await reader.read();
+            if (done) return false;
+            const next = new Uint8Array(buffer.length + value.length);
+            next.set(buffer);
+            next.set(value, buffer.length);
+            buffer = next;
+            return true;
         };
+        const headerEnd = () => {
+            for (let i = 0; i + 3 < buffer.length; i++) {
+                if (buffer[i] === 13 && buffer[i + 1] === 10 && buffer[i + 2] === 13 && buffer[i + 3] === 10) return i;
+            }
+            return -1;
+        };
+
+        while (true) {
+            let end = headerEnd();
+            while (end === -1) {
+                if (decoder.decode(buffer).startsWith(`--${boundary}--`)) return;
+                if (!(await readMore())) return;
+                end = headerEnd();
+            }
+            const headers = {};
+            decoder.decode(buffer.subarray(0, end)).split('\r\n').slice(1).forEach(line => {
+                const split = line.indexOf(':');
+                headers[line.slice(0, split).trim().toLowerCase()] = line.slice(split + 1).trim();
+            });
+            const start = end + 4;
+            const length = parseInt(headers['content-length'], 10);
+            while (buffer.length < start + length + 2) {
+                if (!(await readMore())) throw new Error('Batch response ended early');
+            }
+            yield { headers, body: buffer.slice(start, start + length) };
+            buffer = buffer.slice(start + length + 2);
+        }
     }
 
     function displayProcessedImages() {
@@ -246,7 +308,7 @@ document.addEventListener('DOMContentLoaded', () => {
         link.href = URL.createObjectURL(result.blob);
         const nameWithoutExt = result.originalName.split('.').slice(0, -1).join('.');
         const operation = batchOperation.value;
-        link.download = `${nameWithoutExt}_${operation}_clarifi.png`;
+        link.download = `${nameWithoutExt}_${operation}_clarifi.${result.blob.type.split('/')[1].replace('jpeg', 'jpg')}`;
         document.body.appendChild(link);
         link.click();
         document.body.removeChild(link);
@@ -202,6 +202,19 @@ document.addEventListener('DOMContentLoaded', () => {
         showFeedback("IMAGE CLEARED");
     }
 
+    // GrabCut runs as a server-side job; poll it until the result is ready.
+    async function waitForJob(job) {
+        let delay = 250;
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay = Math.min(delay * 1.5, 2000);
+            const response = await fetch(job.status_url, { credentials: "same-origin" });
+            const status = await response.json().catch(() => ({}));
+            if (!response.ok || status.status === "failed") return new Response(JSON.stringify(status), { status: 500 });
+            if (status.status === "done") return fetch(job.result_url, { credentials: "same-origin" });
+        }
+    }
+
     function removeBackground() {
         console.log("Attempting to remove background");
         if (!currentImageFile || originalCanvas.width === 0 || originalCanvas.height === 0) {
@@ -213,6 +226,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         const formData = new FormData();
         formData.append("image", currentImageFile);
+        formData.append("async", "1");
 
         fetch("/format/remove-background", {
             method: "POST",
@@ -220,6 +234,7 @@ document.addEventListener('DOMContentLoaded', () => {
             headers: { "X-CSRFToken": getCookie("csrftoken") },
             credentials: "same-origin",
         })
+            .then((response) => response.status === 202 ? response.json().then(waitForJob) : response)
             .then((response) => {
                 if (!response.ok) {
                     return response.text().then(text => {
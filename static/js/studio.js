@@ -91,14 +91,16 @@ document.addEventListener('DOMContentLoaded', () => {
   let currentImageFile = null,
     originalImageData = null,
     currentImageObject = null,
-    history = [],
-    historyIndex = -1,
-    MAX_HISTORY = 10,
+    historyCursor = 0,
+    historyLength = 0,
     originalWidth = 0,
     originalHeight = 0,
     isLoading = false,
     loadingInterval = null,
-    lastClickTime = 0;
+    lastClickTime = 0,
+    serverImageReady = false,
+    previewInFlight = false,
+    pendingPreview = null;
 
   init();
 
@@ -142,10 +144,15 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     // Adjustment controls
-    brightnessSlider?.addEventListener('input', () => applyAdjustment('brightness', brightnessSlider.value));
-    contrastSlider?.addEventListener('input', () => applyAdjustment('contrast', contrastSlider.value));
-    saturationSlider?.addEventListener('input', () => applyAdjustment('saturation', saturationSlider.value));
-    hueSlider?.addEventListener('input', () => applyAdjustment('hue', (hueSlider.value - 0.5)));
+    // Dragging requests low-res previews; releasing the slider renders at full resolution.
+    brightnessSlider?.addEventListener('input', () => previewAdjustment('brightness', brightnessSlider.value));
+    contrastSlider?.addEventListener('input', () => previewAdjustment('contrast', contrastSlider.value));
+    saturationSlider?.addEventListener('input', () => previewAdjustment('saturation', saturationSlider.value));
+    hueSlider?.addEventListener('input', () => previewAdjustment('hue', (hueSlider.value - 0.5)));
+    brightnessSlider?.addEventListener('change', () => applyAdjustment('brightness', brightnessSlider.value));
+    contrastSlider?.addEventListener('change', () => applyAdjustment('contrast', contrastSlider.value));
+    saturationSlider?.addEventListener('change', () => applyAdjustment('saturation', saturationSlider.value));
+    hueSlider?.addEventListener('change', () => applyAdjustment('hue', (hueSlider.value - 0.5)));
     resetAdjustmentsButton?.addEventListener('click', resetAdjustments);
 
     // Filter controls
@@ -236,6 +243,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!file.type.startsWith("image/")) return void showFeedback("INVALID IMAGE FORMAT", true);
     
     currentImageFile = file;
+    uploadToSession(file);
     showFeedback("LOADING IMAGE...");
     
     const reader = new FileReader();
@@ -268,11 +276,117 @@ document.addEventListener('DOMContentLoaded', () => {
     reader.readAsDataURL(file);
   }
 
+  function uploadToSession(file) {
+    serverImageReady = false;
+    const formData = new FormData();
+    formData.append('image', file);
+
+    fetch('/upload', {
+      method: 'POST',
+      body: formData,
+      headers: { 'X-CSRFToken': getCookie('csrftoken') }
+    })
+    .then(response => {
+      if (!response.ok) return;
+      // An edit may have landed while the upload was in flight; send the latest image instead.
+      if (currentImageFile && currentImageFile !== file) return uploadToSession(currentImageFile);
+      serverImageReady = true;
+      saveHistory(true);
+    })
+    .catch(() => { serverImageReady = false; });
+  }
+
+  function appendImage(formData) {
+    // Once the server holds the image for this session, tools work on it there.
+    if (!serverImageReady) formData.append('image', currentImageFile);
+  }
+
+  // Slow tools run as server-side jobs; the request returns a job to poll.
+  const ASYNC_TOOLS = {
+    filter: ['hdr', 'oil_painting'],
+    premium: ['remove-background', 'restore', 'denoise', 'super-resolution']
+  };
+
+  async function fetchToolResult(view, tool, formData) {
+    if (ASYNC_TOOLS[view]?.includes(tool)) formData.append('async', '1');
+    let response = await fetch(`/${view}/${tool}`, {
+      method: 'POST',
+      body: formData,
+      headers: { 'X-CSRFToken': getCookie('csrftoken') }
+    });
+    if (response.status === 202) {
+      const job = await response.json();
+      response = await waitForJob(job.status_url, job.result_url);
+    }
+    if (!response.ok) {
+      const data = await response.json().catch(() => ({}));
+      throw new Error(data.error || `HTTP ${response.status}`);
+    }
+    return response.blob();
+  }
+
+  async function waitForJob(statusUrl, resultUrl) {
+    let delay = 250;
+    while (true) {
+      await new Promise(resolve => setTimeout(resolve, delay));
+      delay = Math.min(delay * 1.5, 2000);
+      const response = await fetch(statusUrl);
+      const status = await response.json().catch(() => ({}));
+      if (!response.ok || status.status === 'failed') throw new Error(status.error || `HTTP ${response.status}`);
+      if (status.status === 'done') return fetch(resultUrl);
+      showFeedback(`${status.stage || status.status} ${Math.round(status.progress * 100)}%`.toUpperCase());
+    }
+  }
+
+  function previewAdjustment(tool, factor) {
+    if (!currentImageFile) return;
+    // Keep one preview in flight and only the newest slider value queued behind it.
+    if (previewInFlight) {
+      pendingPreview = [tool, factor];
+      return;
+    }
+    previewInFlight = true;
+
+    const formData = new FormData();
+    appendImage(formData);
+    formData.append('factor', factor);
+    formData.append('preview', '1');
+
+    fetch(`/adjust/${tool}`, {
+      method: 'POST',
+      body: formData,
+      headers: { 'X-CSRFToken': getCookie('csrftoken') }
+    })
+    .then(response => response.ok ? response.blob() : null)
+    .then(blob => blob && drawPreviewFromBlob(blob))
+    .catch(() => {})
+    .finally(() => {
+      previewInFlight = false;
+      if (pendingPreview) {
+        const [nextTool, nextFactor] = pendingPreview;
+        pendingPreview = null;
+        previewAdjustment(nextTool, nextFactor);
+      }
+    });
+  }
+
+  function drawPreviewFromBlob(blob) {
+    const url = URL.createObjectURL(blob);
+    const img = new Image();
+    img.onload = () => {
+      // Previews are downscaled; stretch them over the full-size canvas.
+      ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
+      URL.revokeObjectURL(url);
+    };
+    img.src = url;
+  }
+
   function applyAdjustment(tool, factor) {
     if (!currentImageFile) return;
+    pendingPreview = null;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('factor', factor);
     
     fetch(`/adjust/${tool}`, {
@@ -292,14 +406,9 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     
-    fetch(`/filter/${tool}`, {
-      method: 'POST',
-      body: formData,
-      headers: { 'X-CSRFToken': getCookie('csrftoken') }
-    })
-    .then(response => response.blob())
+    fetchToolResult('filter', tool, formData)
     .then(blob => {
       loadImageFromBlob(blob);
       saveHistory();
@@ -311,7 +420,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append(paramName, paramValue);
     
     fetch(`/filter/${tool}`, {
@@ -336,7 +445,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const bottom = parseInt(cropBottomInput.value || 0);
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('left', left);
     formData.append('top', top);
     formData.append('right', right);
@@ -365,7 +474,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!width && !height) return showFeedback("ENTER WIDTH OR HEIGHT", true);
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('width', width || 0);
     formData.append('height', height || 0);
     
@@ -387,7 +496,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('angle', angle);
     
     fetch('/transform/rotate', {
@@ -408,7 +517,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('direction', direction);
     
     fetch('/transform/flip', {
@@ -429,7 +538,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile || !textContentInput?.value) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('content', textContentInput.value);
     formData.append('x', parseInt(textXInput?.value || 10));
     formData.append('y', parseInt(textYInput?.value || 10));
@@ -454,7 +563,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile || !watermarkTextInput?.value) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('text', watermarkTextInput.value);
     formData.append('opacity', parseFloat(watermarkOpacitySlider?.value || 0.5));
     
@@ -476,7 +585,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     
     fetch('/text/extract-text', {
       method: 'POST',
@@ -500,7 +609,7 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!topText && !bottomText) return showFeedback("ENTER TOP OR BOTTOM TEXT", true);
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('top', topText);
     formData.append('bottom', bottomText);
     
@@ -522,18 +631,13 @@ document.addEventListener('DOMContentLoaded', () => {
     if (!currentImageFile) return;
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     
     Object.keys(params).forEach(key => {
       formData.append(key, params[key]);
     });
     
-    fetch(`/premium/${tool}`, {
-      method: 'POST',
-      body: formData,
-      headers: { 'X-CSRFToken': getCookie('csrftoken') }
-    })
-    .then(response => response.blob())
+    fetchToolResult('premium', tool, formData)
     .then(blob => {
       loadImageFromBlob(blob);
       saveHistory();
@@ -550,7 +654,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const radius = parseInt(inpaintRadiusInput?.value || 10);
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('x', x);
     formData.append('y', y);
     formData.append('radius', radius);
@@ -575,7 +679,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const action = faceActionSelect?.value || 'crop';
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('action', action);
     
     fetch('/premium/apply-face', {
@@ -598,15 +702,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const strength = parseInt(denoiseStrengthInput?.value || 10);
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('strength', strength);
     
-    fetch('/premium/denoise', {
-      method: 'POST',
-      body: formData,
-      headers: { 'X-CSRFToken': getCookie('csrftoken') }
-    })
-    .then(response => response.blob())
+    fetchToolResult('premium', 'denoise', formData)
     .then(blob => {
       loadImageFromBlob(blob);
       saveHistory();
@@ -622,7 +721,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const hueMax = parseInt(colorPopHueMaxInput?.value || 180);
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('hue_min', hueMin);
     formData.append('hue_max', hueMax);
     formData.append('tolerance', 30);
@@ -648,7 +747,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const color = borderColorInput?.value || '#ffffff';
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('width', width);
     formData.append('color', color);
     
@@ -672,7 +771,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const numColors = parseInt(paletteColorsInput?.value || 5);
     
     const formData = new FormData();
-    formData.append('image', currentImageFile);
+    appendImage(formData);
     formData.append('num_colors', numColors);
     
     fetch('/palette/extract-palette', {
@@ -680,9 +779,14 @@ document.addEventListener('DOMContentLoaded', () => {
       body: formData,
       headers: { 'X-CSRFToken': getCookie('csrftoken') }
     })
-    .then(response => response.text())
+    .then(async response => {
+      const data = await response.json().catch(() => ({}));
+      if (!response.ok) throw new Error(data.error || `HTTP ${response.status}`);
+      return data.palette;
+    })
     .then(palette => {
-      showFeedback(`PALETTE: ${palette}`);
+      const colors = palette.map(color => `${color.hex} ${Math.round(color.weight * 100)}%`);
+      showFeedback(`PALETTE: ${colors.join(', ')}`);
       console.log('Extracted palette:', palette);
     })
     .catch(error => showFeedback(`ERROR: ${error.message}`, true));
@@ -700,7 +804,8 @@ document.addEventListener('DOMContentLoaded', () => {
       
       // Update currentImageFile with the processed image
       blob.arrayBuffer().then(buffer => {
-        const file = new File([buffer], 'processed.png', { type: 'image/png' });
+        const type = blob.type || 'image/png';
+        const file = new File([buffer], `processed.${type.split('/')[1]}`, { type });
         currentImageFile = file;
       });
     };
@@ -724,12 +829,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
   function clearCanvas() {
     currentImageFile = null;
+    serverImageReady = false;
     originalImageData = null;
     currentImageObject = null;
     canvas.width = 0;
     canvas.height = 0;
-    history = [];
-    historyIndex = -1;
+    historyCursor = 0;
+    historyLength = 0;
     updateHistoryButtons();
     updatePlaceholderVisibility();
     updateDimensionsDisplay();
@@ -751,56 +857,61 @@ document.addEventListener('DOMContentLoaded', () => {
     if (keepAspectCheckbox) keepAspectCheckbox.checked = true;
   }
 
+  // The server keeps the edit history of the session's image; the page only
+  // tracks its position to enable the buttons.
   function saveHistory(isInitial = false) {
-    if (!canvas.width || !canvas.height) return;
-    
-    const dataUrl = canvas.toDataURL();
-    if (!isInitial && historyIndex > -1 && dataUrl === history[historyIndex]) return;
-    
-    if (historyIndex < history.length - 1) {
-      history = history.slice(0, historyIndex + 1);
-    }
-    
-    history.push(dataUrl);
-    if (history.length > MAX_HISTORY) {
-      history.shift();
+    if (isInitial || !serverImageReady) {
+      historyCursor = 0;
+      historyLength = 0;
+      updateHistoryButtons();
+      if (!serverImageReady) return;
     }
-    
-    historyIndex = history.length - 1;
-    updateHistoryButtons();
+    fetch('/history')
+    .then(response => response.ok ? response.json() : null)
+    .then(status => {
+      if (!status) return;
+      historyCursor = status.cursor;
+      historyLength = status.length;
+      updateHistoryButtons();
+    })
+    .catch(() => {});
   }
 
   function undo() {
-    if (historyIndex <= 0) return showFeedback("CANNOT UNDO FURTHER", true);
-    historyIndex--;
-    restoreHistoryState();
-    showFeedback("UNDO COMPLETE");
+    if (historyCursor <= 0) return showFeedback("CANNOT UNDO FURTHER", true);
+    stepHistory('undo').then(done => done && showFeedback("UNDO COMPLETE"));
   }
 
   function redo() {
-    if (historyIndex >= history.length - 1) return showFeedback("CANNOT REDO FURTHER", true);
-    historyIndex++;
-    restoreHistoryState();
-    showFeedback("REDO COMPLETE");
+    if (historyCursor >= historyLength) return showFeedback("CANNOT REDO FURTHER", true);
+    stepHistory('redo').then(done => done && showFeedback("REDO COMPLETE"));
   }
 
-  function restoreHistoryState() {
-    const dataUrl = history[historyIndex];
-    const img = new Image();
-    img.onload = () => {
-      canvas.width = img.width;
-      canvas.height = img.height;
-      ctx.drawImage(img, 0, 0);
+  async function stepHistory(action) {
+    try {
+      const response = await fetch(`/history/${action}`, {
+        method: 'POST',
+        headers: { 'X-CSRFToken': getCookie('csrftoken') }
+      });
+      if (!response.ok) {
+        const data = await response.json().catch(() => ({}));
+        throw new Error(data.error || `HTTP ${response.status}`);
+      }
+      historyCursor = Number(response.headers.get('X-History-Cursor'));
+      historyLength = Number(response.headers.get('X-History-Length'));
+      loadImageFromBlob(await response.blob());
       updateHistoryButtons();
-      updateDimensionsDisplay();
-    };
-    img.onerror = () => showFeedback("ERROR RESTORING HISTORY", true);
-    img.src = dataUrl;
+      return true;
+    } catch (error) {
+      showFeedback("ERROR RESTORING HISTORY", true);
+      saveHistory();
+      return false;
+    }
   }
 
   function updateHistoryButtons() {
-    if (undoButton) undoButton.disabled = historyIndex <= 0;
-    if (redoButton) redoButton.disabled = historyIndex >= history.length - 1;
+    if (undoButton) undoButton.disabled = historyCursor <= 0;
+    if (redoButton) redoButton.disabled = historyCursor >= historyLength;
   }
 
   function toggleJpegQualitySlider() {